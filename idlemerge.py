@@ -16,19 +16,50 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import BaseHTTPServer
+import bisect
+import calendar
+import cgi
+import collections
+import cProfile
+import contextlib
+import csv
 import datetime
+import errno
+import fcntl
+import fnmatch
+import functools
+import gc
+import gzip
 import hashlib
+import heapq
+import json
+import math
+import multiprocessing
 import os
 import re
+import resource
 import select
 import shutil
+import signal
 import smtplib
+import socket
+import sqlite3
+import StringIO
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import types
 import xml.etree.ElementTree
 from optparse import OptionParser
 
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
 
 USAGE = """%prog <options
 
@@ -72,6 +103,8 @@ Downsides are:
 DEFAULT_NO_MERGE_PATTERNS = (
     'maven-release-plugin', 'NOMERGE', 'NO-MERGE', 'NO MERGE', 'NO_MERGE')
 
+DEFAULT_URGENT_MARKERS = ('MERGE_URGENT',)
+
 BIG_MUST_READ = """
   __  __ _    _  _____ _______   _____  ______          _____  _ _ _ 
  |  \/  | |  | |/ ____|__   __| |  __ \|  ____|   /\   |  __ \| | | |
@@ -120,11 +153,110 @@ def force_line_buffer():
         sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 1)
 
 
+class ConflictReport(object):
+    """Working copy changes left by a conflicting merge, classified in a single pass.
+
+    Each entry is a (kind, path, line) tuple: kind is one of KINDS, or None for the entries that
+    are not part of the merge commit, such as the root of the target, which is always committed
+    for its svn:mergeinfo, unless conflicted. Line is the entry in the 'svn status' text format.
+    Notes are the other lines of a plain 'svn status', such as the summary of conflicts.
+
+    Args:
+        entries: A list of (kind, path, line) tuples.
+        notes: A list of strings.
+    """
+    KINDS = ('conflicted', 'merged', 'added', 'deleted')
+    ITEM_CODES = {
+        'added': 'A', 'conflicted': 'C', 'deleted': 'D', 'external': 'X', 'ignored': 'I',
+        'incomplete': '!', 'missing': '!', 'modified': 'M', 'obstructed': '~', 'replaced': 'R',
+        'unversioned': '?'}
+    PROPS_CODES = {'conflicted': 'C', 'modified': 'M'}
+    # Item, properties, the five other columns of 'svn status', the path.
+    STATUS_LINE = re.compile(r'([ ACDIMRX?!~])([ CM])([ L+SXKOTBC]{0,5})\s+(\S.*?)\s*$')
+
+    def __init__(self, entries=(), notes=()):
+        self.entries = sorted(entries, key=lambda x: x[2])
+        self.notes = list(notes)
+
+    @staticmethod
+    def classify(item, props, tree_conflicted, root=False):
+        """Returns the kind of an entry from its item and properties status codes."""
+        if tree_conflicted or 'C' in (item, props):
+            return 'conflicted'
+        if root:
+            return None
+        if item == 'A':
+            return 'added'
+        if item == 'D':
+            return 'deleted'
+        if item in ('M', 'R') or props == 'M':
+            return 'merged'
+        return None
+
+    @classmethod
+    def from_status(cls, status):
+        """Build the report from a parsed Status(), without running svn again."""
+        roots = set(status.targets)
+        entries = []
+        for entry in status.entries:
+            if (entry.item == 'normal' and entry.props in ('none', 'normal')
+                    and not entry.tree_conflicted):
+                continue
+            item = cls.ITEM_CODES.get(entry.item, ' ')
+            props = cls.PROPS_CODES.get(entry.props, ' ')
+            line = '%s%s %s  %s %s' % (
+                item, props, '+' if entry.copied else ' ',
+                'C' if entry.tree_conflicted else ' ', entry.path)
+            kind = cls.classify(item, props, entry.tree_conflicted, entry.path in roots)
+            entries.append((kind, entry.path, line))
+        return cls(entries)
+
+    @classmethod
+    def from_lines(cls, lines):
+        """Build the report from the output of a plain 'svn status'."""
+        entries = []
+        notes = []
+        for line in lines:
+            line = line.rstrip()
+            match = cls.STATUS_LINE.match(line)
+            if match is None:
+                notes.append(line)
+                continue
+            item, props, columns, path = match.groups()
+            tree_conflicted = len(columns) == 5 and columns[4] == 'C'
+            entries.append((cls.classify(item, props, tree_conflicted, path == '.'), path, line))
+        return cls(entries, notes)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls([(x['kind'], x['path'], x['status']) for x in data['entries']],
+                   data.get('notes', ()))
+
+    def as_dict(self):
+        return {
+            'entries': [{'kind': kind, 'path': path, 'status': line}
+                        for kind, path, line in self.entries],
+            'notes': self.notes}
+
+    @property
+    def lines(self):
+        return [line for _, _, line in self.entries] + self.notes
+
+    def files(self, kind):
+        """Returns the paths of kind, one of KINDS."""
+        return [path for entry_kind, path, _ in self.entries if entry_kind == kind]
+
+
 class Conflict(Error):
-    """Class to handle merge conflicts exceptions."""
+    """Class to handle merge conflicts exceptions.
+
+    The conflicting files come from report, a ConflictReport(), or from status_lines, the output
+    of a plain 'svn status'. With neither, the working copy status is queried when needed.
+    """
 
     def __init__(
-        self, revision, mergeinfos=None, merges=None, message=None, source=None, target=None):
+        self, revision, mergeinfos=None, merges=None, message=None, source=None, target=None,
+        status_lines=None, report=None):
         super(Conflict, self).__init__()
         self.revision = revision
         self.mergeinfos = mergeinfos
@@ -132,7 +264,9 @@ class Conflict(Error):
         self.source = source
         self.target = target
         self._message = message
-        self._status = None
+        self._report = report
+        if report is None and status_lines is not None:
+            self._report = ConflictReport.from_lines(status_lines)
 
     def __str__(self):
         message_lines = [self._message] if self._message else []
@@ -142,28 +276,6 @@ class Conflict(Error):
                 'Pending record-only merges: ' + revisions_as_string(self.mergeinfos))
         if self.merges:
             message_lines.append('Pending clean merges: ' + revisions_as_string(self.merges))
-
-        conflict_files = []
-        merged_files = []
-        added_files = []
-        deleted_files = []
-        for line in self.status:
-            match = re.match(r'(?:!\s+C|C)\s+(.*\w)$', line)
-            if match:
-                conflict_files.append(match.group(1))
-                continue
-            match = re.match(r'[ ]?M\s+(.*\w)$', line)
-            if match:
-                merged_files.append(match.group(1))
-            match = re.match(r'[ ]?A\s+\+\s+(.*\w)$', line)
-            if match:
-                added_files.append(match.group(1))
-            match = re.match(r'[ ]?D\s+(.*\w)$', line)
-            if match:
-                deleted_files.append(match.group(1))
-
-        target = self.target
-        source = self.source
         resolve_lines = [
             '',
             BIG_MUST_READ,
@@ -171,18 +283,7 @@ class Conflict(Error):
             'To resolve use the official subversion command line client.:',
             'Do not use a GUI client such as Eclipse or TortoiseSVN for any of the steps.',
             'If you use them, even to commit the merge metada will be skipped breaking idlemerge.',
-            'You must be in the target branch not in the %s branch' % (source,),
-            '$ cd %s # or your own working copy equivalent of the *target* branch' % (target,),
-            '$ svn up',
-            '$ svn st',
-            '# make sure that none of these files '
-            'have pending changes: %s' % (' '.join(conflict_files + merged_files)),
-            '$ svn merge -c %s --accept postpone  %s' % (self.revision.number, source),
-            '$ svn st',
-            '# resolve the conflicted files, '
-            'stay directly in the base directory of the branch to commit',
-            '$ svn commit -N . %s'
-                % (' '.join(conflict_files + merged_files + added_files + deleted_files)),
+        ] + self.resolve_steps() + [
             '# Note that the dot is important to commit since '
             'it contains the svn:mergeinfo metadata required for idlemerge to work properly.',
             '',
@@ -191,25 +292,125 @@ class Conflict(Error):
         ]
         return '\n'.join(message_lines + self.status + resolve_lines)
 
+    def resolve_steps(self):
+        """Returns the shell session resolving the conflict, as a list of lines."""
+        report = self.report
+        pending = report.files('conflicted') + report.files('merged')
+        committed = pending + report.files('added') + report.files('deleted')
+        return [
+            'You must be in the target branch not in the %s branch' % (self.source,),
+            '$ cd %s # or your own working copy equivalent of the *target* branch' % (
+                self.target,),
+            '$ svn up',
+            '$ svn st',
+            '# make sure that none of these files have pending changes: %s' % ' '.join(pending),
+            '$ svn merge -c %s --accept postpone  %s' % (self.revision.number, self.source),
+            '$ svn st',
+            '# resolve the conflicted files, '
+            'stay directly in the base directory of the branch to commit',
+            '$ svn commit -N . %s' % ' '.join(committed),
+        ]
+
+    @property
+    def report(self):
+        if self._report is None:
+            status_lines = execute_command(['svn', 'status', '--xml'])['stdout']
+            self._report = ConflictReport.from_status(
+                Status(xml.etree.ElementTree.fromstring(''.join(status_lines))))
+        return self._report
+
     @property
     def status(self):
-        if self._status is None:
-            status_lines = execute_command(['svn', 'status'])['stdout']
-            meta_lines = []
-            other_lines = []
-            for line in status_lines:
-                if re.match(r'\s?\S{1,2}\s+', line):
-                    meta_lines.append(line.rstrip())
-                else:
-                    other_lines.append(line.rstrip())
-            self._status = sorted(meta_lines) + other_lines
-        return self._status
+        return self.report.lines
 
     @property
     def subject(self):
         return 'MANUAL MERGE NEEDS TO BE DONE: revision %s by %s from %s' % (
             self.revision, self.revision.author, self.source)
 
+    def as_dict(self):
+        """Returns the conflict report as a JSON serializable dict."""
+        report = self.report
+        data = {
+            'revision': int(self.revision.number),
+            'author': self.revision.author,
+            'source': self.source,
+            'target': self.target,
+            'subject': self.subject,
+            'message': self._message,
+            'pending_record_only': sorted(int(x) for x in self.mergeinfos or ()),
+            'pending_merges': sorted(int(x) for x in self.merges or ()),
+            'resolve': self.resolve_steps(),
+            'time': time.time(),
+        }
+        data.update(report.as_dict())
+        for kind in ConflictReport.KINDS:
+            data[kind] = report.files(kind)
+        return data
+
+    def html(self):
+        """Returns the conflict report as a standalone HTML page."""
+        escape = functools.partial(cgi.escape, quote=True)
+        rows = []
+        for kind, path, line in self.report.entries:
+            rows.append('<tr class="%s"><td>%s</td><td><code>%s</code></td></tr>' % (
+                kind or 'other', escape(line[:7].rstrip() or ' '), escape(path)))
+        pending = []
+        if self.mergeinfos:
+            pending.append('<p>Pending record-only merges: %s</p>' % escape(
+                revisions_as_string(self.mergeinfos)))
+        if self.merges:
+            pending.append('<p>Pending clean merges: %s</p>' % escape(
+                revisions_as_string(self.merges)))
+        return '\n'.join([
+            '<!DOCTYPE html>',
+            '<html><head><meta charset="utf-8"><title>%s</title></head><body>' % escape(
+                self.subject),
+            '<h1>%s</h1>' % escape(self.subject),
+            '<p>%s</p>' % escape(self._message) if self._message else '',
+        ] + pending + [
+            '<table><tr><th>status</th><th>path</th></tr>',
+        ] + rows + [
+            '</table>',
+            '<h2>To resolve</h2>',
+            '<pre>%s</pre>' % escape('\n'.join(self.resolve_steps())),
+            '</body></html>',
+            ''
+        ])
+
+    def write(self, output, report_format='json'):
+        """Write the report to output, a file, in the json, html or text format."""
+        if report_format == 'json':
+            json.dump(self.as_dict(), output, indent=2, sort_keys=True)
+        elif report_format == 'html':
+            output.write(self.html())
+        else:
+            output.write(str(self))
+
+
+class BudgetExhausted(Error):
+    """Raised at a commit boundary when the pass budget is spent, see PassBudget()."""
+
+    def __init__(self, reason, revisions):
+        super(BudgetExhausted, self).__init__()
+        self.reason = reason
+        self.revisions = revisions
+
+    def __str__(self):
+        return 'Pass budget exhausted (%s), %d revisions left for the next pass: %s' % (
+            self.reason, len(self.revisions), revisions_as_string(self.revisions))
+
+
+class UnexpectedModifications(Error):
+    """Raised when a merge modified paths outside of the merged revisions, see commit_targets()."""
+
+    def __init__(self, paths):
+        super(UnexpectedModifications, self).__init__()
+        self.paths = paths
+
+    def __str__(self):
+        return 'Refusing to commit unexpected modifications: %s' % ' '.join(self.paths)
+
 
 def parse_args(argv):
     parser = OptionParser(USAGE)
@@ -223,10 +424,14 @@ def parse_args(argv):
     parser.add_option('-c', '--concise', dest='concise', action='store_true',
         help='if --single is activated, bundle up mergeinfo only merges together to reduce noise.')
     parser.add_option('-a', '--patterns', dest='patterns',
-        help='patterns contained in comments of revisions not to be merged, comma separated')
+        help='rules of the revisions not to be merged, comma separated: text contained in the'
+        ' comment, re:REGEX, author:NAME or path:PATTERN relative to the source branch.')
+    parser.add_option('--rules_file', dest='rules_file', default='patterns.txt',
+        help='file of --patterns rules, one per line, reloaded when it changes.'
+        ' Default is patterns.txt.')
     parser.add_option('-m', '--max', dest='max', default=10, type='int',
-        help='maximum number of revisions to merge in this pass.'
-        ' Used for troubleshooting, 0 is infinite.')
+        help='maximum number of revisions to merge in this pass, 0 is infinite. The pass stops at'
+        ' the first commit reaching it.')
     parser.add_option('-r', '--record_only_file', dest='record_only_filename',
         help='file to store/read record-only revisions.')
     parser.add_option('-v', '--verbose', dest='verbose', action='store_true', help='verbose mode')
@@ -244,10 +449,124 @@ def parse_args(argv):
         help='Email address for the sender')
     parser.add_option('-A', '--append_email', dest='append_email_filename',
         help='Path to a text file to append to the body of the conflict email')
+    parser.add_option('--notify_state', dest='notify_state',
+        help='JSON file of the conflict emails already sent, a conflict left pending is then only'
+        ' emailed again when it changes or after --remind_hours')
+    parser.add_option('--remind_hours', dest='remind_hours', default=24, type='float',
+        help='Hours after which a pending conflict is emailed again, 0 to never remind')
+    parser.add_option('--mail_spool', dest='mail_spool',
+        help='Directory to spool the emails in until delivered, undelivered emails are retried'
+        ' by the next pass. One directory per pair.')
+    parser.add_option('--smtp_host', dest='smtp_host', default='localhost',
+        help='The SMTP relay delivering the emails')
     parser.add_option('-i', '--ignore', dest='ignore',
         help='A comma separated list of files to not merge, usually branch specific files'
         ' such as pom.xml. Each entry is a relative path in the branch.'
     )
+    parser.add_option('--reset', dest='reset', default='auto',
+        help='strategy to get a pristine working copy: auto, snapshot, journal, cleanup or full.'
+        ' Default is auto.')
+    parser.add_option('--dirty_journal', dest='dirty_journal',
+        help='file recording the paths dirtied by merges, enables the journal reset strategy.')
+    parser.add_option('--snapshot_dir', dest='snapshot_dir',
+        help='directory where to keep a clean clone of the working copy, on the same filesystem.'
+        ' Requires --dirty_journal.')
+    parser.add_option('--targeted_update', dest='targeted_update', action='store_true',
+        help='only update the target root and the paths the eligible revisions touch, merging'
+        ' into a mixed-revision working copy.')
+    parser.add_option('--shards', dest='shards',
+        help='merge into sparse working copies, one per group of top level directories, in'
+        ' parallel. Comma separated groups, each is name=dir1+dir2 or a single dir.'
+        ' Requires --single, --concise and --shard_root.')
+    parser.add_option('--shard_root', dest='shard_root',
+        help='directory holding the sparse working copies of --shards.')
+    parser.add_option('--local_eligible', dest='local_eligible', action='store_true',
+        help='compute the eligible revisions from the target svn:mergeinfo and the cached source'
+        ' log instead of asking the server with svn mergeinfo.')
+    parser.add_option('--verify_eligible', dest='verify_eligible', action='store_true',
+        help='compute the eligible revisions locally and on the server, report the differences'
+        ' and use the server answer.')
+    parser.add_option('--cache_dir', dest='cache_dir',
+        help='directory where to keep persistent caches, such as the source log.')
+    parser.add_option('--index_targets', dest='index_targets',
+        help='comma separated target branches to index the idlemerge merges of, for --where.')
+    parser.add_option('--where', dest='where', type='int',
+        help='update the merge index of --index_targets and report where this source revision'
+        ' landed, following the chain of merges. No merge is done.')
+    parser.add_option('--plan', dest='plan', type='int',
+        help='test-merge every eligible revision in PLAN scratch clones of the working copy, in'
+        ' parallel, and report the clean, mergeinfo only, auto-resolvable and conflicting ones.'
+        ' See --report_output. No merge is done.')
+    parser.add_option('--plan_dir', dest='plan_dir',
+        help='directory to keep the --plan scratch working copies in between runs.')
+    parser.add_option('--latency_report', dest='latency_report',
+        help='comma separated target branches, upstream first, to report the merge latency'
+        ' distributions, queue depth and blocked time of. No merge is done.')
+    parser.add_option('--report_range', dest='report_range', default='1:HEAD',
+        help='revision range of the target logs to scan for --latency_report. Default is 1:HEAD.')
+    parser.add_option('--report_format', dest='report_format', default='csv',
+        help='csv or json, format of --report_output. Default is csv.')
+    parser.add_option('--report_output', dest='report_output',
+        help='file to write the --latency_report or the --plan to.')
+    parser.add_option('--blocked_threshold', dest='blocked_threshold', default=30, type='int',
+        help='minutes of latency after which a revision is considered blocked behind a conflict.'
+        ' Default is 30.')
+    parser.add_option('--trace', dest='trace',
+        help='JSONL file to append the timings of each phase and svn command of the run to.')
+    parser.add_option('--profile', dest='profile',
+        help='directory to write cProfile stats and allocation reports of each phase to.')
+    parser.add_option('--record', dest='record',
+        help='archive to record the svn commands and their outputs to, .gz to compress.')
+    parser.add_option('--replay', dest='replay',
+        help='archive of a --record run to serve the svn outputs from, svn is not run.')
+    parser.add_option('--redact', dest='redact', action='append', default=[],
+        help='REAL=PLACEHOLDER, text to replace in the --record archive, e.g. a host name. '
+        'Give the same ones to --replay. Can be repeated.')
+    parser.add_option('--run_journal', dest='run_journal',
+        help='file journaling the merge steps, to commit a merge interrupted by a crash on the'
+        ' next run instead of merging it again.')
+    parser.add_option('--lock_policy', dest='lock_policy', default='none',
+        help='when another run holds the working copy: skip, queue (wait behind it, one run at'
+        ' most) or signal (ask it for one more pass and exit). Default is none, no lock.')
+    parser.add_option('--lock_file', dest='lock_file',
+        help='lock file of --lock_policy. Default is idlemerge.lock in the .svn directory of the'
+        ' working copy root.')
+    parser.add_option('--lock_timeout', dest='lock_timeout', type='int',
+        help='seconds to wait for the lock with --lock_policy=queue. Default is no limit.')
+    parser.add_option('--urgent_markers', dest='urgent_markers', default='MERGE_URGENT',
+        help='comma separated markers of the commit messages to merge ahead of the older pending'
+        ' revisions they do not overlap. Default is MERGE_URGENT.')
+    parser.add_option('--urgent_authors', dest='urgent_authors',
+        help='comma separated authors whose revisions are urgent, see --urgent_markers.')
+    parser.add_option('--urgent_paths', dest='urgent_paths',
+        help='comma separated patterns relative to the source branch, e.g. security/*, of the'
+        ' paths whose changes are urgent, see --urgent_markers.')
+    parser.add_option('--predict_batch', dest='predict_batch', default=0, type='int',
+        help='in concise mode, merge and commit together up to PREDICT_BATCH revisions that do not'
+        ' touch the paths the target changed on its own, likely conflicts are merged one by one.'
+        ' Default is 0, disabled.')
+    parser.add_option('--max_seconds', dest='max_seconds', default=0, type='int',
+        help='stop the pass at the first commit after MAX_SECONDS seconds, 0 is infinite.')
+    parser.add_option('--max_bytes', dest='max_bytes', default=0, type='int',
+        help='stop the pass at the first commit reaching MAX_BYTES bytes of changed files,'
+        ' 0 is infinite.')
+    parser.add_option('--cursor_file', dest='cursor_file',
+        help='JSON file recording after each pass the next revision to merge and why the pass'
+        ' stopped, for the schedulers of several pairs.')
+    parser.add_option('--conflict_report', dest='conflict_report',
+        help='JSON file to store the report of the conflict blocking the pair in, for the'
+        ' dashboards and notification hooks. Removed once the pair merges again.')
+    parser.add_option('--conflict_html', dest='conflict_html',
+        help='HTML file to store the report of the conflict blocking the pair in.')
+    parser.add_option('--metrics_file', dest='metrics_file',
+        help='Prometheus textfile to write the queue health metrics to after each pass.')
+    parser.add_option('--daemon', dest='daemon', type='int',
+        help='keep running, starting a merge pass every DAEMON seconds.')
+    parser.add_option('--metrics_port', dest='metrics_port', type='int',
+        help='in --daemon mode, serve the metrics on http://:METRICS_PORT/metrics.')
+    parser.add_option('--lookahead', dest='lookahead', default=5, type='int',
+        help='number of revisions to load and analyze in the background ahead of the merge,'
+        ' 0 disables the prefetching. Default is 5.')
 
     # TODO(stephane): options to be implemented:
     # merge subdirs independently as long as no pending conflict is in the same directory.
@@ -263,7 +582,12 @@ def parse_args(argv):
 
     options, _ = parser.parse_args(argv[1:])
 
-    if not options.source:
+    if options.where and not options.index_targets:
+        print USAGE
+        raise Error()
+    if options.where or options.latency_report:
+        return options
+    if not options.source or (options.shards and not options.shard_root):
         print USAGE
         raise Error()
     return options
@@ -328,7 +652,13 @@ def execute_command(
     read = 0
     inputs = (out_buffer, err_buffer)
     while True:
-        readable, _ , _ = select.select(inputs, (), ())
+        try:
+            readable, _ , _ = select.select(inputs, (), ())
+        except select.error as error:
+            if error.args[0] == errno.EINTR:
+                # A signal handler ran, e.g. the SIGUSR1 one of --lock_policy=signal.
+                continue
+            raise
         if not readable:
             break
         for stream in readable:
@@ -356,6 +686,256 @@ def execute_command(
     return process_output
 
 
+SVN_SUBCOMMANDS = frozenset([
+    'cat', 'checkout', 'cleanup', 'commit', 'diff', 'info', 'log', 'merge', 'mergeinfo', 'propget',
+    'resolved', 'revert', 'status', 'update'])
+
+
+def svn_subcommand(options):
+    """Returns the svn subcommand of a list of svn options."""
+    for option in options:
+        if option in SVN_SUBCOMMANDS:
+            return option
+    for option in options:
+        if not option.startswith('-'):
+            return option
+    return options[0] if options else ''
+
+
+class RunTrace(object):
+    """Hierarchical timers for the IdleMerge phases and the svn commands of a run.
+
+    Each phase and each command is written as a JSON line to the trace file, if any, and
+    aggregated for the summary table. Phases nest, a command is attributed to the innermost
+    phase of the thread running it.
+
+    Listeners, e.g. a Profiler(), are notified of the start and the end of each phase.
+
+    Args:
+        filename: A string, the JSONL file to append the trace to. None to only aggregate.
+        run_id: A string, the identifier of the run in the trace. Default is time and pid based.
+        labels: A dict, extra fields for each record, e.g. the source and target of the pair.
+    """
+
+    def __init__(self, filename=None, run_id=None, labels=None):
+        self.filename = filename
+        self.run_id = run_id or '%s-%d' % (time.strftime('%Y%m%dT%H%M%S'), os.getpid())
+        self.labels = labels or {}
+        self.phases = {}
+        self.commands = {}
+        self.listeners = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._file = None
+
+    @property
+    def stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @property
+    def current_phase(self):
+        return '/'.join(self.stack)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.stack.append(name)
+        path = self.current_phase
+        for listener in self.listeners:
+            listener.phase_started(path)
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            self.stack.pop()
+            for listener in reversed(self.listeners):
+                listener.phase_ended(path, duration)
+            self._aggregate(self.phases, path, duration)
+            self._write({'type': 'phase', 'phase': path, 'start': start, 'duration': duration})
+
+    def record_command(self, options, duration, output_bytes, return_code):
+        subcommand = svn_subcommand(options)
+        self._aggregate(self.commands, subcommand, duration, output_bytes)
+        self._write({
+            'type': 'command', 'phase': self.current_phase, 'subcommand': subcommand,
+            'args': options, 'duration': duration, 'bytes': output_bytes,
+            'return_code': return_code})
+
+    def _aggregate(self, totals, key, duration, output_bytes=0):
+        with self._lock:
+            count, seconds, size = totals.get(key, (0, 0.0, 0))
+            totals[key] = (count + 1, seconds + duration, size + output_bytes)
+
+    def _write(self, record):
+        if not self.filename:
+            return
+        record['run'] = self.run_id
+        record.update(self.labels)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.filename, 'a')
+            self._file.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def summary(self):
+        """Returns the summary table of the phases and svn commands, as a string."""
+        lines = ['%-60s %6s %10s' % ('phase', 'count', 'seconds')]
+        for path in sorted(self.phases):
+            count, seconds, _ = self.phases[path]
+            lines.append('%-60s %6d %10.2f' % (path, count, seconds))
+        lines.append('')
+        lines.append('%-60s %6s %10s %12s' % ('svn command', 'count', 'seconds', 'bytes'))
+        for subcommand in sorted(self.commands):
+            count, seconds, size = self.commands[subcommand]
+            lines.append('%-60s %6d %10.2f %12d' % (subcommand, count, seconds, size))
+        return '\n'.join(lines)
+
+
+class Profiler(object):
+    """cProfile and allocation profiles of the phases of a RunTrace().
+
+    Each phase of the main thread gets its own cProfile.Profile, enabled while the phase is the
+    innermost one, so a pstats file holds the time spent in a phase outside of its sub-phases.
+    Allocations are measured with tracemalloc where available, the top lines growing during
+    each phase, sub-phases included. Without tracemalloc (Python 2) the growth of the live
+    objects per type is reported instead, along with the max RSS increase.
+
+    Args:
+        directory: A string, the directory to write the profiles to.
+        run_id: A string, the run identifier, see RunTrace().
+        label: A string, the source/target pair, used in the file names.
+        top: An integer, the number of allocation sites reported per phase.
+    """
+    ROOT = 'run'
+
+    def __init__(self, directory, run_id, label, top=20):
+        self.directory = directory
+        self.prefix = '%s-%s' % (re.sub(r'[^\w.-]+', '_', label).strip('_'), run_id)
+        self.top = top
+        self.profiles = {}
+        self.allocations = {}
+        self._stack = []
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.current_thread()
+        if tracemalloc is not None:
+            tracemalloc.start()
+        self.phase_started(self.ROOT)
+
+    def stop(self):
+        if self._stack:
+            self.phase_ended(self.ROOT, 0)
+        if tracemalloc is not None:
+            tracemalloc.stop()
+
+    def _profile(self, path):
+        if path not in self.profiles:
+            self.profiles[path] = cProfile.Profile()
+        return self.profiles[path]
+
+    @staticmethod
+    def _allocation_snapshot():
+        if tracemalloc is not None:
+            return tracemalloc.take_snapshot()
+        counts = {}
+        for obj in gc.get_objects():
+            name = type(obj).__name__
+            counts[name] = counts.get(name, 0) + 1
+        return counts, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def _record_allocations(self, path, before):
+        totals = self.allocations.setdefault(path, {})
+        if tracemalloc is not None:
+            diffs = [(str(x.traceback), x.size_diff, x.count_diff)
+                     for x in tracemalloc.take_snapshot().compare_to(before, 'lineno')]
+        else:
+            counts, maxrss = self._allocation_snapshot()
+            diffs = [(name, 0, count - before[0].get(name, 0))
+                     for name, count in counts.items() if count != before[0].get(name, 0)]
+            diffs.append(('max rss (KiB)', 0, maxrss - before[1]))
+        for key, size, count in diffs:
+            total_size, total_count = totals.get(key, (0, 0))
+            totals[key] = (total_size + size, total_count + count)
+
+    def phase_started(self, path):
+        if threading.current_thread() is not self._thread:
+            return
+        if self._stack:
+            self._stack[-1][1].disable()
+        # Snapshot before enabling the profile, to keep it out of the phase profile.
+        snapshot = self._allocation_snapshot()
+        profile = self._profile(path)
+        self._stack.append((path, profile, snapshot))
+        profile.enable()
+
+    def phase_ended(self, path, duration):
+        if threading.current_thread() is not self._thread or not self._stack:
+            return
+        _, profile, snapshot = self._stack.pop()
+        profile.disable()
+        self._record_allocations(path, snapshot)
+        if self._stack:
+            self._stack[-1][1].enable()
+
+    def allocation_report(self):
+        """Returns the top allocation sites of each phase, as a string."""
+        unit = 'bytes' if tracemalloc is not None else 'objects'
+        lines = []
+        for path in sorted(self.allocations):
+            lines.append('== %s (%s)' % (path, unit))
+            totals = self.allocations[path]
+            key_index = 0 if tracemalloc is not None else 1
+            for key in sorted(totals, key=lambda x: -abs(totals[x][key_index]))[:self.top]:
+                size, count = totals[key]
+                lines.append('%12d %10d  %s' % (size, count, key))
+            lines.append('')
+        return '\n'.join(lines)
+
+    def write(self):
+        """Write the pstats file of each phase and the allocation report.
+
+        Returns:
+            A list of strings, the files written.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        filenames = []
+        for path, profile in sorted(self.profiles.items()):
+            enabled = any(x[1] is profile for x in self._stack[-1:])
+            if enabled:
+                profile.disable()
+            filename = os.path.join(
+                self.directory, '%s.%s.pstats' % (self.prefix, path.replace('/', '.')))
+            profile.dump_stats(filename)
+            filenames.append(filename)
+            if enabled:
+                profile.enable()
+        filename = os.path.join(self.directory, '%s.alloc.txt' % self.prefix)
+        with open(filename, 'w') as report_file:
+            report_file.write(self.allocation_report())
+        filenames.append(filename)
+        return filenames
+
+
+def traced(name):
+    """Decorator timing an IdleMerge method as a phase of its RunTrace()."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.tracer.phase(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class AuthToken(object):
     """Simple wrapper used to pass username and password around."""
 
@@ -388,6 +968,10 @@ class LogPath(object):
     def kind(self):
         return self._xml.attrib['kind']
 
+    @property
+    def copyfrom_path(self):
+        return self._xml.attrib.get('copyfrom-path')
+
     @property
     def is_file(self):
         return self.kind == 'file'
@@ -397,6 +981,34 @@ class LogPath(object):
         return not self.is_file
 
 
+# <path
+#    props="none"
+#    kind="file"
+#    item="modified">svn+ssh://svn/sandbox/branches/stable/foo.py</path>
+class SummaryPath(object):
+    """Abstraction class for <path> entries from svn diff --summarize --xml."""
+
+    def __init__(self, xml_element):
+        self._xml = xml_element
+
+    @property
+    def url(self):
+        return self._xml.text
+
+    @property
+    def item(self):
+        """Returns the change type: 'added', 'deleted', 'modified' or 'none'."""
+        return self._xml.attrib['item']
+
+    @property
+    def props(self):
+        return self._xml.attrib['props']
+
+    @property
+    def kind(self):
+        return self._xml.attrib['kind']
+
+
 class Revision(object):
     """Svn revision class.
 
@@ -430,6 +1042,7 @@ class Revision(object):
         self._idle_data = None
         self._paths = None
         self._original_branch = None
+        self._summary = None
 
     def __str__(self):
         return str(self.number)
@@ -455,6 +1068,10 @@ class Revision(object):
             self._delete_properties()
             self._number = int(revision_number)
 
+    @property
+    def log_loaded(self):
+        return self._xml is not None
+
     @property
     def xml_element(self):
         if self._xml is None:
@@ -509,7 +1126,8 @@ class Revision(object):
         # Note: Python2.7 supports flags=re.MULTILINE -- stephane
         match = re.split(r'(^|\n)-- IDLEMERGE DATA --\n', full_msg, 1)
         self._msg = match[0]
-        self._idle_data = match[1] if len(match) > 1 else ''
+        # match[1] is the captured separator.
+        self._idle_data = match[-1] if len(match) > 1 else ''
 
     @property
     def paths(self):
@@ -544,16 +1162,50 @@ class Revision(object):
             return self.branch
         return match.group(1)
 
+    @property
+    def summary(self):
+        """Returns the SummaryPath() entries of 'svn diff --summarize' for this revision."""
+        if self._summary is None:
+            self._summary = self._get_summary()
+        return self._summary
+
+    def _get_summary(self, svn=None):
+        if svn is None:
+            svn = self.svn
+        svn.run(['diff', '--summarize', '--xml', '-c', str(self.number),
+                 '%s@%s' % (self.original_branch, self.number)])
+        if svn.return_code:
+            return []
+        diff = xml.etree.ElementTree.fromstring(''.join(svn.stdout))
+        return [SummaryPath(x) for x in diff.findall('paths/path')]
+
+    def prefetch(self, svn=None):
+        """Load the log entry, the original branch and the diff summary ahead of the merge.
+
+        Args:
+            svn: An SvnWrapper instance to use instead of self.svn. A background thread must use
+                its own instance since SvnWrapper keeps the status of the last command.
+        """
+        if self._xml is None:
+            self._get_log(svn)
+        if self._original_branch is None:
+            self._original_branch = self._get_original_branch()
+        if self._summary is None:
+            self._summary = self._get_summary(svn)
+
     def _delete_properties(self):
         self._xml = None
         self._author = None
         self._date = None
         self._msg = None
+        self._summary = None
 
-    def _get_log(self):
+    def _get_log(self, svn=None):
+        if svn is None:
+            svn = self.svn
         self._delete_properties()
-        self.svn.log(['--xml', '-v', '-r', str(self.number), self.branch])
-        log = xml.etree.ElementTree.fromstring(''.join(self.svn.stdout))
+        svn.log(['--xml', '-v', '-r', str(self.number), self.branch])
+        log = xml.etree.ElementTree.fromstring(''.join(svn.stdout))
         self._xml = log.find('logentry')
 
 
@@ -562,6 +1214,272 @@ def revisions_as_string(revisions, separator=', '):
     return separator.join([str(revision) for revision in sorted_revisions])
 
 
+class RevisionPrefetcher(object):
+    """Background stage loading the upcoming revisions while the current one merges.
+
+    The svn merge and svn commit of a revision leave the network idle, the worker thread uses that
+    time to fetch the log, detect the original branch and run 'svn diff --summarize' for the next
+    revisions of the queue. At most lookahead revisions are loaded ahead of the merge cursor.
+
+    Args:
+        revisions: A list of Revision() instances, in merge order.
+        lookahead: An integer, the number of revisions to keep loaded ahead of the cursor. 0
+            disables the prefetching, revisions are then loaded lazily as before.
+        svn: An SvnWrapper instance dedicated to the worker thread.
+    """
+
+    def __init__(self, revisions, lookahead=5, svn=None):
+        self._revisions = list(revisions)
+        self.lookahead = lookahead
+        self._svn = svn
+        self._index = dict([(r.number, i) for i, r in enumerate(self._revisions)])
+        self._loaded = dict([(r.number, threading.Event()) for r in self._revisions])
+        self._cursor = 0
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        if self.lookahead <= 0 or not self._revisions:
+            return
+        self._thread = threading.Thread(target=self._run, name='idlemerge-prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._condition.acquire()
+        try:
+            self._stopped = True
+            self._condition.notify_all()
+        finally:
+            self._condition.release()
+        self._thread.join()
+        self._thread = None
+
+    def wait_for(self, revision):
+        """Move the cursor to revision and block until it has been loaded."""
+        if self._thread is None or revision.number not in self._index:
+            return
+        self._condition.acquire()
+        try:
+            self._cursor = max(self._cursor, self._index[revision.number])
+            self._condition.notify_all()
+        finally:
+            self._condition.release()
+        self._loaded[revision.number].wait()
+
+    def _run(self):
+        for index, revision in enumerate(self._revisions):
+            self._condition.acquire()
+            try:
+                while not self._stopped and index >= self._cursor + self.lookahead:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+            finally:
+                self._condition.release()
+            try:
+                revision.prefetch(self._svn)
+            except Exception:   # pylint: disable=W0703
+                # The merge thread loads the revision lazily and reports the error itself.
+                pass
+            self._loaded[revision.number].set()
+
+
+class RevisionRanges(object):
+    """Set of revision numbers stored as sorted, disjoint and inclusive (start, end) ranges.
+
+    Args:
+        ranges: An iterable of (start, end) integer tuples, in any order, possibly overlapping.
+    """
+
+    def __init__(self, ranges=()):
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        self.ranges = merged
+        self._starts = [start for start, _ in merged]
+
+    @classmethod
+    def parse(cls, text):
+        """Parse svn:mergeinfo ranges such as '1-5,7,9-12*'.
+
+        Non-inheritable ranges, with a trailing '*', are skipped: these revisions are only
+        partially merged and svn still reports them as eligible.
+        """
+        ranges = []
+        for item in text.split(','):
+            item = item.strip()
+            if not item or item.endswith('*'):
+                continue
+            start, _, end = item.partition('-')
+            ranges.append((int(start), int(end or start)))
+        return cls(ranges)
+
+    @classmethod
+    def from_revisions(cls, numbers):
+        return cls([(int(x), int(x)) for x in numbers])
+
+    def __contains__(self, number):
+        index = bisect.bisect_right(self._starts, int(number)) - 1
+        return index >= 0 and self.ranges[index][1] >= int(number)
+
+    def __iter__(self):
+        for start, end in self.ranges:
+            for number in xrange(start, end + 1):
+                yield number
+
+    def __len__(self):
+        return sum([end - start + 1 for start, end in self.ranges])
+
+    def __eq__(self, other):
+        return isinstance(other, RevisionRanges) and self.ranges == other.ranges
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return ','.join(
+            [str(start) if start == end else '%d-%d' % (start, end) for start, end in self.ranges])
+
+    def __repr__(self):
+        return 'RevisionRanges(%r)' % self.ranges
+
+    def union(self, other):
+        return RevisionRanges(self.ranges + other.ranges)
+
+    def difference(self, other):
+        """Returns the revisions of self that are not in other, as a RevisionRanges()."""
+        result = []
+        others = other.ranges
+        index = 0
+        for start, end in self.ranges:
+            while index < len(others) and others[index][1] < start:
+                index += 1
+            position = index
+            while start <= end:
+                if position >= len(others) or others[position][0] > end:
+                    result.append((start, end))
+                    break
+                other_start, other_end = others[position]
+                if other_start > start:
+                    result.append((start, other_start - 1))
+                start = other_end + 1
+                position += 1
+        return RevisionRanges(result)
+
+
+def parse_mergeinfo(lines):
+    """Parse a svn:mergeinfo property value.
+
+    Args:
+        lines: A list of strings, each is '/repo/path:ranges'.
+
+    Returns:
+        A dict, the repository path as key and the merged RevisionRanges() as value.
+    """
+    mergeinfo = {}
+    for line in lines:
+        path, _, ranges = line.strip().rpartition(':')
+        if not path:
+            continue
+        mergeinfo[path] = mergeinfo.get(path, RevisionRanges()).union(RevisionRanges.parse(ranges))
+    return mergeinfo
+
+
+class LogCache(object):
+    """Persistent cache of the revisions changing a branch, updated incrementally.
+
+    Only the branch's own revisions are kept, up to the copy that created it (svn log
+    --stop-on-copy), the creation revision itself is excluded. The cache file is keyed by the
+    repository UUID and the branch path, so that the repositories sharing a cache_dir never mix.
+
+    Args:
+        svn: An SvnWrapper instance.
+        url: A string, the branch url, e.g. ^/branches/stable.
+        repo_path: A string, the path of the branch in the repository, e.g. /branches/stable.
+        cache_dir: A string, the directory where to store the cache. None keeps it in memory only.
+    """
+
+    def __init__(self, svn, url, repo_path, cache_dir=None):
+        self.svn = svn
+        self.url = url
+        self.repo_path = repo_path
+        self.cache_dir = cache_dir
+        self.uuid = None
+        self._youngest = 0
+        self._revisions = None
+
+    @property
+    def key(self):
+        return '%s%s' % (self.uuid, self.repo_path)
+
+    @property
+    def filename(self):
+        if not self.cache_dir:
+            return None
+        return os.path.join(self.cache_dir, 'log-%s.json' % hashlib.md5(self.key).hexdigest())
+
+    def load(self):
+        self._youngest = 0
+        self._revisions = RevisionRanges()
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'r') as cache_file:
+            data = json.load(cache_file)
+        if data.get('key') != self.key:
+            return
+        self._youngest = data['youngest']
+        self._revisions = RevisionRanges([tuple(x) for x in data['ranges']])
+
+    def save(self):
+        if not self.filename:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        data = {'key': self.key, 'youngest': self._youngest, 'ranges': self._revisions.ranges}
+        with open(self.filename + '.tmp', 'w') as cache_file:
+            json.dump(data, cache_file)
+        os.rename(self.filename + '.tmp', self.filename)
+
+    def last_changed_revision(self):
+        """Returns the last changed revision of the branch, and sets the repository UUID."""
+        self.svn.run(['info', '--xml', self.url])
+        if self.svn.return_code:
+            raise Error('Cannot get info for %s: %s' % (self.url, ''.join(self.svn.stderr)))
+        entry = Info(xml.etree.ElementTree.fromstring(''.join(self.svn.stdout))).entries[0]
+        self.uuid = entry.repo_uuid
+        return int(entry.commit_revision)
+
+    def revisions(self):
+        """Returns the RevisionRanges() of the revisions changing the branch."""
+        last_changed = self.last_changed_revision()
+        if self._revisions is None:
+            self.load()
+        if last_changed <= self._youngest:
+            return self._revisions
+        self.svn.run(['log', '--xml', '-q', '-v', '--stop-on-copy', '-r',
+                      '%d:%d' % (self._youngest + 1, last_changed), self.url])
+        if self.svn.return_code:
+            raise Error('Cannot get log for %s: %s' % (self.url, ''.join(self.svn.stderr)))
+        log = xml.etree.ElementTree.fromstring(''.join(self.svn.stdout))
+        numbers = []
+        for entry in log.findall('logentry'):
+            revision = Revision(xml_element=entry, svn=self.svn, branch=self.url)
+            if [x for x in revision.paths if x.path == self.repo_path and x.action == 'A']:
+                continue    # the copy creating the branch.
+            numbers.append(revision.number)
+        self._revisions = self._revisions.union(RevisionRanges.from_revisions(numbers))
+        self._youngest = last_changed
+        self.save()
+        return self._revisions
+
+
 class StatusEntry(object):
     """Wrapper class for svn status entries."""
 
@@ -604,7 +1522,7 @@ class StatusEntry(object):
 
         Returns:
             A string, values are 'added', 'conflicted', 'deleted', 'normal', 'missing',
-            'modified', 'unversionned'.
+            'modified', 'unversioned'.
         """
         return self.wc_status.attrib['item']
 
@@ -629,6 +1547,17 @@ class StatusEntry(object):
                 return conflict_file if os.path.exists(conflict_file) else None
             return None
 
+    @property
+    def copied(self):
+        return self.wc_status.attrib.get('copied') == 'true'
+
+    @property
+    def is_modified(self):
+        """Returns True if the entry has something to commit."""
+        if self.is_unversionned:
+            return False
+        return self.item != 'normal' or self.props not in ('none', 'normal')
+
     @property
     def tree_conflicted(self):
         return self.wc_status.attrib.get('tree-conflicted') == 'true'
@@ -641,11 +1570,11 @@ class StatusEntry(object):
     def has_non_props_changes(self):
         # TODO(stephane): this is a potential 'bug' we should specifically ignore svn:mergeinfo.
         # The downside is small enough to not fix it on the first revision.
-        return self.has_conflict or self.item not in ('normal', 'unversionnned')
+        return self.has_conflict or self.item not in ('normal', 'unversioned')
 
     @property
     def is_unversionned(self):
-        return self.item == 'unversionned'
+        return self.item == 'unversioned'
 
 
 class Status(object):
@@ -668,9 +1597,14 @@ class Status(object):
     @property
     def entries_by_path(self):
         if self._entries_by_path is None:
-            self._entries_by_path()
+            self._get_entries()
         return self._entries_by_path
 
+    @property
+    def targets(self):
+        """Returns the paths given to svn status."""
+        return [x.attrib['path'] for x in self._xml.findall('target')]
+
     def _get_entries(self):
         _entries_by_path = {}
         _entries = []
@@ -718,10 +1652,18 @@ class Status(object):
                 return True
         return False
 
+    def modified_bytes(self):
+        """Returns the size on disk of the modified files, an upper bound of what a commit sends."""
+        size = 0
+        for entry in self.entries:
+            if entry.is_modified and os.path.isfile(entry.path):
+                size += os.path.getsize(entry.path)
+        return size
+
     @property
     def unversionned(self):
         if self._unversionned is None:
-            self._unversionned = [entry for entry in self.entries if not entry.is_unversionned]
+            self._unversionned = [entry for entry in self.entries if entry.is_unversionned]
         return self._unversionned
 
 
@@ -754,6 +1696,18 @@ class InfoEntry(object):
     def kind(self):
         return self._xml.attrib['kind']
 
+    @property
+    def revision(self):
+        return self._xml.attrib.get('revision')
+
+    @property
+    def commit_revision(self):
+        """Returns the last changed revision as a string, None if unknown."""
+        _commit = self.commit
+        if _commit is None:
+            return None
+        return _commit.attrib.get('revision')
+
     @property
     def is_file(self):
         return self.kind == 'file'
@@ -770,6 +1724,10 @@ class InfoEntry(object):
     def repo_root(self):
         return self._xml.find('repository/root').text
 
+    @property
+    def repo_uuid(self):
+        return self._xml.findtext('repository/uuid')
+
     @property
     def repo_path(self):
         url = self.url
@@ -817,16 +1775,234 @@ class Info(object):
         self._entries_by_path = _entries_by_path
 
 
+class Redactor(object):
+    """Rewrite the svn commands and outputs stored in a recording.
+
+    Args:
+        substitutions: A list of (real, placeholder) string tuples, e.g. the working copy path
+            or the repository host. The current directory is always replaced with %%CWD%%.
+        redact: A callable taking and returning a string, an extra hook applied after the
+            substitutions when recording. Optional.
+    """
+    CWD = '%%CWD%%'
+
+    def __init__(self, substitutions=(), redact=None):
+        self.substitutions = list(substitutions) + [(os.getcwd(), self.CWD)]
+        self.redact = redact
+
+    def hide(self, text):
+        for real, placeholder in self.substitutions:
+            text = text.replace(real, placeholder)
+        if self.redact is not None:
+            text = self.redact(text)
+        return text
+
+    def reveal(self, text):
+        for real, placeholder in self.substitutions:
+            text = text.replace(placeholder, real)
+        return text
+
+    def hide_options(self, options):
+        hidden = [self.hide(x) for x in options]
+        for index, option in enumerate(options[:-1]):
+            if option == '--password':
+                hidden[index + 1] = '%%PASSWORD%%'
+            elif option == '--targets':
+                hidden[index + 1] = self.hide_targets(options[index + 1])
+        return hidden
+
+    def hide_targets(self, filename):
+        """Returns a placeholder for a --targets file, its name is random but not its content."""
+        try:
+            with open(filename, 'r') as targets_file:
+                content = self.hide(targets_file.read())
+        except IOError:
+            return '%%TARGETS%%'
+        return '%%%%TARGETS-%s%%%%' % hashlib.md5(content).hexdigest()
+
+
+def open_archive(filename, mode):
+    """Open a recording archive, gzip compressed if its name ends with .gz."""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+
+class _TeeFile(object):
+    """File like wrapper of a process output, keeping a copy of what the caller reads."""
+
+    def __init__(self, fileobj):
+        self._file = fileobj
+        self.chunks = []
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self.chunks.append(data)
+        return data
+
+    def readline(self, size=-1):
+        line = self._file.readline(size)
+        self.chunks.append(line)
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self._file.close()
+
+    @property
+    def lines(self):
+        return ''.join(self.chunks).splitlines(True)
+
+
+class _RecordingProcess(object):
+    """subprocess.Popen wrapper recording the streamed outputs once the process is waited."""
+
+    def __init__(self, process, on_exit):
+        self._process = process
+        self._on_exit = on_exit
+        self.stdout = _TeeFile(process.stdout)
+        self.stderr = _TeeFile(process.stderr)
+
+    def wait(self):
+        return_code = self._process.wait()
+        if self._on_exit is not None:
+            self._on_exit({
+                'return_code': return_code, 'stdout': self.stdout.lines,
+                'stderr': self.stderr.lines})
+            self._on_exit = None
+        return return_code
+
+    def __getattr__(self, name):
+        return getattr(self._process, name)
+
+
+class ReplayProcess(object):
+    """subprocess.Popen look alike serving an output known in advance, e.g. a recorded one."""
+
+    def __init__(self, result):
+        self.stdout = StringIO.StringIO(''.join(result['stdout']))
+        self.stderr = StringIO.StringIO(''.join(result['stderr']))
+        self.returncode = result['return_code']
+
+    def wait(self):
+        return self.returncode
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):
+        pass
+
+    kill = terminate
+
+
+class SvnRecorder(object):
+    """Record the svn commands of a run, with their outputs and return codes, to an archive.
+
+    The archive is a JSON line per command, written as the command completes, so a crashed run
+    still leaves a usable recording. Outputs are stored as latin-1 to keep binary data intact.
+
+    Args:
+        filename: A string, the archive to write, gzip compressed if it ends with .gz.
+        redactor: A Redactor() instance, rewriting the commands and outputs before storage.
+    """
+
+    def __init__(self, filename, redactor=None):
+        self.filename = filename
+        self.redactor = redactor or Redactor()
+        self._file = None
+        self._opened = False
+        self._lock = threading.Lock()
+
+    def record(self, command, result):
+        hide = self.redactor.hide
+        record = {
+            'command': [x.decode('latin-1') for x in self.redactor.hide_options(command)],
+            'return_code': result['return_code'],
+            'stdout': [hide(x).decode('latin-1') for x in result['stdout']],
+            'stderr': [hide(x).decode('latin-1') for x in result['stderr']]}
+        with self._lock:
+            if self._file is None:
+                # Appended after a close, e.g. between the passes of the daemon mode.
+                self._file = open_archive(self.filename, 'ab' if self._opened else 'wb')
+                self._opened = True
+            self._file.write(json.dumps(record, sort_keys=True) + '\n')
+            self._file.flush()
+
+    def wrap(self, command, command_result, handle_process):
+        """Record a command result, returns it or the process wrapper to hand to the caller."""
+        if handle_process:
+            self.record(command, command_result)
+            return command_result
+        return _RecordingProcess(command_result, lambda result: self.record(command, result))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class SvnReplay(object):
+    """Serve the outputs of a SvnRecorder() archive instead of running svn.
+
+    Each command gets the recorded answers to the same command in their recording order, the
+    last one being repeated once they are exhausted.
+
+    Args:
+        filename: A string, the archive to replay.
+        redactor: A Redactor() instance with the substitutions used for the recording.
+    """
+
+    def __init__(self, filename, redactor=None):
+        self.redactor = redactor or Redactor()
+        self.responses = {}
+        self._lock = threading.Lock()
+        with contextlib.closing(open_archive(filename, 'rb')) as archive:
+            for line in archive:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                key = tuple([x.encode('latin-1') for x in record['command']])
+                self.responses.setdefault(key, []).append({
+                    'return_code': record['return_code'],
+                    'stdout': [x.encode('latin-1') for x in record['stdout']],
+                    'stderr': [x.encode('latin-1') for x in record['stderr']]})
+
+    def run(self, command, handle_process=True):
+        key = tuple(self.redactor.hide_options(command))
+        with self._lock:
+            responses = self.responses.get(key)
+            if not responses:
+                raise Error('No recorded output for: %s' % ' '.join(key))
+            response = responses.pop(0) if len(responses) > 1 else responses[0]
+        reveal = self.redactor.reveal
+        result = {
+            'return_code': response['return_code'],
+            'stdout': [reveal(x) for x in response['stdout']],
+            'stderr': [reveal(x) for x in response['stderr']]}
+        return result if handle_process else ReplayProcess(result)
+
+
 class SvnWrapper(object):
-    """Class to manage svn calls."""
+    """Class to manage svn calls.
+
+    Commands are recorded to a SvnRecorder() if set. If a backend is set, e.g. a SvnReplay() or
+    a simulated repository from idlemerge_sim, it answers the commands instead of svn.
+    """
 
-    def __init__(self, auth=None, no_commit=False, verbose=False, stdout=None):
+    def __init__(self, auth=None, no_commit=False, verbose=False, stdout=None, tracer=None):
         if stdout is None:
             stdout = sys.stdout
         self._stdout = stdout
         self.no_commit = no_commit
         self.verbose = verbose
         self.auth = auth
+        self.tracer = tracer
+        self.recorder = None
+        self.backend = None
 
         self._last_status = None
 
@@ -842,23 +2018,55 @@ class SvnWrapper(object):
     def stderr(self):
         return self._last_status['stderr'] if self._last_status else None
 
-    def run(self, options, discard_output=False, handle_process=True, bufsize=None):
-        svn_cmd = ['svn', '--non-interactive']
-        password = None
-        if self.auth:
-            svn_cmd += ['--username', self.auth.username]
-            if self.auth.password:
-                password = self.auth.password
-                svn_cmd += ['--password', '%%PASSWORD%%']
-        svn_cmd += options
-        self._last_status = None
-        command_result = execute_command(
-            svn_cmd, discard_output=discard_output, verbose=self.verbose, stdout=self._stdout,
-            password=password, handle_process=handle_process, bufsize=bufsize
-        )
+    def run(self, options, discard_output=False, handle_process=True, bufsize=None,
+            program='svn'):
+        """Run a svn command.
+
+        Args:
+            options: A list of strings, the svn subcommand and its arguments.
+            discard_output, handle_process, bufsize: See execute_command().
+            program: A string, the svn tool to run, e.g. svnversion. Default is svn.
+
+        Returns:
+            The return code if handle_process is True, the process otherwise.
+        """
+        svn_cmd = [program]
+        password = None
+        if program == 'svn':
+            svn_cmd.append('--non-interactive')
+            if self.auth:
+                svn_cmd += ['--username', self.auth.username]
+                if self.auth.password:
+                    password = self.auth.password
+                    svn_cmd += ['--password', '%%PASSWORD%%']
+        svn_cmd += options
+        self._last_status = None
+        start = time.time()
+        if self.backend is not None:
+            if self.verbose:
+                print >> self._stdout, '[DEBUG] backend command %r.' % ' '.join(svn_cmd)
+            command_result = self.backend.run([program] + options, handle_process)
+        else:
+            command_result = execute_command(
+                svn_cmd, discard_output=discard_output, verbose=self.verbose,
+                stdout=self._stdout, password=password, handle_process=handle_process,
+                bufsize=bufsize
+            )
+            if self.recorder is not None:
+                command_result = self.recorder.wrap(
+                    [program] + options, command_result, handle_process)
+        traced_options = options if program == 'svn' else [program] + options
         if handle_process:
             self._last_status = command_result
+            if self.tracer:
+                output_bytes = sum([len(x) for x in command_result['stdout']]) + sum(
+                    [len(x) for x in command_result['stderr']])
+                self.tracer.record_command(
+                    traced_options, time.time() - start, output_bytes, self.return_code)
             return self.return_code
+        if self.tracer:
+            # Streamed output, only the time to start the process is known.
+            self.tracer.record_command(traced_options, time.time() - start, 0, None)
         # We got the command process back
         return command_result
 
@@ -884,16 +2092,226 @@ def add_email_domain(email, domain):
     return email + at_domain
 
 
+class NotificationLog(object):
+    """Persistent record of the conflict emails already sent.
+
+    Entries are keyed by pair and revision and hold a digest of the conflict, so that a conflict
+    left pending by cron passes is only emailed again when it changes or once the reminder interval
+    is over. An entry is recorded once the email is delivered, by the MailOutbox() worker thread.
+    The entries of a pair are dropped once it merges again without conflict.
+
+    Args:
+        filename: A string, the JSON state file, None to email every conflict.
+        reminder: A number of seconds after which a pending conflict is emailed again, 0 to never
+            remind.
+    """
+
+    def __init__(self, filename=None, reminder=0):
+        self.filename = filename
+        self.reminder = reminder
+        self._entries = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(conflict):
+        return '%s>%s@%s' % (conflict.source, conflict.target, conflict.revision.number)
+
+    @staticmethod
+    def digest(conflict):
+        """Return a digest of the conflicted revision and files, not of the pending revisions."""
+        return hashlib.md5('\n'.join([conflict.subject] + conflict.status)).hexdigest()
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = {}
+            if self.filename and os.path.exists(self.filename):
+                with open(self.filename, 'r') as state_file:
+                    self._entries = json.load(state_file)
+        return self._entries
+
+    def save(self):
+        if not self.filename:
+            return
+        with open(self.filename + '.tmp', 'w') as state_file:
+            json.dump(self.entries, state_file, indent=1, sort_keys=True)
+        os.rename(self.filename + '.tmp', self.filename)
+
+    def due(self, key, digest, now=None):
+        """Return why the email of a conflict is due: new, changed or reminder, None if not."""
+        entry = self.entries.get(key) if self.filename else None
+        if entry is None:
+            return 'new'
+        if entry['digest'] != digest:
+            return 'changed'
+        now = time.time() if now is None else now
+        if self.reminder and now - entry['sent'] >= self.reminder:
+            return 'reminder'
+        return None
+
+    def sent(self, key, digest, now=None):
+        if not self.filename:
+            return
+        with self._lock:
+            self.entries[key] = {'digest': digest, 'sent': time.time() if now is None else now}
+            self.save()
+
+    def clear(self, source, target, keep=None):
+        """Drop the entries of a pair, but keep, and save the state if any was dropped."""
+        if not self.filename:
+            return
+        pair = '%s>%s' % (source, target)
+        with self._lock:
+            stale = []
+            for key in self.entries:
+                key_pair = key.rsplit('@', 1)[0]
+                if key != keep and (key_pair == pair or key_pair.startswith(pair + '/')):
+                    stale.append(key)
+            for key in stale:
+                del self.entries[key]
+            if stale:
+                self.save()
+
+
+class MailOutbox(object):
+    """Background delivery of the emails of a pass over a single SMTP connection.
+
+    Messages are queued in memory, or written to the spool directory, and a worker thread delivers
+    them while the pass goes on. The worker opens one connection for all the queued messages and
+    exits once the queue is empty, the next message starts a new one. It is not a daemon thread,
+    the interpreter waits for the delivery before exiting.
+
+    A spooled message is removed once delivered, the messages left by an unreachable relay or by a
+    killed run are delivered along with the next message queued. A message queued in memory is
+    put back in front of the queue when the relay fails.
+
+    Args:
+        host: A string, the SMTP relay.
+        spool_dir: A string, the directory of the messages to deliver, None to queue in memory.
+        on_delivered: A callable, called by the worker thread with the tag of each delivered
+            message. Optional.
+    """
+
+    def __init__(self, host='localhost', spool_dir=None, on_delivered=None):
+        self.host = host
+        self.spool_dir = spool_dir
+        self.on_delivered = on_delivered
+        self.delivered = 0
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def put(self, sender, recipients, message, tag=None):
+        """Queue a message, tag is any JSON serializable value passed back to on_delivered."""
+        envelope = {'from': sender, 'to': sorted(recipients), 'message': message, 'tag': tag}
+        if self.spool_dir:
+            if not os.path.isdir(self.spool_dir):
+                os.makedirs(self.spool_dir)
+            handle, filename = tempfile.mkstemp(
+                prefix='%.6f-' % time.time(), suffix='.tmp', dir=self.spool_dir)
+            with os.fdopen(handle, 'w') as spool_file:
+                json.dump(envelope, spool_file)
+            os.rename(filename, filename[:-len('.tmp')] + '.mail')
+        else:
+            self._queue.append(envelope)
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='idlemerge-mail')
+                self._thread.start()
+
+    def spooled(self):
+        """Return the spooled message files, oldest first."""
+        if not self.spool_dir or not os.path.isdir(self.spool_dir):
+            return []
+        return [os.path.join(self.spool_dir, x)
+                for x in sorted(os.listdir(self.spool_dir)) if x.endswith('.mail')]
+
+    def pending(self, tag):
+        """Return True if a message with tag is queued or spooled and not delivered yet."""
+        with self._lock:
+            if [x for x in self._queue if x.get('tag') == tag]:
+                return True
+        for filename in self.spooled():
+            try:
+                with open(filename, 'r') as spool_file:
+                    if json.load(spool_file).get('tag') == tag:
+                        return True
+            except (IOError, ValueError):
+                continue    # delivered and removed meanwhile.
+        return False
+
+    def _next(self):
+        """Return the next envelope and its spool file, or end the worker if there is none."""
+        with self._lock:
+            if self._queue:
+                return self._queue.popleft(), None
+            for filename in self.spooled():
+                with open(filename, 'r') as spool_file:
+                    return json.load(spool_file), filename
+            self._thread = None
+            return None, None
+
+    def _run(self):
+        smtp = None
+        try:
+            while True:
+                envelope, filename = self._next()
+                if envelope is None:
+                    return
+                try:
+                    if smtp is None:
+                        smtp = smtplib.SMTP(self.host)
+                    smtp.sendmail(envelope['from'], envelope['to'], envelope['message'])
+                except (smtplib.SMTPException, socket.error) as error:
+                    print 'Error: unable to send email: %s' % error
+                    with self._lock:
+                        if filename is None:
+                            self._queue.appendleft(envelope)
+                        self._thread = None
+                    return
+                self.delivered += 1
+                if filename:
+                    os.remove(filename)
+                if self.on_delivered is not None:
+                    self.on_delivered(envelope.get('tag'))
+                print 'Successfully sent email from %s to %s' % (
+                    envelope['from'], ', '.join(envelope['to']))
+        finally:
+            if smtp is not None:
+                try:
+                    smtp.quit()
+                except (smtplib.SMTPException, socket.error):
+                    pass
+
+    def wait(self):
+        """Block until the queued messages are delivered or the relay fails."""
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+
 class MergeEmail(object):
-    """Small email management class."""
+    """Small email management class.
+
+    Conflicts already emailed are skipped as long as the notifications log does not find them due,
+    the emails are delivered in the background by the outbox. A conflict is recorded in the log
+    once its email is delivered, and is not queued again meanwhile, nor by the next runs while its
+    message waits in the spool of the outbox.
+    """
 
-    def __init__(self, send, domain, default_recipients, sender, append_filename):
+    def __init__(self, send, domain, default_recipients, sender, append_filename,
+            notifications=None, outbox=None):
         self.send = send.strip() if send else ''
         self.domain = domain.strip() if domain else ''
         self._default_recipients = default_recipients
         self._sender = sender.strip() if sender else ''
         self._append_filename = append_filename
         self._append_text = None
+        self.notifications = notifications if notifications is not None else NotificationLog()
+        self.outbox = outbox if outbox is not None else MailOutbox()
+        self.outbox.on_delivered = self.delivered
+        self.queued = {}
 
     @property
     def default_recipients(self):
@@ -935,14 +2353,26 @@ class MergeEmail(object):
         return set([add_email_domain(x, self.domain) for x in filtered_recipients])
 
     def email_conflict(self, conflict):
-        """Send an email about the merge conflict.
+        """Queue an email about the merge conflict, unless it was already sent.
 
         Args:
             conflict: A Conflict() exception.
         """
         if not self.send or self.send == 'no':
             return
+        key = self.notifications.key(conflict)
+        digest = self.notifications.digest(conflict)
+        tag = {'key': key, 'digest': digest}
+        reason = self.notifications.due(key, digest)
+        if reason is None:
+            print 'Conflict of revision %s already emailed' % conflict.revision
+            return
+        if self.queued.get(key) == digest or self.outbox.pending(tag):
+            print 'Conflict of revision %s already queued' % conflict.revision
+            return
         subject = conflict.subject
+        if reason == 'reminder':
+            subject = 'REMINDER: ' + subject
         body = '%s\n\n%s' % (str(conflict), self.get_append_text())
         sender = self.sender
         recipients = self.recipients_for_conflict(conflict)
@@ -959,15 +2389,549 @@ class MergeEmail(object):
             }
         )
 
+        self.queued[key] = digest
+        self.notifications.clear(conflict.source, conflict.target, keep=key)
+        self.outbox.put(sender, recipients, message, tag)
+
+    def delivered(self, tag):
+        """Record the delivery of a conflict email, called by the outbox worker thread."""
+        if not tag:
+            return
+        if self.queued.get(tag['key']) == tag['digest']:
+            del self.queued[tag['key']]
+        self.notifications.sent(tag['key'], tag['digest'])
+
+    def conflict_cleared(self, source, target):
+        """Forget the conflicts emailed for a pair once it merged everything."""
+        self.notifications.clear(source, target)
+
+
+class DirtyPathsJournal(object):
+    """Small journal of the working copy paths dirtied by merges.
+
+    Each merge appends a 'BEGIN <revision>' line before touching the working copy, then the paths
+    reported by svn status and an 'END <revision>' line once they are known. The merge roots, whose
+    svn:mergeinfo every merge changes, are recorded apart on 'ROOT <path>' lines, they are reset
+    without their children. The journal can be trusted to reset the working copy only if every
+    BEGIN has its END, otherwise a crash happened in between and some dirty paths might be missing.
+
+    Args:
+        filename: A string, the path to the journal file. None disables the journal.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @property
+    def enabled(self):
+        return bool(self.filename)
+
+    def _append(self, lines):
+        if not self.enabled:
+            return
+        with open(self.filename, 'a') as journal_file:
+            for line in lines:
+                print >> journal_file, line
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+    def begin(self, revisions):
+        self._append(['BEGIN ' + revisions_as_string(revisions, ',')])
+
+    def end(self, revisions, paths, roots=()):
+        self._append(['ROOT ' + x for x in sorted(set(roots))] + sorted(set(paths)) + [
+            'END ' + revisions_as_string(revisions, ',')])
+
+    def read(self):
+        """Read the journal.
+
+        Returns:
+            A tuple (trusted, paths, roots), trusted is a boolean, paths and roots are sets of
+            strings. trusted is False if the journal does not exist or if a merge was interrupted.
+        """
+        if not self.enabled or not os.path.exists(self.filename):
+            return False, set(), set()
+        pending = set()
+        paths = set()
+        roots = set()
+        with open(self.filename, 'r') as journal_file:
+            for line in journal_file:
+                line = line.rstrip('\n')
+                if line.startswith('BEGIN '):
+                    pending.add(line[len('BEGIN '):])
+                elif line.startswith('END '):
+                    pending.discard(line[len('END '):])
+                elif line.startswith('ROOT '):
+                    roots.add(line[len('ROOT '):])
+                elif line:
+                    paths.add(line)
+        return not pending, paths - roots, roots
+
+    def clear(self):
+        """Truncate the journal, the working copy is known to be pristine."""
+        if not self.enabled:
+            return
+        open(self.filename, 'w').close()
+
+
+class RunJournal(object):
+    """Append-only journal of the steps of the merge passes, to resume after a crash.
+
+    Each step is a JSON line synced to disk before the step runs: pass, merge, resolved,
+    reverted, commit, committed, conflict and done. A pass killed between a commit step and its
+    committed result left a complete merge in the working copy: the next run commits it, unless
+    svn log shows it landed, instead of resetting and merging it again. Any other interruption
+    is cleaned up by the reset engine as before.
+
+    Args:
+        filename: A string, the path to the journal file. None disables the journal.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @property
+    def enabled(self):
+        return bool(self.filename)
+
+    def record(self, step, revisions=(), **fields):
+        if not self.enabled:
+            return
+        fields.update({
+            'step': step, 'revisions': sorted([int(x) for x in revisions]), 'time': time.time()})
+        with open(self.filename, 'a') as journal_file:
+            journal_file.write(json.dumps(fields, sort_keys=True) + '\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+    def read(self):
+        """Returns the records of the last pass, a torn last line is ignored."""
+        if not self.enabled or not os.path.exists(self.filename):
+            return []
+        records = []
+        with open(self.filename, 'r') as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if record['step'] == 'pass':
+                    records = []
+                records.append(record)
+        return records
+
+    def interrupted(self):
+        """Returns the last record of the previous pass if it was interrupted, None otherwise."""
+        records = self.read()
+        if not records or records[-1]['step'] == 'done':
+            return None
+        return records[-1]
+
+    def start(self, **fields):
+        """Start a new pass, the previous one has been recovered."""
+        if not self.enabled:
+            return
+        open(self.filename, 'w').close()
+        self.record('pass', **fields)
+
+
+UPDATE_LINE_RE = re.compile(r'^[ADUCGER ][ADUCGER ][ B][ C] (\S.*)$')
+COMMIT_LINE_RE = re.compile(r'^(?:Sending|Adding|Deleting|Replacing)\s+(?:\(bin\)\s+)?(\S.*)$')
+COMMITTED_RE = re.compile(r'^Committed revision (\d+)\.')
+
+
+def committed_revision(lines):
+    """Returns the revision number created according to the output of 'svn commit', or None."""
+    for line in lines or []:
+        match = COMMITTED_RE.match(line)
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def updated_paths(lines):
+    """Returns the list of paths reported as changed by the output of 'svn update'."""
+    paths = []
+    for line in lines:
+        match = UPDATE_LINE_RE.match(line.rstrip('\r\n'))
+        if match:
+            paths.append(match.group(1))
+    return paths
+
+
+def committed_paths(lines):
+    """Returns the list of paths reported as sent by the output of 'svn commit'."""
+    paths = []
+    for line in lines:
+        match = COMMIT_LINE_RE.match(line.rstrip('\r\n'))
+        if match:
+            paths.append(match.group(1))
+    return paths
+
+
+class WorkingCopySnapshot(object):
+    """Clean clone of the target working copy, to restore it in O(changed files).
+
+    The snapshot is cloned with reflinks when the filesystem supports them, and as a hardlink tree
+    otherwise. svn installs working and pristine files by renaming a temporary file so the inodes
+    shared with the snapshot are never modified in place, but sqlite does write .svn/wc.db in place,
+    so that one is always a real copy. Requires a svn 1.7+ working copy at the root of the target.
+
+    Args:
+        target: A string, the path to the working copy.
+        snapshot_dir: A string, where to keep the snapshot, on the same filesystem as target.
+            None disables the snapshot.
+    """
+    MARKER = 'idlemerge-snapshot'
+
+    def __init__(self, target, snapshot_dir):
+        self.target = target
+        self.snapshot_dir = snapshot_dir
+        self._mode = None
+
+    @property
+    def enabled(self):
+        return bool(self.snapshot_dir)
+
+    @property
+    def marker(self):
+        return os.path.join(self.snapshot_dir, '.svn', self.MARKER)
+
+    @property
+    def exists(self):
+        """Returns True if a complete snapshot is available."""
+        return self.enabled and os.path.exists(self.marker)
+
+    @property
+    def mode(self):
+        """Returns 'reflink' if the filesystem supports them, 'hardlink' otherwise."""
+        if self._mode is None:
+            self._mode = 'reflink' if self._supports_reflink() else 'hardlink'
+        return self._mode
+
+    def _supports_reflink(self):
+        parent = os.path.dirname(os.path.abspath(self.snapshot_dir))
+        probe = os.path.join(parent, '.idlemerge-reflink-probe')
+        try:
+            with open(probe, 'w') as probe_file:
+                probe_file.write('probe')
+            result = execute_command(['cp', '--reflink=always', probe, probe + '.clone'])
+            return result['return_code'] == 0
+        finally:
+            for path in (probe, probe + '.clone'):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def clone(self, source, destination):
+        """Clone a file or a directory tree, destination must not exist."""
+        parent = os.path.dirname(destination)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+        if self.mode == 'reflink':
+            command = ['cp', '-a', '--reflink=always', source, destination]
+        else:
+            command = ['cp', '-al', source, destination]
+        if execute_command(command)['return_code']:
+            raise Error('Failed to clone %s to %s' % (source, destination))
+
+    @staticmethod
+    def remove(path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+    @staticmethod
+    def _copy_wc_db(source_root, destination_root):
+        source = os.path.join(source_root, '.svn', 'wc.db')
+        if not os.path.exists(source):
+            raise Error('No %s, snapshots require a svn 1.7+ working copy root.' % source)
+        destination = os.path.join(destination_root, '.svn', 'wc.db')
+        shutil.copy2(source, destination + '.idlemerge')
+        # The rename breaks any hardlink, sqlite will not write into the other tree.
+        os.rename(destination + '.idlemerge', destination)
+
+    def _sync_pristines(self, source_root, destination_root, relpaths):
+        """Make sure the pristine files of relpaths from source_root exist in destination_root."""
+        relpaths = [x for x in relpaths if x]
+        if not relpaths:
+            return
+        connection = sqlite3.connect(os.path.join(source_root, '.svn', 'wc.db'))
         try:
-            smtp = smtplib.SMTP('localhost')
-            smtp.sendmail(sender, recipients, message)
-            print 'Successfully sent email from %s to %s' % (sender, ', '.join(recipients))
-        except smtplib.SMTPException:
-            print 'Error: unable to send email'
+            checksums = set()
+            for relpath in relpaths:
+                rows = connection.execute(
+                    'SELECT checksum FROM nodes WHERE checksum IS NOT NULL'
+                    ' AND (local_relpath = ? OR local_relpath LIKE ?)',
+                    (relpath, relpath + '/%'))
+                checksums.update(row[0] for row in rows)
+        finally:
+            connection.close()
+        for checksum in checksums:
+            digest = checksum.split('$')[-1]
+            pristine = os.path.join('.svn', 'pristine', digest[:2], digest + '.svn-base')
+            if os.path.exists(os.path.join(source_root, pristine)):
+                if not os.path.exists(os.path.join(destination_root, pristine)):
+                    self.clone(os.path.join(source_root, pristine),
+                               os.path.join(destination_root, pristine))
+
+    def _relpaths(self, paths):
+        relpaths = set()
+        for path in paths:
+            relpath = os.path.relpath(path, self.target)
+            if relpath == os.curdir or relpath.startswith(os.pardir):
+                continue
+            relpaths.add(relpath)
+        return sorted(relpaths)
+
+    def _copy_entries(self, source_root, destination_root, relpaths):
+        for relpath in relpaths:
+            source = os.path.join(source_root, relpath)
+            destination = os.path.join(destination_root, relpath)
+            if (os.path.isdir(source) and not os.path.islink(source) and
+                os.path.isdir(destination) and not os.path.islink(destination)):
+                continue    # directory on both sides, changed children are listed on their own.
+            self.remove(destination)
+            if os.path.lexists(source):
+                self.clone(source, destination)
+
+    def create(self):
+        """Snapshot the target, it must be pristine."""
+        print 'Snapshot: cloning %s to %s (%s)' % (self.target, self.snapshot_dir, self.mode)
+        self.remove(self.snapshot_dir)
+        self.clone(self.target, self.snapshot_dir)
+        self._copy_wc_db(self.target, self.snapshot_dir)
+        open(self.marker, 'w').close()
+
+    def restore(self, paths):
+        """Restore paths and the working copy database from the snapshot."""
+        relpaths = self._relpaths(paths)
+        self._sync_pristines(self.snapshot_dir, self.target, [''] + relpaths)
+        self._copy_wc_db(self.snapshot_dir, self.target)
+        self._copy_entries(self.snapshot_dir, self.target, relpaths)
+
+    def refresh(self, paths):
+        """Copy paths and the working copy database from the target into the snapshot."""
+        if not self.exists:
+            return
+        relpaths = self._relpaths(paths)
+        # An interrupted refresh leaves no marker, the snapshot is then created again.
+        os.remove(self.marker)
+        self._sync_pristines(self.target, self.snapshot_dir, [''] + relpaths)
+        self._copy_entries(self.target, self.snapshot_dir, relpaths)
+        self._copy_wc_db(self.target, self.snapshot_dir)
+        open(self.marker, 'w').close()
+
+
+class WorkspaceReset(object):
+    """Reset engine to get a pristine working copy for the target branch.
+
+    Strategies, from the cheapest to the most expensive:
+        snapshot: restore the paths the DirtyPathsJournal() recorded from a WorkingCopySnapshot().
+        journal: revert and clean only the paths the DirtyPathsJournal() recorded.
+        cleanup: 'svn revert -R' then 'svn cleanup --remove-unversioned --remove-ignored', this
+            requires a svn 1.9 or newer client.
+        full: 'svn revert -R' then a status crawl and removal of the unversioned entries.
+    The 'auto' strategy picks the first one available. In all cases the update is skipped when the
+    working copy is already at the last changed revision of the target branch.
 
+    Args:
+        idlemerge: An IdleMerge() instance.
+        strategy: A string, one of 'auto', 'snapshot', 'journal', 'cleanup' or 'full'.
+        journal: A DirtyPathsJournal() instance.
+        snapshot: A WorkingCopySnapshot() instance, it is created after the first reset and kept
+            up to date after each update and commit.
+    """
+    STRATEGIES = ('auto', 'snapshot', 'journal', 'cleanup', 'full')
+
+    def __init__(self, idlemerge, strategy='auto', journal=None, snapshot=None):
+        if strategy not in self.STRATEGIES:
+            raise Error('Unknown reset strategy %r, use one of %s' % (
+                strategy, ', '.join(self.STRATEGIES)))
+        self.idlemerge = idlemerge
+        self.strategy = strategy
+        self.journal = journal if journal is not None else DirtyPathsJournal(None)
+        self.snapshot = snapshot if snapshot is not None else WorkingCopySnapshot(None, None)
+        self.timings = []
+        self._svn_version = None
 
-def idle_merge_metacomment(revisions=None, mergeinfo_revisions=None):
+    @property
+    def svn_version(self):
+        """Returns the svn client version as a tuple of integers, () if unknown."""
+        if self._svn_version is None:
+            self.idlemerge.execute_svn_command(['--version', '--quiet'])
+            output = ''.join(self.idlemerge.svn.stdout or []).strip()
+            match = re.match(r'(\d+)\.(\d+)', output)
+            self._svn_version = tuple(int(x) for x in match.groups()) if match else ()
+        return self._svn_version
+
+    @property
+    def supports_cleanup(self):
+        return self.svn_version >= (1, 9)
+
+    def _timed(self, label, function, *args):
+        start = time.time()
+        with self.idlemerge.tracer.phase(label):
+            result = function(*args)
+        elapsed = time.time() - start
+        self.timings.append((label, elapsed))
+        print 'Reset: %s took %.2fs' % (label, elapsed)
+        return result
+
+    def reset(self):
+        """Revert all pending changes and delete unknown files to get a pristine working copy."""
+        self.timings = []
+        strategy = self.strategy
+        trusted, paths, roots = self.journal.read()
+        if strategy == 'auto':
+            if trusted and self.snapshot.exists:
+                strategy = 'snapshot'
+            elif trusted:
+                strategy = 'journal'
+            elif self.supports_cleanup:
+                strategy = 'cleanup'
+            else:
+                strategy = 'full'
+        if strategy == 'snapshot':
+            if not trusted or not self.snapshot.exists:
+                print 'Reset: no snapshot or untrusted dirty paths journal, using a full reset'
+                strategy = 'full'
+            else:
+                self._timed('snapshot', self.snapshot.restore, paths.union(roots))
+        if strategy == 'journal':
+            if not trusted:
+                print 'Reset: dirty paths journal cannot be trusted, using a full reset'
+                strategy = 'full'
+            else:
+                self._timed('journal', self.reset_paths, paths, roots)
+        if strategy == 'cleanup':
+            self._timed('cleanup', self.reset_cleanup)
+        elif strategy == 'full':
+            self._timed('full', self.reset_full)
+        self._timed('update', self.update)
+        if self.snapshot.enabled and not self.snapshot.exists:
+            self._timed('snapshot creation', self.snapshot.create)
+        self.journal.clear()
+
+    def restore_snapshot(self):
+        """Restore the dirty paths from the snapshot if possible.
+
+        Returns:
+            A boolean, True if the working copy was restored.
+        """
+        trusted, paths, roots = self.journal.read()
+        if not trusted or not self.snapshot.exists:
+            return False
+        self._timed('snapshot', self.snapshot.restore, paths.union(roots))
+        self.journal.clear()
+        return True
+
+    def committed(self, commit_output):
+        """Refresh the snapshot with the paths of a successful commit."""
+        if self.snapshot.exists:
+            self._timed('snapshot refresh', self.snapshot.refresh, committed_paths(commit_output))
+
+    def reset_paths(self, paths, roots=()):
+        """Revert roots alone, paths recursively and delete the unversioned files below paths."""
+        idlemerge = self.idlemerge
+        if roots:
+            idlemerge.execute_svn_command(['revert', '--depth', 'empty'] + sorted(roots))
+        if not paths:
+            return
+        idlemerge.execute_svn_command(['revert', '-R'] + sorted(paths))
+        existing = [path for path in sorted(paths) if os.path.lexists(path)]
+        if not existing:
+            return
+        idlemerge.execute_svn_command(['status', '--ignore-externals', '--xml'] + existing)
+        status = Status(xml.etree.ElementTree.fromstring(''.join(idlemerge.svn.stdout)))
+        self.remove_unversioned(status)
+
+    def reset_cleanup(self):
+        self.idlemerge.revert_all()
+        self.idlemerge.execute_svn_command(
+            ['cleanup', '--remove-unversioned', '--remove-ignored', self.idlemerge.target])
+
+    def reset_full(self):
+        self.idlemerge.revert_all()
+        self.remove_unversioned(self.idlemerge.svn_status())
+
+    def remove_unversioned(self, status):
+        for entry in status.unversionned:
+            path = entry.path
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+
+    def is_up_to_date(self):
+        """Returns True if the working copy is at the last changed revision of the branch."""
+        idlemerge = self.idlemerge
+        return_code = idlemerge.svn.run([idlemerge.target], program='svnversion')
+        match = re.match(r'(\d+)M?S?P?$', ''.join(idlemerge.svn.stdout).strip())
+        if return_code or not match:
+            return False    # mixed revisions, switched or not a working copy.
+        remote = idlemerge.get_svn_info(idlemerge.info.entries_by_path[idlemerge.target].url)
+        if idlemerge.svn.return_code or not remote.entries:
+            return False
+        last_changed = remote.entries[0].commit_revision
+        return last_changed is not None and int(match.group(1)) >= int(last_changed)
+
+    def update(self):
+        if self.idlemerge.targeted_update:
+            # Only the root properties, the paths are updated once the queue is known.
+            paths = []
+        elif self.is_up_to_date():
+            print 'Reset: working copy is up to date, skipping svn update'
+            return
+        else:
+            paths = None
+        if self.idlemerge.svn_update(paths):
+            raise Error('Failed to reset workspace !')
+        if self.snapshot.exists:
+            self.snapshot.refresh(updated_paths(self.idlemerge.svn.stdout))
+
+
+class UpdatePlanner(object):
+    """Plan the svn update of only the target paths the queued revisions touch.
+
+    The resulting working copy has mixed revisions, so merges are then run with
+    --allow-mixed-revisions. Directories added, deleted or replaced and copies can bring paths we
+    do not know about, they require a full update.
+
+    Args:
+        idlemerge: An IdleMerge() instance.
+    """
+
+    def __init__(self, idlemerge):
+        self.idlemerge = idlemerge
+
+    def plan(self, revisions):
+        """Returns the set of target sub paths to update, None if a full update is required."""
+        paths = set()
+        for revision in revisions:
+            original_branch = revision.original_branch
+            for log_path in revision.paths:
+                structural = log_path.is_dir and log_path.action in ('A', 'D', 'R')
+                if structural or log_path.copyfrom_path:
+                    print 'Structural change on %s in r%s requires a full update' % (
+                        log_path.path, revision)
+                    return None
+                sub_path = self.idlemerge.get_source_sub_path(log_path.path, original_branch)
+                if sub_path == log_path.path:
+                    continue    # outside of the branch, or the branch root itself.
+                paths.add(sub_path)
+        return paths
+
+
+def idle_merge_metacomment(revisions=None, mergeinfo_revisions=None, urgent=None):
+    """Returns the IDLEMERGE DATA block of a merge commit message.
+
+    Args:
+        revisions: A list of Revision() instances, the merged revisions.
+        mergeinfo_revisions: A list of Revision() instances, the mergeinfo only revisions.
+        urgent: A tuple (reason, overtaken revisions) when the merged revision was moved ahead of
+            older pending revisions, see IdleMerge.prioritize().
+    """
     if revisions is None:
         revisions = set()
     if mergeinfo_revisions is None:
@@ -981,11 +2945,861 @@ def idle_merge_metacomment(revisions=None, mergeinfo_revisions=None):
         comment.append('REVISIONS=' + revisions_as_string(revisions, ','))
     if mergeinfo_revisions:
         comment.append('MERGEINFO_REVISIONS=' + revisions_as_string(mergeinfo_revisions, ','))
+    if urgent:
+        comment.append('URGENT=' + urgent[0])
+        comment.append('AHEAD_OF=' + revisions_as_string(urgent[1], ','))
     all_revisions = sorted(revisions.union(mergeinfo_revisions))
     comment += ['r%s | %s | %s' % (r.number, r.author, r.date) for r in all_revisions]
     return '\n  '.join(comment)
 
 
+IDLE_DATA_REVISION_RE = re.compile(r'^r(\d+) \| (.*?) \| (.*)$')
+AUTOMERGE_SOURCE_RE = re.compile(
+    r'^(?:\[automerge ([^\]@ ]+)(?:@\d+)?\]|merge revisions [\d, ]+ from (\S+) to \S+)')
+
+
+class IdleData(object):
+    """Parser for the IDLEMERGE DATA block of a merge commit, see idle_merge_metacomment().
+
+    Args:
+        text: A string, the block after the '-- IDLEMERGE DATA --' line.
+    """
+
+    def __init__(self, text):
+        self.values = {}
+        self.origins = []
+        for line in (text or '').splitlines():
+            line = line.strip()
+            match = IDLE_DATA_REVISION_RE.match(line)
+            if match:
+                self.origins.append((int(match.group(1)), match.group(2), match.group(3)))
+                continue
+            key, sep, value = line.partition('=')
+            if sep and key.isupper():
+                self.values[key] = value
+
+    def _numbers(self, key):
+        return [int(x) for x in self.values.get(key, '').split(',') if x.strip()]
+
+    @property
+    def revisions(self):
+        return self._numbers('REVISIONS')
+
+    @property
+    def mergeinfo_revisions(self):
+        return self._numbers('MERGEINFO_REVISIONS')
+
+    @property
+    def ahead_of(self):
+        """Returns the older revisions an urgent merge overtook."""
+        return self._numbers('AHEAD_OF')
+
+    def __nonzero__(self):
+        return bool(self.values or self.origins)
+
+
+def automerge_source(msg):
+    """Returns the source branch of an idlemerge commit message, None if not an automerge."""
+    match = AUTOMERGE_SOURCE_RE.match(msg or '')
+    if not match:
+        return None
+    return match.group(1) or match.group(2)
+
+
+def iter_log_entries(svn, url, start, end, options=None):
+    """Stream the <logentry> elements of svn log, without keeping the whole log in memory.
+
+    Args:
+        svn: An SvnWrapper instance.
+        url: A string, the branch to get the log of.
+        start: An integer, the first revision.
+        end: An integer or 'HEAD', the last revision.
+        options: A list of strings, additional options for svn log such as '-v'.
+
+    Yields:
+        xml.etree.ElementTree elements, they are cleared once the consumer gets the next one.
+    """
+    command = ['log', '--xml', '-r', '%s:%s' % (start, end)] + (options or []) + [url]
+    process = svn.run(command, handle_process=False, bufsize=-1)
+    root = None
+    try:
+        for event, element in xml.etree.ElementTree.iterparse(
+                process.stdout, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+                continue
+            if element.tag == 'logentry':
+                yield element
+                root.clear()
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read()
+        if process.wait():
+            raise Error('svn log of %s failed: %s' % (url, stderr))
+
+
+class MergeIndex(object):
+    """Persistent index of the merges done by idlemerge, built from the logs of target branches.
+
+    The IDLEMERGE DATA blocks of the target branches logs are scanned incrementally, each source
+    revision is indexed with the target branch, the target revision, its date and whether it was
+    a real merge or a mergeinfo only merge.
+
+    Args:
+        svn: An SvnWrapper instance.
+        targets: A list of strings, the urls of the target branches to index.
+        cache_dir: A string, the directory where to store the index. None keeps it in memory only.
+    """
+
+    def __init__(self, svn, targets, cache_dir=None):
+        self.svn = svn
+        self.targets = list(targets)
+        self.cache_dir = cache_dir
+        self._youngest = {}
+        self._entries = {}
+        self._loaded = False
+
+    @property
+    def filename(self):
+        if not self.cache_dir:
+            return None
+        return os.path.join(self.cache_dir, 'merge-index.json')
+
+    def load(self):
+        self._loaded = True
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'r') as index_file:
+            data = json.load(index_file)
+        self._youngest = data.get('youngest', {})
+        self._entries = data.get('entries', {})
+
+    def save(self):
+        if not self.filename:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        with open(self.filename + '.tmp', 'w') as index_file:
+            json.dump({'youngest': self._youngest, 'entries': self._entries}, index_file)
+        os.rename(self.filename + '.tmp', self.filename)
+
+    def add(self, target, logentry):
+        """Index a target branch <logentry>, returns True if it is an idlemerge commit."""
+        revision = Revision(xml_element=logentry, svn=self.svn, branch=target)
+        if not revision.idle_data:
+            return False
+        idle_data = IdleData(revision.idle_data)
+        source = automerge_source(revision.msg)
+        date = logentry.find('date').text
+        for kind, numbers in (('merge', idle_data.revisions),
+                              ('mergeinfo', idle_data.mergeinfo_revisions)):
+            for number in numbers:
+                self._entries.setdefault(str(number), []).append(
+                    [source, target, revision.number, date, kind])
+        return True
+
+    def update(self):
+        """Scan the target branches logs committed since the last update."""
+        if not self._loaded:
+            self.load()
+        for target in self.targets:
+            start = self._youngest.get(target, 0) + 1
+            self.svn.run(['info', '--xml', target])
+            if self.svn.return_code:
+                raise Error('Cannot get info for %s: %s' % (target, ''.join(self.svn.stderr)))
+            info = Info(xml.etree.ElementTree.fromstring(''.join(self.svn.stdout)))
+            last_changed = int(info.entries[0].commit_revision)
+            if last_changed < start:
+                continue
+            count = 0
+            for logentry in iter_log_entries(self.svn, target, start, last_changed):
+                if self.add(target, logentry):
+                    count += 1
+            print 'Indexed %d merges in %s r%d:%d' % (count, target, start, last_changed)
+            self._youngest[target] = last_changed
+        self.save()
+
+    def landings(self, number):
+        """Returns where a revision landed, a list of (source, target, revision, date, kind)."""
+        if not self._loaded:
+            self.load()
+        return [tuple(x) for x in self._entries.get(str(int(number)), [])]
+
+    def where(self, number, depth=0, seen=None):
+        """Returns the report lines following a revision through the chain of merges."""
+        if seen is None:
+            seen = set()
+        lines = []
+        for source, target, target_revision, date, kind in sorted(
+                self.landings(number), key=lambda x: x[2]):
+            if (target, target_revision) in seen:
+                continue
+            seen.add((target, target_revision))
+            lines.append('%sr%s -> %s r%s at %s (%s from %s)' % (
+                '  ' * depth, number, target, target_revision, date, kind, source))
+            lines.extend(self.where(target_revision, depth + 1, seen))
+        return lines
+
+
+SVN_DATE_RE = re.compile(
+    r'^(\d{4}-\d{2}-\d{2})[T ](\d{2}:\d{2}:\d{2})(?:\.(\d+))?Z?(?: ([+-])(\d{2})(\d{2}))?')
+
+
+def svn_date_to_epoch(text):
+    """Convert svn and IDLEMERGE DATA dates to seconds since the epoch, in UTC.
+
+    Supported formats are 2012-02-17T17:13:35.123456Z from the xml logs, 2012-02-17 17:13:35.123456
+    as written by idle_merge_metacomment() and 2012-02-17 17:13:35 -0800 (Fri, 17 Feb 2012).
+
+    Returns:
+        A float, None if the date cannot be parsed.
+    """
+    match = SVN_DATE_RE.match((text or '').strip())
+    if not match:
+        return None
+    day, clock, fraction, sign, hours, minutes = match.groups()
+    date = datetime.datetime.strptime('%s %s' % (day, clock), '%Y-%m-%d %H:%M:%S')
+    epoch = calendar.timegm(date.timetuple()) + float('0.' + (fraction or '0'))
+    if sign:
+        offset = int(hours) * 3600 + int(minutes) * 60
+        epoch += -offset if sign == '+' else offset
+    return epoch
+
+
+class LatencyHistogram(object):
+    """Latency distribution in log spaced buckets, memory does not grow with the samples.
+
+    Percentiles are the upper bound of their bucket, about 9% precision.
+    """
+    BUCKETS_PER_DOUBLING = 8
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, seconds):
+        seconds = max(float(seconds), 0.0)
+        index = int(math.floor(math.log(seconds + 1, 2) * self.BUCKETS_PER_DOUBLING))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.minimum = seconds if self.minimum is None else min(self.minimum, seconds)
+        self.maximum = seconds if self.maximum is None else max(self.maximum, seconds)
+
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        rank = math.ceil(self.count * percent / 100.0)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                upper = 2 ** (float(index + 1) / self.BUCKETS_PER_DOUBLING) - 1
+                return min(max(upper, self.minimum), self.maximum)
+        return self.maximum
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.maximum,
+        }
+
+
+class LatencyReport(object):
+    """Propagation latency analytics from the IDLEMERGE DATA of target branches logs.
+
+    The latency of a source revision is the time between its original commit and the idlemerge
+    commit bringing it to the target, both dates come from the target log. The logs of the branches
+    are streamed together in revision order, so that merges of merges are followed: the end to end
+    latency measures from the first original commit across all the hops.
+
+    The origins of the merges are only kept for the branches before the last one, and each is
+    dropped once a downstream merge consumed it. The memory held is bounded by the upstream merges
+    not merged downstream yet, not by the log range. A revision merged from one branch into
+    several downstream branches is followed from the first of them only.
+
+    The time spent blocked behind conflicts is estimated: revisions merged by hand do not carry
+    IDLEMERGE DATA, so any latency above blocked_threshold is accounted as blocked time.
+
+    Args:
+        svn: An SvnWrapper instance.
+        branches: A list of strings, the target branches urls, the last one is the most
+            downstream.
+        start: An integer, the first revision to scan.
+        end: An integer or 'HEAD', the last revision to scan.
+        blocked_threshold: An integer, in seconds.
+    """
+
+    def __init__(self, svn, branches, start=1, end='HEAD', blocked_threshold=1800):
+        self.svn = svn
+        self.branches = list(branches)
+        self.start = start
+        self.end = end
+        self.blocked_threshold = blocked_threshold
+        self.pairs = {}
+        self.hops = {}
+        self.blocked = {}
+        self._queue_deltas = {}
+        # Idlemerge commit revision -> (first original commit epoch, hops), until merged downstream.
+        self._origins = {}
+
+    def _histogram(self, histograms, key):
+        if key not in histograms:
+            histograms[key] = LatencyHistogram()
+        return histograms[key]
+
+    def _queue_delta(self, pair, epoch, delta):
+        hour = int(epoch // 3600) * 3600
+        deltas = self._queue_deltas.setdefault(pair, {})
+        deltas[hour] = deltas.get(hour, 0) + delta
+
+    def add(self, target, logentry, upstream=True):
+        """Account an idlemerge commit of target, upstream keeps its origins for the next hop."""
+        revision = Revision(xml_element=logentry, svn=self.svn, branch=target)
+        if not revision.idle_data:
+            return
+        idle_data = IdleData(revision.idle_data)
+        merged_at = svn_date_to_epoch(logentry.find('date').text)
+        pair = '%s -> %s' % (automerge_source(revision.msg), target)
+        first_origin = None
+        hops = 1
+        for number, _, date in idle_data.origins:
+            committed_at = svn_date_to_epoch(date)
+            if committed_at is None or merged_at is None:
+                continue
+            latency = merged_at - committed_at
+            self._histogram(self.pairs, pair).add(latency)
+            self._histogram(self.blocked, pair).add(max(0, latency - self.blocked_threshold))
+            self._queue_delta(pair, committed_at, 1)
+            self._queue_delta(pair, merged_at, -1)
+            origin, origin_hops = self._origins.pop(number, (committed_at, 0))
+            self._histogram(self.hops, '%s (%d hops)' % (target, origin_hops + 1)).add(
+                merged_at - origin)
+            if first_origin is None or origin < first_origin:
+                first_origin = origin
+                hops = origin_hops + 1
+        if first_origin is not None and upstream:
+            self._origins[revision.number] = (first_origin, hops)
+
+    def _log(self, index, branch):
+        for logentry in iter_log_entries(self.svn, branch, self.start, self.end):
+            yield int(logentry.get('revision')), index, logentry
+
+    def run(self):
+        logs = [self._log(index, branch) for index, branch in enumerate(self.branches)]
+        for _, index, logentry in heapq.merge(*logs):
+            self.add(self.branches[index], logentry, upstream=index < len(self.branches) - 1)
+        return self
+
+    def queue_depth(self):
+        """Returns a dict, pair as key, list of (hour epoch, pending revisions) as value."""
+        depths = {}
+        for pair, deltas in self._queue_deltas.items():
+            depth = 0
+            series = []
+            for hour in sorted(deltas):
+                depth += deltas[hour]
+                series.append((hour, depth))
+            depths[pair] = series
+        return depths
+
+    def rows(self):
+        """Returns the report as a list of dicts, one per distribution."""
+        rows = []
+        for kind, histograms in (('pair', self.pairs), ('hop', self.hops),
+                                 ('blocked', self.blocked)):
+            for key in sorted(histograms):
+                row = {'kind': kind, 'key': key}
+                row.update(histograms[key].summary())
+                rows.append(row)
+        return rows
+
+    def write(self, output, report_format='csv'):
+        if report_format == 'json':
+            json.dump({'distributions': self.rows(), 'queue_depth': self.queue_depth()},
+                      output, indent=2, sort_keys=True)
+            return
+        fields = ['kind', 'key', 'count', 'mean', 'p50', 'p95', 'p99', 'max']
+        writer = csv.writer(output)
+        writer.writerow(fields)
+        for row in self.rows():
+            writer.writerow([row[x] for x in fields])
+        writer.writerow([])
+        writer.writerow(['pair', 'hour', 'queue_depth'])
+        for pair, series in sorted(self.queue_depth().items()):
+            for hour, depth in series:
+                writer.writerow([pair, datetime.datetime.utcfromtimestamp(hour).isoformat(), depth])
+
+    def __str__(self):
+        lines = ['%-8s %-50s %7s %10s %10s %10s' % ('kind', 'key', 'count', 'p50', 'p95', 'p99')]
+        for row in self.rows():
+            lines.append('%-8s %-50s %7d %10s %10s %10s' % (
+                row['kind'], row['key'], row['count'], format_duration(row['p50']),
+                format_duration(row['p95']), format_duration(row['p99'])))
+        return '\n'.join(lines)
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return '-'
+    if seconds < 120:
+        return '%.0fs' % seconds
+    if seconds < 7200:
+        return '%.1fm' % (seconds / 60.0)
+    if seconds < 172800:
+        return '%.1fh' % (seconds / 3600.0)
+    return '%.1fd' % (seconds / 86400.0)
+
+
+class PriorityRules(object):
+    """Rules tagging the urgent revisions to merge ahead of the backlog.
+
+    Args:
+        markers: A list of strings, a revision is urgent if its message contains one of them.
+        authors: A list of strings, authors whose revisions are urgent.
+        paths: A list of fnmatch patterns, relative to the source branch, e.g. 'security/*'. A
+            revision changing a matching path is urgent.
+    """
+
+    def __init__(self, markers=DEFAULT_URGENT_MARKERS, authors=(), paths=()):
+        self.markers = tuple(markers)
+        self.authors = frozenset(authors)
+        self.paths = tuple(paths)
+
+    def __nonzero__(self):
+        return bool(self.markers or self.authors or self.paths)
+
+    def reason(self, revision, branch_path):
+        """Returns why revision is urgent, None if it is not.
+
+        Args:
+            revision: A Revision() instance, with its log loaded.
+            branch_path: A string, the path of the source branch in the repository.
+        """
+        message = revision.msg or ''
+        for marker in self.markers:
+            if marker in message:
+                return marker
+        if revision.author in self.authors:
+            return 'author %s' % revision.author
+        if self.paths:
+            for relative in branch_relative_paths(revision, branch_path):
+                for pattern in self.paths:
+                    if fnmatch.fnmatch(relative, pattern):
+                        return 'path %s' % pattern
+        return None
+
+
+class _PathNode(object):
+    __slots__ = ('children', 'exact', 'prefix', 'globs')
+
+    def __init__(self):
+        self.children = {}
+        self.exact = False
+        self.prefix = False
+        self.globs = []
+
+
+class PathTrie(object):
+    """Set of paths with exact, directory prefix and glob entries.
+
+    Paths are split on '/' and stored component by component, looking a path up costs its number
+    of components, plus the globs hanging on the way. A glob is attached to the node of its
+    literal leading components and matched with fnmatch component by component, '**' matches any
+    number of components.
+
+    Args:
+        paths: A list of strings, exact paths to add.
+    """
+    WILDCARDS = re.compile(r'[*?[]')
+
+    def __init__(self, paths=()):
+        self._root = _PathNode()
+        self._entries = []
+        for path in paths:
+            self.add(path)
+
+    @staticmethod
+    def split(path):
+        return [x for x in path.split('/') if x]
+
+    def _node(self, components):
+        node = self._root
+        for component in components:
+            child = node.children.get(component)
+            if child is None:
+                child = node.children[component] = _PathNode()
+            node = child
+        return node
+
+    def add(self, path, prefix=False):
+        """Add path, and everything below it if prefix is set."""
+        node = self._node(self.split(path))
+        if not node.exact:
+            self._entries.append((path, node))
+        node.exact = True
+        node.prefix = node.prefix or prefix
+
+    def add_glob(self, pattern):
+        components = self.split(pattern)
+        literal = 0
+        while literal < len(components) and not self.WILDCARDS.search(components[literal]):
+            literal += 1
+        if literal == len(components):
+            return self.add(pattern)
+        self._node(components[:literal]).globs.append(components[literal:])
+        self._entries.append((pattern, None))
+
+    def update(self, other):
+        """Add the entries of other, another PathTrie()."""
+        for path, node in other._entries:
+            if node is None:
+                self.add_glob(path)
+            else:
+                self.add(path, prefix=node.prefix)
+
+    def copy(self):
+        trie = PathTrie()
+        trie.update(self)
+        return trie
+
+    def add_pattern(self, pattern):
+        """Add a pattern of a user list: a glob, a directory if it ends with '/', else a path."""
+        if self.WILDCARDS.search(pattern):
+            self.add_glob(pattern)
+        else:
+            self.add(pattern, prefix=pattern.endswith('/'))
+
+    @property
+    def exact_only(self):
+        """True if there is no prefix nor glob entry, looking up is then plain membership."""
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node.prefix or node.globs:
+                return False
+            stack.extend(node.children.values())
+        return True
+
+    @classmethod
+    def _glob_match(cls, pattern, components):
+        if not pattern:
+            return not components
+        if pattern[0] == '**':
+            return any(cls._glob_match(pattern[1:], components[x:])
+                       for x in range(len(components) + 1))
+        return bool(components) and fnmatch.fnmatchcase(components[0], pattern[0]) and (
+            cls._glob_match(pattern[1:], components[1:]))
+
+    def __contains__(self, path):
+        components = self.split(path)
+        node = self._root
+        for index, component in enumerate(components):
+            if node.prefix:
+                return True
+            for pattern in node.globs:
+                if self._glob_match(pattern, components[index:]):
+                    return True
+            node = node.children.get(component)
+            if node is None:
+                return False
+        return node.exact
+
+    def overlaps(self, path):
+        """Returns True if path is in the trie or if entries are below it."""
+        if path in self:
+            return True
+        node = self._root
+        for component in self.split(path):
+            node = node.children.get(component)
+            if node is None:
+                return False
+        return True
+
+    def __iter__(self):
+        """Yields the entries, the directory prefixes with a trailing '/'."""
+        for path, node in self._entries:
+            yield path.rstrip('/') + '/' if node is not None and node.prefix else path
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def branch_relative_paths(revision, branch_path):
+    """Returns the paths changed by revision below branch_path, relative to it."""
+    prefix = branch_path.rstrip('/') + '/'
+    return [x.path[len(prefix):] for x in revision.paths if x.path.startswith(prefix)]
+
+
+class AhoCorasick(object):
+    """Automaton finding any of a set of words in a text, in a single pass over the text.
+
+    The cost of a search depends on the length of the text, not on the number of words.
+
+    Args:
+        words: A list of strings.
+    """
+
+    def __init__(self, words):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [None]
+        for word in words:
+            if not word:
+                continue
+            node = 0
+            for char in word:
+                child = self._goto[node].get(char)
+                if child is None:
+                    child = len(self._goto)
+                    self._goto[node][char] = child
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(None)
+                node = child
+            if self._output[node] is None:
+                self._output[node] = word
+        # Breadth first, so the fail node of a node is complete before its children.
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                if self._output[child] is None:
+                    self._output[child] = self._output[self._fail[child]]
+
+    def search(self, text):
+        """Returns the first word found in text, None if there is none."""
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node] is not None:
+                return output[node]
+        return None
+
+
+class NoMergeRules(object):
+    """Compiled rules of the revisions to record-only instead of merging.
+
+    Each rule is a line, with an optional kind prefix:
+        NO_MERGE            the commit message contains NO_MERGE, same as text:NO_MERGE.
+        re:^Release \d+     the commit message matches the regular expression.
+        author:jenkins      the revision is committed by jenkins.
+        path:*.pom          the revision changes a path matching the pattern, relative to the
+                            source branch.
+
+    The substrings are searched with a single AhoCorasick() automaton, the regular expressions
+    and the path patterns are combined into one regular expression each, so that a revision is
+    evaluated in one pass over its message and paths however many rules there are. The rules of
+    the file are reloaded when it changes.
+
+    Args:
+        rules: A list of strings, the rules always applied, e.g. from the command line.
+        filename: A string, the file with more rules, one per line, # starts a comment. Optional.
+    """
+    KINDS = ('text', 're', 'author', 'path')
+
+    def __init__(self, rules=(), filename=None):
+        self.rules = list(rules)
+        self.filename = filename
+        self._file_rules = []
+        self._mtime = None
+        self._compile()
+
+    @classmethod
+    def parse(cls, rule):
+        """Returns the (kind, value) of a rule string."""
+        kind, sep, value = rule.partition(':')
+        if sep and kind in cls.KINDS:
+            return kind, value
+        return 'text', rule
+
+    @staticmethod
+    def read_rules(filename):
+        rules = []
+        with open(filename, 'r') as rules_file:
+            for line in rules_file:
+                rule = line.strip()
+                if rule and not rule.startswith('#'):
+                    rules.append(rule)
+        return rules
+
+    def reload(self):
+        """Read the rules file again if it changed since the last load."""
+        if not self.filename:
+            return
+        try:
+            mtime = os.stat(self.filename).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        self._file_rules = self.read_rules(self.filename) if mtime is not None else []
+        self._compile()
+        print 'Loaded %d no-merge rules from %s' % (len(self._file_rules), self.filename)
+
+    def _compile(self):
+        by_kind = dict([(kind, []) for kind in self.KINDS])
+        for rule in self.rules + self._file_rules:
+            kind, value = self.parse(rule)
+            if value:
+                by_kind[kind].append(value)
+        self._texts = AhoCorasick(by_kind['text'])
+        self._regexes = []
+        for pattern in by_kind['re']:
+            try:
+                self._regexes.append(re.compile(pattern))
+            except re.error as error:
+                # A typo in the rules file must not stop the passes, the rule is left out.
+                print 'Skipping invalid no-merge rule re:%s: %s' % (pattern, error)
+        by_kind['re'] = [x.pattern for x in self._regexes]
+        self._regex = None
+        if self._regexes:
+            try:
+                self._regex = re.compile('|'.join(['(?:%s)' % x.pattern for x in self._regexes]))
+            except (re.error, AssertionError, OverflowError):
+                # Too many groups for a single expression, they are tried one by one.
+                pass
+        self._authors = frozenset(by_kind['author'])
+        self._paths = by_kind['path']
+        self._path_regex = None
+        if self._paths:
+            self._path_regex = re.compile('|'.join(
+                ['(?:%s)' % self.glob_regex(x) for x in self._paths]), re.S)
+        self.count = sum([len(x) for x in by_kind.values()])
+
+    @staticmethod
+    def glob_regex(pattern):
+        """Returns the regular expression of an fnmatch pattern, without the trailing flags."""
+        regex = fnmatch.translate(pattern)
+        if regex.endswith('(?ms)'):
+            regex = regex[:-len('(?ms)')]
+        return regex
+
+    @property
+    def has_path_rules(self):
+        return bool(self._paths)
+
+    def match(self, revision, branch_path=None):
+        """Returns the rule revision matches, None if none does.
+
+        Args:
+            revision: A Revision() instance.
+            branch_path: A string, the path of the source branch in the repository, required by
+                the path rules.
+        """
+        if self._authors and revision.author in self._authors:
+            return 'author:%s' % revision.author
+        message = revision.msg or ''
+        word = self._texts.search(message)
+        if word is not None:
+            return word
+        if self._regexes and (self._regex is None or self._regex.search(message)):
+            # Only a match pays for finding which expression it is.
+            for regex in self._regexes:
+                if regex.search(message):
+                    return 're:%s' % regex.pattern
+        if self._path_regex is not None and branch_path:
+            for relative in branch_relative_paths(revision, branch_path):
+                if self._path_regex.match(relative):
+                    for pattern in self._paths:
+                        if fnmatch.fnmatch(relative, pattern):
+                            return 'path:%s' % pattern
+        return None
+
+
+def paths_overlap(paths, other_paths):
+    """Returns True if the two lists of LogPath() entries touch a common file or directory.
+
+    A directory modification is a property change, usually svn:mergeinfo, it only overlaps the
+    same directory and not everything below it.
+    """
+    def keys(log_paths):
+        return [(x.path.rstrip('/'), x.is_dir and x.action == 'M') for x in log_paths]
+    for path, props_only in keys(paths):
+        for other, other_props_only in keys(other_paths):
+            if path == other:
+                return True
+            if not props_only and other.startswith(path + '/'):
+                return True
+            if not other_props_only and path.startswith(other + '/'):
+                return True
+    return False
+
+
+class ConflictPredictor(object):
+    """Guess which pending revisions merge cleanly, before touching the working copy.
+
+    A revision is likely to conflict when it changes a path that the target changed on its own,
+    outside of the merges from the source, since the last merge base: the last automerge from the
+    source, or the copy creating the target when there is none. The target side is read from the
+    svn log -v of the target after the merge base, the source side from the paths of the revisions.
+
+    Args:
+        idlemerge: An IdleMerge() instance.
+    """
+
+    def __init__(self, idlemerge):
+        self.idlemerge = idlemerge
+        self.diverged = PathTrie()
+        self.suspects = set()
+
+    def merge_base(self, url):
+        """Returns the revision of the last automerge from the source to url, else its copy."""
+        base = None
+        for entry in iter_log_entries(self.idlemerge.svn, url, 1, 'HEAD', ['--stop-on-copy']):
+            if base is None or automerge_source(entry.findtext('msg')) == self.idlemerge.source:
+                base = int(entry.get('revision'))
+        return base or 0
+
+    def load(self, revisions):
+        """Collect the paths the target changed since the last merge base."""
+        idlemerge = self.idlemerge
+        self.diverged = PathTrie()
+        self.suspects = set()
+        if not revisions:
+            return
+        url = idlemerge.info.entries_by_path[idlemerge.target].url
+        prefix = idlemerge.repo_path(url).rstrip('/') + '/'
+        base = self.merge_base(url)
+        for entry in iter_log_entries(idlemerge.svn, url, base, 'HEAD', ['-v']):
+            if (int(entry.get('revision')) == base or
+                    automerge_source(entry.findtext('msg')) == idlemerge.source):
+                continue
+            for log_path in [LogPath(x) for x in entry.findall('paths/path')]:
+                if log_path.path.startswith(prefix):
+                    self.diverged.add(log_path.path[len(prefix):], prefix=(
+                        log_path.is_dir and log_path.action in ('A', 'R')))
+        print 'Predictor: %d paths changed on the target side' % len(self.diverged)
+
+    def likely_conflict(self, revision):
+        if revision in self.suspects:
+            return True
+        for log_path in revision.paths:
+            sub_path = self.idlemerge.get_source_sub_path(log_path.path, revision.original_branch)
+            if self.diverged.overlaps(sub_path):
+                return True
+        return False
+
+
 class IdleMerge(object):
 
     def __init__(self, source, target='.', noop=True, single=False, verbose=False, stdout=None,
@@ -998,7 +3812,7 @@ class IdleMerge(object):
         self._stdout = stdout
         self.commit_mergeinfo = commit_mergeinfo
         self.noop = noop
-        self.no_merge_patterns = DEFAULT_NO_MERGE_PATTERNS
+        self.no_merge_rules = NoMergeRules(DEFAULT_NO_MERGE_PATTERNS)
         self.single = single
         self.concise = False
         self.mail_handler = None
@@ -1006,11 +3820,38 @@ class IdleMerge(object):
         self.verbose = verbose
         self.validation_script = None
         self.ignore = ()
+        self._ignore_trie = None
+        self._source_prefixes = {}
+        self.lookahead = 0
+        self.reset_strategy = 'auto'
+        self.dirty_journal = None
+        self.snapshot_dir = None
+        self.targeted_update = False
+        self.shards = ()
+        self.merge_subtrees = ()
+        self.local_eligible = False
+        self.verify_eligible = False
+        self.cache_dir = None
+        self.profiler = None
+        self.run_journal = RunJournal(None)
+        self.lock_wait = 0.0
+        self.extend_requested = False
+        self.budget = PassBudget()
+        self.cursor_filename = None
+        self.conflict_report = None
+        self.conflict_html = None
+        self.priority = PriorityRules()
+        self.urgent = {}
+        self.predict_batch = 0
+        self.predictor = ConflictPredictor(self)
+        self._reset_engine = None
         # self.authentication = False
         # self.username = None
         # self.password = None
         # self.printOut = None
-        self.svn = SvnWrapper(no_commit=noop, verbose=verbose, stdout=stdout)
+        self.tracer = RunTrace(labels={'source': source, 'target': target})
+        self.pass_stats = PassStats(self.tracer)
+        self.svn = SvnWrapper(no_commit=noop, verbose=verbose, stdout=stdout, tracer=self.tracer)
         self._info = None
 
     @property
@@ -1025,6 +3866,14 @@ class IdleMerge(object):
             self.get_svn_info()
         return self._info
 
+    @property
+    def target_label(self):
+        """Returns the target url for reports, the local path if it is not known."""
+        try:
+            return self.target_url
+        except (Error, KeyError, OSError, SyntaxError):
+            return self.target
+
     def execute_svn_command(self, command_label, handle_process=True, bufsize=None):
         return self.svn.run(
             command_label, discard_output=False, handle_process=handle_process, bufsize=bufsize)
@@ -1056,30 +3905,80 @@ class IdleMerge(object):
             self._info = info
         return info
 
-    def svn_update(self):
+    def svn_update(self, paths=None):
+        """Update the target, or only its root properties and paths when paths is a list."""
         print "UPDATE"
         self._info = None
-        return self.execute_svn_command(['update', '--ignore-externals', self.target])
+        if paths is None:
+            return self.execute_svn_command(['update', '--ignore-externals', self.target])
+        return self.execute_svn_command(
+            ['update', '--ignore-externals', '--depth', 'empty', '--parents', self.target] +
+            [os.path.join(self.target, path) for path in sorted(paths)])
+
+    def update_for(self, revisions, full=False):
+        """Update the working copy before merging revisions, see --targeted_update."""
+        if full or not self.targeted_update:
+            return self.svn_update()
+        paths = UpdatePlanner(self).plan(revisions)
+        return self.svn_update(paths)
 
+    @property
+    def reset_engine(self):
+        if self._reset_engine is None:
+            self._reset_engine = WorkspaceReset(
+                self, strategy=self.reset_strategy, journal=DirtyPathsJournal(self.dirty_journal),
+                snapshot=WorkingCopySnapshot(self.target, self.snapshot_dir))
+        return self._reset_engine
+
+    @traced('revert_pristine')
     def revert_pristine(self):
         """Revert all pending changes and delete unknown files to get a pristine working copy."""
-        self.revert_all()
-        self.svn_update()
-
-        status = self.svn_status()
-        if not status.unversionned:
-            return
-        # delete unversionned files
-        for entry in status.unversionned:
-            path = entry.path
-            if os.path.isdir(path) and not os.path.islink(path):
-                shutil.rmtree(path)
-            else:
-                os.remove(path)
-        if self.svn_update() == 0:
-            raise Error('Failed to reset workspace !')
-
+        return self.reset_engine.reset()
+
+    def repo_path(self, url):
+        """Returns the repository path of url, e.g. /branches/stable for ^/branches/stable@12."""
+        url = re.sub(r'@[^/]*$', '', url).rstrip('/')
+        if url.startswith('^/'):
+            return url[1:]
+        repo_root = self.info.entries_by_path[self.target].repo_root.rstrip('/')
+        if url.startswith(repo_root):
+            return url[len(repo_root):] or '/'
+        raise Error('%s is not in the repository %s' % (url, repo_root))
+
+    @traced('get_eligible_revisions')
     def get_eligible_revisions(self):
+        """Returns the list of Revision() instances of self.source not merged to the target.
+
+        svn computes them server side unless --local_eligible is set. With --verify_eligible both
+        are computed, the differences are reported and the server answer is used.
+        """
+        if not self.local_eligible and not self.verify_eligible:
+            return self.get_server_eligible_revisions()
+        local = self.get_local_eligible_revisions()
+        if not self.verify_eligible:
+            return local
+        server = self.get_server_eligible_revisions()
+        local_only = RevisionRanges.from_revisions(local).difference(
+            RevisionRanges.from_revisions(server))
+        server_only = RevisionRanges.from_revisions(server).difference(
+            RevisionRanges.from_revisions(local))
+        if local_only.ranges or server_only.ranges:
+            print 'Eligible revisions mismatch, local only: %s, server only: %s' % (
+                local_only or 'none', server_only or 'none')
+        else:
+            print 'Eligible revisions verified: %d revisions' % len(server)
+        return server
+
+    def get_local_eligible_revisions(self):
+        """Compute the eligible revisions from the target svn:mergeinfo and the LogCache()."""
+        source_path = self.repo_path(self.source)
+        self.execute_svn_command(['propget', 'svn:mergeinfo', self.target])
+        merged = parse_mergeinfo(self.svn.stdout or []).get(source_path, RevisionRanges())
+        log_cache = LogCache(self.svn, self.source, source_path, self.cache_dir)
+        eligible = log_cache.revisions().difference(merged)
+        return [Revision(number=x, svn=self.svn, branch=self.source) for x in eligible]
+
+    def get_server_eligible_revisions(self):
         self.execute_svn_command([
             'mergeinfo', '--show-revs', 'eligible', self.source, self.target])
         svn_output = self.svn.stdout
@@ -1092,61 +3991,250 @@ class IdleMerge(object):
                 revisions.append(Revision(number=match.group(1), svn=self.svn, branch=self.source))
         return revisions
 
+    def merge_targets(self, source):
+        """Returns the (source, target) pairs to merge, one per subtree with merge_subtrees.
+
+        Merging the subtrees separately records their svn:mergeinfo on each subtree, the root of
+        the target is left untouched.
+        """
+        if not self.merge_subtrees:
+            return [(source, self.target)]
+        return [('%s/%s' % (source, x), os.path.normpath(os.path.join(self.target, x)))
+                for x in self.merge_subtrees]
+
     # When this error happens, we want to update and retry the merge
     # svn: E195020: Cannot merge into mixed-revision working copy [431:432]; try updating first
+    @traced('svn_merge')
     def svn_merge(self, revisions, merge_option='postpone'):
         if type(revisions) is Revision:
             revisions = [revisions]
         revisions_string = ','.join([str(revision.number) for revision in revisions])
         original_branch = revisions[-1].original_branch
-        command = ['--accept', merge_option, 'merge', '-c', revisions_string,
-             '%s@%s' % (original_branch, str(revisions[-1].number)), self.target]
-        print '> svn', ' '.join(command)
-        for _ in range(3):
-            return_code = self.execute_svn_command(command)
-            err_line = self.svn.stderr[0] if self.svn.stderr else ''
-            if return_code and err_line.startswith('svn: E195020'):
-                self.svn_update()
-                continue
-            break
-        if return_code:
-            print >> self._stdout, ' Executing %r failed !\n' % command
-            print >> self._stdout, self.svn.stderr
-            return False
-        self.revert_files_to_ignore()
+        self.reset_engine.journal.begin(revisions)
+        for source, target in self.merge_targets(original_branch):
+            command = ['--accept', merge_option, 'merge'] + self.merge_options() + [
+                '-c', revisions_string, '%s@%s' % (source, str(revisions[-1].number)), target]
+            print '> svn', ' '.join(command)
+            for attempt in range(3):
+                return_code = self.execute_svn_command(command)
+                err_line = self.svn.stderr[0] if self.svn.stderr else ''
+                if return_code and err_line.startswith('svn: E195020'):
+                    # Try the targeted update first, then the whole working copy.
+                    self.update_for(revisions, full=attempt > 0)
+                    continue
+                break
+            if return_code:
+                print >> self._stdout, ' Executing %r failed !\n' % command
+                print >> self._stdout, self.svn.stderr
+                return False
+        self.revert_files_to_ignore(revisions)
         return True
 
-    def revert_files_to_ignore(self):
+    def load_logs(self, revisions):
+        """Load the log entries of revisions with a single svn log of the source."""
+        missing = [r for r in revisions if not r.log_loaded]
+        if not missing:
+            return
+        self.execute_svn_command(['log', '--xml', '-v', '-r', '%d:%d' % (
+            min(missing).number, max(missing).number), self.source])
+        if self.svn.return_code:
+            raise Error('Cannot get the log of %s: %s' % (self.source, ''.join(self.svn.stderr)))
+        entries = {}
+        for entry in xml.etree.ElementTree.fromstring(''.join(self.svn.stdout)).findall('logentry'):
+            entries[int(entry.attrib['revision'])] = entry
+        for revision in missing:
+            if revision.number in entries:
+                revision.xml_element = entries[revision.number]
+
+    @traced('prioritize')
+    def prioritize(self, revisions):
+        """Move the urgent revisions ahead of the older pending revisions they do not overlap.
+
+        An urgent revision touching the paths of an older pending revision keeps its place, so
+        the reordered merges are cherry-picks that apply the same. The overtaken revisions are
+        kept in self.urgent for the IDLEMERGE DATA of the merge.
+
+        Args:
+            revisions: A list of Revision() instances, in merge order.
+
+        Returns:
+            A list of the same Revision() instances, in the new merge order.
+        """
+        self.urgent = {}
+        if not self.priority or len(revisions) < 2:
+            return revisions
+        self.load_logs(revisions)
+        branch_path = self.repo_path(self.source)
+        urgent = []
+        kept = []
+        for revision in revisions:
+            reason = self.priority.reason(revision, branch_path)
+            if reason and kept and not [x for x in kept if paths_overlap(x.paths, revision.paths)]:
+                self.urgent[revision] = (reason, list(kept))
+                urgent.append(revision)
+            elif reason and not kept:
+                urgent.append(revision)
+            else:
+                kept.append(revision)
+        for revision in urgent:
+            if revision in self.urgent:
+                print 'Urgent r%s (%s) merged ahead of %s' % (
+                    revision, self.urgent[revision][0],
+                    revisions_as_string(self.urgent[revision][1]))
+        return urgent + kept
+
+    def merge_options(self):
+        """Returns the extra options for svn merge."""
+        if self.targeted_update or self.shards:
+            return ['--allow-mixed-revisions']
+        return []
+
+    @property
+    def ignore_trie(self):
+        """Returns the PathTrie() of self.ignore, rebuilt when the list changes."""
+        if self._ignore_trie is None or self._ignore_trie[0] != tuple(self.ignore):
+            trie = PathTrie()
+            for pattern in self.ignore:
+                trie.add_pattern(pattern)
+            self._ignore_trie = (tuple(self.ignore), trie)
+        return self._ignore_trie[1]
+
+    def revert_files_to_ignore(self, revisions=()):
+        """Revert the --ignore paths the merge of revisions brought in.
+
+        Plain paths are reverted as they are, directories and globs are matched against the
+        paths the revisions changed.
+        """
         if not self.ignore:
             return
-        self.execute_svn_command(['revert'] + [os.path.join(self.target, x) for x in self.ignore])
+        trie = self.ignore_trie
+        paths = [os.path.join(self.target, x) for x in self.ignore
+                 if not PathTrie.WILDCARDS.search(x) and not x.endswith('/')]
+        if not trie.exact_only:
+            for revision in revisions:
+                for log_path in revision.paths:
+                    sub_path = self.get_source_sub_path(log_path.path, revision.original_branch)
+                    if sub_path in trie:
+                        paths.append(os.path.join(self.target, sub_path))
+        if paths:
+            self.svn_revert(sorted(set(paths)))
+
+    def svn_revert(self, paths):
+        """Revert paths with a single svn revert, reading them from a file past 100 paths."""
+        if len(paths) <= 100:
+            return self.execute_svn_command(['revert'] + paths)
+        # Keep the command line short, svn reads the extra targets from the file.
+        with tempfile.NamedTemporaryFile(prefix='idlemerge-targets-') as targets_file:
+            targets_file.write('\n'.join(paths) + '\n')
+            targets_file.flush()
+            return self.execute_svn_command(['revert', '--targets', targets_file.name])
+
+    def commit_targets(self, status, expected_paths=None):
+        """Get the explicit list of paths to commit from the post merge status.
+
+        Args:
+            status: A Status() instance of the target after the merge.
+            expected_paths: A set of strings, the paths the merge is allowed to modify besides the
+                target itself. None to skip the check.
+
+        Returns:
+            A list of strings, the paths to commit with --depth empty along with the target. None
+            if the whole target must be committed, for copied, deleted or replaced directories
+            which svn only commits recursively.
+
+        Raises:
+            UnexpectedModifications: if modified paths are not part of expected_paths.
+        """
+        targets = []
+        unexpected = []
+        full = False
+        removed = []
+        parents = set()
+        for entry in status.entries:
+            if entry.path == self.target or not entry.is_modified:
+                continue
+            if expected_paths is not None and entry.path not in expected_paths:
+                unexpected.append(entry.path)
+            if entry.is_dir() and (entry.copied or entry.item == 'replaced'):
+                full = True
+            elif entry.item in ('deleted', 'replaced'):
+                # A deleted directory is gone from the disk, it is known by its children.
+                removed.append(entry.path)
+            parent = os.path.dirname(entry.path)
+            while parent and parent not in parents:
+                parents.add(parent)
+                parent = os.path.dirname(parent)
+            targets.append(entry.path)
+        if unexpected:
+            raise UnexpectedModifications(unexpected)
+        if full or parents.intersection(removed):
+            return None
+        return targets
+
+    @traced('commit')
+    def commit(self, options=None, status=None, expected_paths=None):
+        """Commit the merge.
 
-    def commit(self, options=None):
+        Args:
+            options: A list of strings, extra options for svn commit, e.g. the message.
+            status: A Status() instance of the target after the merge. When provided only the
+                modified paths are committed, instead of svn crawling the whole working copy.
+            expected_paths: A set of strings, see commit_targets().
+
+        Returns:
+            An integer, the return code of svn commit.
+        """
         if options is None:
             options = []
+        targets = None
+        if status is not None:
+            targets = self.commit_targets(status, expected_paths)
         if self.noop:
             print 'NOOP: commit'
-            self.revert_all()
+            if not self.reset_engine.restore_snapshot():
+                self.revert_all()
             return 0
-        self.execute_svn_command(['commit'] + options + [self.target])
+        if targets is None:
+            self.execute_svn_command(['commit'] + options + [self.target])
+        elif len(targets) > 100:
+            # Keep the command line short, svn reads the extra targets from the file.
+            with tempfile.NamedTemporaryFile(prefix='idlemerge-targets-') as targets_file:
+                targets_file.write('\n'.join(targets) + '\n')
+                targets_file.flush()
+                self.execute_svn_command(['commit'] + options + [
+                    '--depth', 'empty', '--targets', targets_file.name, self.target])
+        else:
+            self.execute_svn_command(
+                ['commit'] + options + ['--depth', 'empty', self.target] + targets)
         print ''.join(self.svn.stdout)
+        if not self.svn.return_code:
+            self.reset_engine.committed(self.svn.stdout)
         return self.svn.return_code
 
     def is_no_merge_revision(self, revision, record_only_revisions=None):
         if record_only_revisions and revision in record_only_revisions:
             return True
-        comment = revision.msg
-        for pattern in self.no_merge_patterns:
-            if pattern in comment:
-                return True
-        return False
+        branch_path = None
+        if self.no_merge_rules.has_path_rules:
+            branch_path = self.repo_path(self.source)
+        rule = self.no_merge_rules.match(revision, branch_path)
+        if rule is None:
+            return False
+        if self.verbose:
+            print 'r%s is not merged, rule %s' % (revision, rule)
+        return True
 
+    @traced('merge_record_only')
     def merge_record_only(self, revisions):
         revisions_string = revisions_as_string(revisions, ',')
-        return self.execute_svn_command([
-            'merge', '--accept', 'postpone', '--record-only', '-c', revisions_string,
-            self.source, self.target
-        ])
+        self.reset_engine.journal.begin(revisions)
+        for source, target in self.merge_targets(self.source):
+            return_code = self.execute_svn_command(
+                ['merge', '--accept', 'postpone', '--record-only'] + self.merge_options() +
+                ['-c', revisions_string, source, target])
+            if return_code:
+                return return_code
+        return 0
 
     # sample delete tree conflict.
     # <?xml version="1.0" encoding="UTF-8"?>
@@ -1319,6 +4407,7 @@ class IdleMerge(object):
             return self.resolve_tree_conflict(revision, victim_path, tree_conflict)
         return True
 
+    @traced('resolve_conflicts')
     def resolve_conflicts(self, revision):
         # Tree conflict, check if the file is the same on both sides.
         # Better would be to check if the file in target is 'newer', then 'accept-yours', if older
@@ -1334,32 +4423,52 @@ class IdleMerge(object):
     def get_source_sub_path(self, path, original_path=None):
         if original_path is None:
             original_path = self.source
-        match = re.match(r'\^?(/.*?)/?(?:@.*)?$', original_path)
-        if match:
-            source = match.group(1) + '/'
-        else:
-            source = original_path
+        source = self._source_prefixes.get(original_path)
+        if source is None:
+            match = re.match(r'\^?(/.*?)/?(?:@.*)?$', original_path)
+            if match:
+                source = match.group(1) + '/'
+            else:
+                source = original_path
+            self._source_prefixes[original_path] = source
         if path.startswith(source):
             return path[len(source):]
         return path
 
+    @traced('revert_spurious_merges')
     def revert_spurious_merges(self, revision, valid_entries=()):
-        no_revert = set(valid_entries)
-        for path_item in revision.paths:
-            no_revert.add(self.get_source_sub_path(path_item.path, revision.original_branch))
+        """Revert the changes of the merge outside of the paths revision changed.
+
+        Args:
+            revision: A Revision() instance, the revision just merged, or a list of them.
+            valid_entries: A PathTrie() of the paths merged so far in the pass, the paths of
+                revision are added to it. Other iterables are copied.
+
+        Returns:
+            The PathTrie() of the valid paths.
+        """
+        revisions = [revision] if type(revision) is Revision else revision
+        no_revert = valid_entries
+        if not isinstance(no_revert, PathTrie):
+            no_revert = PathTrie(valid_entries)
+        for merged in revisions:
+            for path_item in merged.paths:
+                sub_path = self.get_source_sub_path(path_item.path, merged.original_branch)
+                # Below an added directory everything belongs to the revision, e.g. a copy.
+                no_revert.add(sub_path, prefix=path_item.is_dir and path_item.action in ('A', 'R'))
         status = self.svn_status()
         to_revert = []
         for entry in status.entries:
-            if entry.item == 'unversionned' or entry.path in no_revert:
+            if entry.is_unversionned or entry.path in no_revert:
                 continue
             to_revert.append(entry.path)
         if not to_revert:
             return no_revert
         if self.verbose and no_revert:
             print 'Valid entries are:\n  ' + '\n  '.join(sorted(no_revert))
-            print no_revert
-        print 'Reverting spurious merges from %s on %s' % (revision, ' '.join(to_revert))
-        self.execute_svn_command(['revert'] + to_revert)
+        print 'Reverting spurious merges from %s on %s' % (
+            revisions_as_string(revisions), ' '.join(to_revert))
+        self.svn_revert(to_revert)
         return no_revert
 
 # merge revision r1234 by foo from ^/x to ^/bar: Original comment for the revision
@@ -1397,9 +4506,20 @@ class IdleMerge(object):
         else:
             message = 'merge revisions %s from %s to %s' % (
                 revisions_as_string(revisions), self.source, self.target_url)
-        metacomment = idle_merge_metacomment(revisions, mergeinfo_revisions)
+        urgent = self.urgent.get(revisions[0]) if len(revisions) == 1 else None
+        metacomment = idle_merge_metacomment(revisions, mergeinfo_revisions, urgent)
         return '%s\n%s' % (message, metacomment)
 
+    def prefetcher(self, revisions):
+        """Returns a started RevisionPrefetcher() for revisions, see --lookahead."""
+        svn = SvnWrapper(
+            auth=self.svn.auth, verbose=self.verbose, stdout=self._stdout, tracer=self.tracer)
+        svn.recorder = self.svn.recorder
+        svn.backend = self.svn.backend
+        prefetcher = RevisionPrefetcher(revisions, self.lookahead, svn)
+        prefetcher.start()
+        return prefetcher
+
     def merge_one_by_one_concise(self, revisions, commit_mergeinfo=False):
         """Merge one by one but bundle bundle pure mergeinfo changes together to reduce noise.
 
@@ -1419,34 +4539,65 @@ class IdleMerge(object):
             print 'Found %d revisions to record-only from previous run: %s' % (
                 len(record_only_revisions), revisions_as_string(record_only_revisions))
             record_only_revisions = record_only_revisions.intersection(set(revisions))
-        merged_paths = set(self.target)
+        if self.predict_batch > 1:
+            with self.tracer.phase('predict'):
+                self.predictor.load(revisions)
+        prefetcher = self.prefetcher(revisions)
+        try:
+            return self._merge_one_by_one_concise(
+                revisions, record_only_revisions, prefetcher, commit_mergeinfo)
+        finally:
+            prefetcher.stop()
+
+    def _merge_one_by_one_concise(
+        self, revisions, record_only_revisions, prefetcher, commit_mergeinfo):
+        merged_paths = PathTrie([self.target] + [x[1] for x in self.merge_targets(self.source)])
         revisions_to_merge = revisions[:]
         mergeinfo_revisions = set()
         while revisions_to_merge:
+            mergeinfo_revisions = set()
+            batch = []
+            if self.predict_batch > 1:
+                batch = self.predicted_batch(revisions_to_merge, record_only_revisions, prefetcher)
+            if len(batch) > 1 and self.merge_batch(batch, merged_paths):
+                revisions_to_merge = [r for r in revisions_to_merge if r not in batch]
+                self.check_budget(revisions_to_merge, mergeinfo_revisions, record_only_revisions)
+                continue
             print '=====> Merging: ' + revisions_as_string(revisions_to_merge)
             merged = []
-            mergeinfo_revisions = set()
             for revision in revisions_to_merge:
+                prefetcher.wait_for(revision)
+                self.run_journal.record('merge', [revision])
                 if self.is_no_merge_revision(revision, record_only_revisions):
                     self.merge_record_only([revision])
                 else:
                     self.svn_merge(revision)
                 self.resolve_conflicts(revision)
+                self.run_journal.record('resolved', [revision])
                 merged_paths = self.revert_spurious_merges(revision, merged_paths)
+                self.run_journal.record('reverted', [revision])
                 status = self.svn_status()
+                self.journal_dirty_paths([revision], status)
                 if status.has_conflict:
+                    self.run_journal.record('conflict', [revision])
                     raise Conflict(
                         revision=revision,
                         mergeinfos=mergeinfo_revisions.union(record_only_revisions),
                         source=self.source,
-                        target=self.target
+                        target=self.target,
+                        report=ConflictReport.from_status(status)
                     )
                 if status.has_non_props_changes():
                     merged = mergeinfo_revisions.copy()
                     merged.add(revision)
                     commit_log = self.commit_log(revision, mergeinfo_revisions)
                     print commit_log
-                    self.commit(['-m', commit_log])
+                    self.journal_commit([revision], mergeinfo_revisions, commit_log, merged_paths)
+                    size = status.modified_bytes()
+                    if not self.commit(['-m', commit_log], status, merged_paths):
+                        self.pass_stats.merged.update(merged)
+                        self.budget.charge(len(merged), size)
+                    self.journal_committed(merged)
                     if not self.svn.return_code:
                         mergeinfo_revisions = set()
                     break
@@ -1456,7 +4607,12 @@ class IdleMerge(object):
                     merged = mergeinfo_revisions.copy()
                     commit_log = self.commit_log(mergeinfo_revisions=mergeinfo_revisions)
                     print commit_log
-                    self.commit(['-m', commit_log])
+                    self.journal_commit([], mergeinfo_revisions, commit_log, None)
+                    size = status.modified_bytes()
+                    if not self.commit(['-m', commit_log], status):
+                        self.pass_stats.merged.update(merged)
+                        self.budget.charge(len(merged), size)
+                    self.journal_committed(merged)
                     if not self.svn.return_code:
                         mergeinfo_revisions = set()
                     break
@@ -1467,18 +4623,247 @@ class IdleMerge(object):
                         mergeinfo_revisions.union(record_only_revisions))
                     return None
             revisions_to_merge = [r for r in revisions_to_merge if r not in merged]
+            self.check_budget(revisions_to_merge, mergeinfo_revisions, record_only_revisions)
         # Whole pass completed, nothing left pending to merge
         self.save_record_only_revisions(mergeinfo_revisions)
         return None
 
+    def check_budget(self, revisions, mergeinfo_revisions, record_only_revisions):
+        """Stop the pass at this commit boundary if its budget is spent, see PassBudget()."""
+        reason = self.budget.exhausted()
+        if reason and revisions:
+            self.save_record_only_revisions(mergeinfo_revisions.union(
+                record_only_revisions.intersection(revisions)))
+            raise BudgetExhausted(reason, revisions)
+
+    def predicted_batch(self, revisions, record_only_revisions, prefetcher):
+        """Returns the leading revisions predicted to merge cleanly together, see --predict_batch.
+
+        Only revisions with content changes from the same original branch are batched, record-only
+        and urgent revisions are left to the one by one merge.
+        """
+        batch = []
+        for revision in revisions[:self.predict_batch]:
+            prefetcher.wait_for(revision)
+            if (revision in self.urgent or
+                    self.is_no_merge_revision(revision, record_only_revisions) or
+                    not [x for x in revision.summary if x.item != 'none'] or
+                    self.predictor.likely_conflict(revision)):
+                break
+            if batch and revision.original_branch != batch[0].original_branch:
+                break
+            batch.append(revision)
+        return batch
+
+    @traced('merge_batch')
+    def merge_batch(self, batch, merged_paths):
+        """Merge and commit in one go revisions predicted to merge cleanly.
+
+        Args:
+            batch: A list of Revision() instances, in merge order.
+            merged_paths: The PathTrie() of the paths merged so far in the pass, the paths of
+                the batch are added to it once committed.
+
+        Returns:
+            A boolean, False if the merge was not clean: the working copy is reset and the
+            revisions are left to merge one by one.
+        """
+        print '=====> Merging predicted clean batch: ' + revisions_as_string(batch)
+        self.run_journal.record('merge', batch)
+        clean = self.svn_merge(batch)
+        # The batch may be rolled back, its paths must not stay valid for the next merges.
+        batch_paths = self.revert_spurious_merges(batch, merged_paths.copy())
+        status = self.svn_status()
+        self.journal_dirty_paths(batch, status)
+        if not clean or status.has_conflict or not status.has_non_props_changes():
+            print '=====> Batch did not merge cleanly, isolating: ' + revisions_as_string(batch)
+            self.predictor.suspects.update(batch)
+            self.revert_pristine()
+            return False
+        commit_log = self.commit_log(batch)
+        print commit_log
+        self.journal_commit(batch, set(), commit_log, batch_paths)
+        size = status.modified_bytes()
+        if not self.commit(['-m', commit_log], status, batch_paths):
+            self.pass_stats.merged.update(batch)
+            self.budget.charge(len(batch), size)
+            merged_paths.update(batch_paths)
+        self.journal_committed(batch)
+        return True
+
+    def plan_revision(self, revision):
+        """Test-merge revision alone in the working copy and classify the outcome, see MergePlan.
+
+        The working copy is reset before and after the merge.
+
+        Returns:
+            A dict with the revision number, the outcome and the conflicted paths.
+        """
+        self.revert_pristine()
+        paths = []
+        if self.is_no_merge_revision(revision):
+            outcome = 'record_only'
+        elif not self.svn_merge(revision):
+            outcome = 'error'
+            paths = [x.strip() for x in self.svn.stderr]
+        else:
+            status = self.svn_status()
+            paths = [entry.path for entry in status.conflict_entries]
+            if paths:
+                self.resolve_conflicts(revision)
+                remaining = [entry.path for entry in self.svn_status().conflict_entries]
+                outcome = 'conflict' if remaining else 'resolvable'
+                paths = remaining or paths
+            elif status.has_non_props_changes():
+                outcome = 'clean'
+            else:
+                outcome = 'mergeinfo'
+        self.revert_pristine()
+        return {'revision': revision.number, 'outcome': outcome, 'paths': paths}
+
+    def journal_commit(self, revisions, mergeinfo_revisions, commit_log, expected_paths):
+        if not self.run_journal.enabled:
+            return
+        self.run_journal.record(
+            'commit', revisions, mergeinfo=[int(x) for x in mergeinfo_revisions],
+            message=commit_log, paths=sorted(expected_paths) if expected_paths else None,
+            base=self.info.entries_by_path[self.target].revision)
+
+    def journal_committed(self, revisions):
+        self.run_journal.record(
+            'committed', revisions, revision=committed_revision(self.svn.stdout),
+            return_code=self.svn.return_code)
+
+    def landed_revision(self, record):
+        """Returns the revision committing the merge of a journal commit record, None if none."""
+        url = self.info.entries_by_path[self.target].url
+        log_range = 'HEAD:%s' % (record.get('base') or 1)
+        self.execute_svn_command(['log', '--xml', '-r', log_range, url])
+        if self.svn.return_code:
+            raise Error('Cannot get the log of %s: %s' % (url, ''.join(self.svn.stderr)))
+        log = xml.etree.ElementTree.fromstring(''.join(self.svn.stdout))
+        for entry in log.findall('logentry'):
+            revision = Revision(xml_element=entry, svn=self.svn, branch=url)
+            data = IdleData(revision.idle_data)
+            if automerge_source(revision.msg) != self.source or not data:
+                continue
+            if (set(record['revisions']) <= set(data.revisions) and
+                    set(record['mergeinfo']) <= set(data.mergeinfo_revisions + data.revisions)):
+                return int(revision.number)
+        return None
+
+    def resume(self):
+        """Finish the commit of a pass interrupted by a crash, see RunJournal()."""
+        record = self.run_journal.interrupted()
+        if record is None:
+            return
+        print 'Resume: previous pass interrupted at %s of r%s' % (
+            record['step'], revisions_as_string(record['revisions'], ',') or '-')
+        if record['step'] != 'commit':
+            print 'Resume: no complete merge to commit, resetting the working copy'
+            return
+        revisions = record['revisions'] + record['mergeinfo']
+        landed = self.landed_revision(record)
+        if landed:
+            print 'Resume: the merge landed as r%d' % landed
+            self.run_journal.record('committed', revisions, revision=landed, recovered=True)
+            return
+        # The commit may have been killed holding the working copy locks.
+        self.execute_svn_command(['cleanup', self.target])
+        status = self.svn_status()
+        if status.has_conflict:
+            print 'Resume: the working copy has conflicts, resetting it'
+            return
+        paths = None
+        if record['paths'] is not None:
+            paths = PathTrie()
+            for path in record['paths']:
+                paths.add(path, prefix=path.endswith('/'))
+        try:
+            return_code = self.commit(['-m', record['message']], status, paths)
+        except Error as error:
+            print 'Resume: cannot commit the interrupted merge: %s' % error
+            return
+        self.journal_committed(revisions)
+        if not return_code:
+            print 'Resume: committed the interrupted merge of r%s' % revisions_as_string(revisions)
+            self.pass_stats.merged.update(
+                [Revision(number=x, svn=self.svn, branch=self.source) for x in revisions])
+
     def merge_one_by_one(self, revisions):
-        for revision in revisions:
+        for index, revision in enumerate(revisions):
+            reason = self.budget.exhausted()
+            if reason:
+                raise BudgetExhausted(reason, revisions[index:])
             if self.is_no_merge_revision(revision):
                 return_code = self.merge_record_only([revision])
             else:
                 return_code = self.svn_merge([revision])
             if return_code:
                 print 'Error %s returned when merging' % return_code
+            self.journal_dirty_paths([revision])
+            self.budget.charge(1, 0)
+
+    def journal_dirty_paths(self, revisions, status=None):
+        """Record the paths dirtied by the merge of revisions, see DirtyPathsJournal().
+
+        Args:
+            revisions: A list of Revision() instances, the revisions just merged.
+            status: A Status() instance of the target after the merge, None to get it.
+        """
+        journal = self.reset_engine.journal
+        if not journal.enabled:
+            return
+        if status is None:
+            status = self.svn_status()
+        roots = set([self.target] + [x[1] for x in self.merge_targets(self.source)])
+        journal.end(revisions, [x.path for x in status.entries if x.path not in roots], roots)
+
+    def load_cursor(self):
+        """Returns the cursor saved by the previous pass, None if there is none."""
+        if not self.cursor_filename or not os.path.exists(self.cursor_filename):
+            return None
+        try:
+            with open(self.cursor_filename, 'r') as cursor_file:
+                return json.load(cursor_file)
+        except ValueError:
+            return None
+
+    def save_cursor(self, revisions, stopped=None):
+        """Record where the pass stopped, replacing the file atomically.
+
+        Args:
+            revisions: A list of Revision() instances, the revisions left to merge.
+            stopped: A string, why the pass stopped before merging them: the exhausted budget or
+                'conflict'. None when it completed.
+        """
+        if not self.cursor_filename:
+            return
+        cursor = {
+            'source': self.source,
+            'target': self.target_label,
+            'next': int(revisions[0]) if revisions else None,
+            'pending': len(revisions),
+            'stopped': stopped,
+            'time': time.time(),
+        }
+        with open(self.cursor_filename + '.tmp', 'w') as cursor_file:
+            json.dump(cursor, cursor_file, sort_keys=True)
+        os.rename(self.cursor_filename + '.tmp', self.cursor_filename)
+
+    def save_conflict_report(self, conflict):
+        """Store the report of the conflict blocking the pair, None to remove a stale one."""
+        for filename, report_format in ((self.conflict_report, 'json'),
+                                        (self.conflict_html, 'html')):
+            if not filename:
+                continue
+            if conflict is None:
+                if os.path.exists(filename):
+                    os.remove(filename)
+                continue
+            with open(filename + '.tmp', 'w') as report_file:
+                conflict.write(report_file, report_format)
+            os.rename(filename + '.tmp', filename)
 
     def load_record_only_revisions(self):
         if not self.record_only_filename or not os.path.exists(self.record_only_filename):
@@ -1500,19 +4885,43 @@ class IdleMerge(object):
         with open(self.record_only_filename, 'w') as records_file:
             print >> records_file, revisions_as_string(revisions, ',')
 
+    @traced('pass')
     def launch_merge(self):
         """launch the merge
 
         Returns:
             A boolean - true if everything went fine or false if manual merge to be done.
         """
+        self.pass_stats = PassStats(self.tracer)
+        try:
+            return self._launch_merge()
+        finally:
+            self.pass_stats.finish(self.tracer)
 
+    def _launch_merge(self):
+        self._info = None
+        self._reset_engine = None
+        self.budget.start()
+        self.no_merge_rules.reload()
+        self.resume()
+        self.run_journal.start()
+        cursor = self.load_cursor()
+        if cursor and cursor.get('stopped') not in (None, 'conflict'):
+            print 'Previous pass stopped on its budget (%s) at r%s' % (
+                cursor['stopped'], cursor['next'])
         self.revert_pristine()
         revisions = self.get_eligible_revisions()
+        self.pass_stats.eligible = revisions
+        revisions = self.prioritize(revisions)
         print >> self._stdout, 'Merging %s revisions ...' % len(revisions)
+        if self.targeted_update and revisions and not self.shards:
+            if self.update_for(revisions):
+                raise Error('Failed to update the working copy !')
 
         try:
-            if self.single:
+            if self.single and self.concise and self.shards:
+                ShardedMerge(self, self.shards).run(revisions)
+            elif self.single:
                 if self.concise:
                     self.merge_one_by_one_concise(revisions, self.commit_mergeinfo)
                 else:
@@ -1520,29 +4929,805 @@ class IdleMerge(object):
             else:
                 raise Error('Not implemented')
         except Conflict as conflict:
+            self.pass_stats.conflict = conflict
             print str(conflict)
             self.save_record_only_revisions(conflict.mergeinfos)
+            self.save_cursor(self.pass_stats.pending, 'conflict')
+            self.save_conflict_report(conflict)
             self.mail_handler.email_conflict(conflict)
+            self.run_journal.record('done', conflict=conflict.revision.number)
+            return 1
+        except BudgetExhausted as stop:
+            self.pass_stats.budget_stop = stop.reason
+            print str(stop)
+            self.save_cursor(stop.revisions, stop.reason)
+            self.run_journal.record('done', budget=stop.reason)
+            return 0
+        except UnexpectedModifications as refused:
+            print str(refused)
+            self.save_cursor(self.pass_stats.pending, 'unexpected')
+            self.run_journal.record('done', unexpected=refused.paths)
             return 1
+        self.save_cursor(self.pass_stats.pending)
+        self.mail_handler.conflict_cleared(self.source, self.target)
+        self.save_conflict_report(None)
+        self.run_journal.record('done')
         print 'Done merging'
         return 0
 
+    def report_trace(self):
+        """Print the timing summary of the run and close the trace file."""
+        if self.tracer.filename or self.verbose:
+            print self.tracer.summary()
+        self.tracer.close()
+        if self.svn.recorder is not None:
+            self.svn.recorder.close()
+        if self.profiler is not None:
+            print 'Profiles written to: %s' % ' '.join(self.profiler.write())
+
+
+class PassBudget(object):
+    """Limits of a merge pass, so that a big backlog does not starve the other pairs of the host.
+
+    The merge loops charge each commit and stop at the first commit boundary past a limit, the
+    next pass picks up the remaining revisions from svn:mergeinfo.
+
+    Args:
+        revisions: An integer, the number of revisions to merge, 0 for no limit.
+        seconds: A number, the duration of the pass, 0 for no limit.
+        size: An integer, the bytes of changed files to commit, 0 for no limit.
+    """
+
+    def __init__(self, revisions=0, seconds=0, size=0):
+        self.revisions = revisions
+        self.seconds = seconds
+        self.size = size
+        self.start()
+
+    def start(self):
+        self.started = time.time()
+        self.merged = 0
+        self.bytes = 0
+
+    def charge(self, revisions, size):
+        """Account a commit of revisions changing files of size bytes."""
+        self.merged += revisions
+        self.bytes += size
+
+    def exhausted(self):
+        """Returns a string naming the exhausted limit, None while within all of them."""
+        if self.revisions and self.merged >= self.revisions:
+            return '--max %d' % self.revisions
+        if self.seconds and time.time() - self.started >= self.seconds:
+            return '--max_seconds %d' % self.seconds
+        if self.size and self.bytes >= self.size:
+            return '--max_bytes %d' % self.size
+        return None
+
+
+class PassStats(object):
+    """Statistics of a merge pass, for the metrics."""
+
+    def __init__(self, tracer):
+        self.start = time.time()
+        self.end = None
+        self.eligible = []
+        self.merged = set()
+        self.conflict = None
+        self.budget_stop = None
+        self._commands_before = dict(tracer.commands)
+        self.svn_commands = {}
+
+    def finish(self, tracer):
+        self.end = time.time()
+        for subcommand, totals in tracer.commands.items():
+            count = totals[0] - self._commands_before.get(subcommand, (0,))[0]
+            if count:
+                self.svn_commands[subcommand] = count
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    @property
+    def pending(self):
+        return [r for r in self.eligible if r not in self.merged]
+
+
+class MetricsExporter(object):
+    """Prometheus metrics of the merge queue health, per source/target pair.
+
+    The metrics are written after each pass to a node exporter textfile, and served on
+    /metrics by the daemon mode when a port is set. The time since a conflict is blocking is
+    kept across runs by reading back the previous textfile.
+
+    Args:
+        filename: A string, the textfile to write, usually ending with .prom. Optional.
+    """
+    METRICS = (
+        ('idlemerge_lock_wait_seconds', 'gauge', 'Time waited for the working copy lock.'),
+        ('idlemerge_eligible_revisions', 'gauge', 'Revisions eligible at the start of the pass.'),
+        ('idlemerge_pending_revisions', 'gauge', 'Revisions still pending after the pass.'),
+        ('idlemerge_oldest_pending_age_seconds', 'gauge',
+         'Age of the oldest revision still pending after the pass.'),
+        ('idlemerge_conflict_blocking', 'gauge', '1 if a conflict blocks the merge queue.'),
+        ('idlemerge_conflict_revision', 'gauge', 'Revision blocking the queue, 0 if none.'),
+        ('idlemerge_conflict_since_timestamp_seconds', 'gauge',
+         'When the blocking conflict was first seen, 0 if none.'),
+        ('idlemerge_conflict_blocking_seconds', 'gauge', 'For how long the conflict is blocking.'),
+        ('idlemerge_pass_merged_revisions', 'gauge', 'Revisions merged by the last pass.'),
+        ('idlemerge_pass_duration_seconds', 'gauge', 'Duration of the last pass.'),
+        ('idlemerge_pass_success', 'gauge', '1 if the last pass completed without error.'),
+        ('idlemerge_pass_budget_exhausted', 'gauge', '1 if the last pass stopped on its budget.'),
+        ('idlemerge_last_pass_timestamp_seconds', 'gauge', 'When the last pass ended.'),
+        ('idlemerge_pass_svn_commands', 'gauge', 'svn commands run by the last pass.'),
+    )
+    SAMPLE_RE = re.compile(r'^(\w+)\{(.*)\} (\S+)$')
+    LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._samples = {}
+        self._lock = threading.Lock()
+        self._conflicts = None
+
+    @staticmethod
+    def _labels(labels):
+        return ','.join(['%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                         for key, value in sorted(labels.items())])
+
+    def _previous_conflicts(self):
+        """Read the conflicts from the previous textfile, (source, target) -> (revision, since)."""
+        conflicts = {}
+        if not self.filename or not os.path.exists(self.filename):
+            return conflicts
+        values = {}
+        with open(self.filename, 'r') as metrics_file:
+            for line in metrics_file:
+                match = self.SAMPLE_RE.match(line.strip())
+                if not match:
+                    continue
+                name, labels, value = match.groups()
+                labels = dict(self.LABEL_RE.findall(labels))
+                key = (labels.get('source'), labels.get('target'))
+                values.setdefault(key, {})[name] = float(value)
+        for key, samples in values.items():
+            revision = int(samples.get('idlemerge_conflict_revision', 0))
+            since = samples.get('idlemerge_conflict_since_timestamp_seconds', 0)
+            if revision and since:
+                conflicts[key] = (revision, since)
+        return conflicts
+
+    def update(self, idlemerge, success=True):
+        """Record the metrics of the last pass of idlemerge and write the textfile."""
+        stats = idlemerge.pass_stats
+        pair = (idlemerge.source, idlemerge.target_label)
+        if self._conflicts is None:
+            self._conflicts = self._previous_conflicts()
+        now = time.time()
+        labels = {'source': pair[0], 'target': pair[1]}
+        conflict_revision = stats.conflict.revision.number if stats.conflict else 0
+        if conflict_revision:
+            previous, since = self._conflicts.get(pair, (None, None))
+            if previous != conflict_revision:
+                since = now
+            self._conflicts[pair] = (conflict_revision, since)
+        else:
+            self._conflicts.pop(pair, None)
+            since = 0
+        pending = stats.pending
+        oldest_age = 0
+        if pending and pending[0].date:
+            oldest_age = now - calendar.timegm(pending[0].date.timetuple())
+        samples = [
+            ('idlemerge_lock_wait_seconds', labels, idlemerge.lock_wait),
+            ('idlemerge_eligible_revisions', labels, len(stats.eligible)),
+            ('idlemerge_pending_revisions', labels, len(pending)),
+            ('idlemerge_oldest_pending_age_seconds', labels, oldest_age),
+            ('idlemerge_conflict_blocking', labels, 1 if conflict_revision else 0),
+            ('idlemerge_conflict_revision', labels, conflict_revision),
+            ('idlemerge_conflict_since_timestamp_seconds', labels, since),
+            ('idlemerge_conflict_blocking_seconds', labels, now - since if since else 0),
+            ('idlemerge_pass_merged_revisions', labels, len(stats.merged)),
+            ('idlemerge_pass_duration_seconds', labels, stats.duration),
+            ('idlemerge_pass_success', labels, 1 if success else 0),
+            ('idlemerge_pass_budget_exhausted', labels, 1 if stats.budget_stop else 0),
+            ('idlemerge_last_pass_timestamp_seconds', labels, now),
+        ]
+        for subcommand, count in sorted(stats.svn_commands.items()):
+            command_labels = dict(labels)
+            command_labels['subcommand'] = subcommand
+            samples.append(('idlemerge_pass_svn_commands', command_labels, count))
+        with self._lock:
+            self._samples[pair] = samples
+        self.write()
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            samples = []
+            for pair in sorted(self._samples):
+                samples.extend(self._samples[pair])
+        lines = []
+        for name, metric_type, description in self.METRICS:
+            metric_samples = [x for x in samples if x[0] == name]
+            if not metric_samples:
+                continue
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for _, labels, value in metric_samples:
+                lines.append('%s{%s} %s' % (name, self._labels(labels), repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        if not self.filename:
+            return
+        with open(self.filename + '.tmp', 'w') as metrics_file:
+            metrics_file.write(self.render())
+        os.rename(self.filename + '.tmp', self.filename)
+
+    def serve(self, port):
+        """Serve the metrics on http://:port/metrics from a background thread."""
+        exporter = self
+
+        class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_GET(self):   # pylint: disable=C0103
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.render()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('', port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, name='idlemerge-metrics')
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+class RunLock(object):
+    """Exclusive flock of a working copy by an idlemerge run.
+
+    The lock file holds the pid, host, pair and start time of its holder, for the runs finding
+    it locked. The lock itself dies with its holder, a lock file left with content by a killed
+    run is reported as stale and taken over.
+
+    Policies when the working copy is locked:
+        skip: give up this run.
+        queue: wait for the lock, unless another run already waits.
+        signal: ask the holder, with SIGUSR1, to run one more pass once done, then give up.
+
+    Pairs sharing a lock file take turns: a daemon only holds the lock during its passes.
+
+    Args:
+        filename: A string, the lock file, a second filename.queue file is used to queue.
+        label: A string, the pair merged by this run.
+        policy: A string, one of POLICIES but 'none'.
+        timeout: A number of seconds to wait for the lock with the queue policy, None to wait as
+            long as needed.
+    """
+    POLICIES = ('none', 'skip', 'queue', 'signal')
+
+    def __init__(self, filename, label='', policy='skip', timeout=None):
+        self.filename = filename
+        self.label = label
+        self.policy = policy
+        self.timeout = timeout
+        self.wait = 0.0
+        self._file = None
+
+    @staticmethod
+    def default_filename(target):
+        """Returns idlemerge.lock in the .svn directory of the working copy holding target.
+
+        Since svn 1.7 only the root of a working copy has a .svn directory, look for it upwards.
+        """
+        path = os.path.abspath(target)
+        while True:
+            if os.path.isdir(os.path.join(path, '.svn')):
+                return os.path.join(path, '.svn', 'idlemerge.lock')
+            parent = os.path.dirname(path)
+            if parent == path:
+                raise Error('No .svn directory found above %s, use --lock_file' % target)
+            path = parent
+
+    @staticmethod
+    def _flock(lock_file, blocking=False):
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except IOError as error:
+            if error.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        return True
+
+    def holder(self):
+        """Returns the dict describing the holder from the lock file, None if unknown."""
+        try:
+            with open(self.filename, 'r') as lock_file:
+                return json.loads(lock_file.read() or 'null')
+        except (IOError, ValueError):
+            return None
+
+    def describe(self, holder):
+        if not holder:
+            return 'an unknown run'
+        return 'pid %s on %s merging %s since %s' % (
+            holder.get('pid'), holder.get('host'), holder.get('label'),
+            format_duration(time.time() - holder.get('start', time.time())) + ' ago')
+
+    def _take(self, lock_file):
+        previous = self.holder()
+        if previous:
+            print 'Lock: taking over the stale lock of %s' % self.describe(previous)
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(json.dumps({
+            'pid': os.getpid(), 'host': os.uname()[1], 'label': self.label,
+            'start': time.time(), 'signal': True}))
+        lock_file.flush()
+        self._file = lock_file
+
+    def acquire(self):
+        """Lock the working copy following the policy.
+
+        Returns:
+            A boolean, True if the lock is held, False if the run must give up.
+        """
+        policy = self.policy
+        timeout = self.timeout
+        self.wait = 0.0
+        start = time.time()
+        lock_file = open(self.filename, 'a+')
+        if self._flock(lock_file):
+            self._take(lock_file)
+            return True
+        holder = self.holder()
+        if policy == 'signal' and holder and holder.get('signal') and (
+                holder.get('host') == os.uname()[1]):
+            print 'Lock: held by %s, asking it for another pass' % self.describe(holder)
+            try:
+                os.kill(int(holder['pid']), signal.SIGUSR1)
+            except OSError as error:
+                print 'Lock: cannot signal pid %s: %s' % (holder['pid'], error)
+            lock_file.close()
+            return False
+        if policy != 'queue':
+            print 'Lock: held by %s, skipping this run' % self.describe(holder)
+            lock_file.close()
+            return False
+        queue_file = open(self.filename + '.queue', 'a+')
+        try:
+            if not self._flock(queue_file):
+                print 'Lock: held by %s and a run is already queued, skipping' % (
+                    self.describe(holder))
+                lock_file.close()
+                return False
+            print 'Lock: held by %s, queued behind it' % self.describe(holder)
+            while not self._flock(lock_file):
+                if timeout is not None and time.time() - start > timeout:
+                    print 'Lock: gave up waiting after %s' % format_duration(timeout)
+                    lock_file.close()
+                    return False
+                time.sleep(0.5)
+        finally:
+            queue_file.close()
+        self.wait = time.time() - start
+        self._take(lock_file)
+        return True
+
+    def release(self):
+        if self._file is None:
+            return
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.close()
+        self._file = None
 
-def extract_additional_patterns(patterns_string):
-    if patterns_string:
-        return [x.strip() for x in patterns_string.split(',') if x.strip()]
 
-    patterns = []
-    patterns_filepath = 'patterns.txt' # if not options.patternsFile else options.patternsFile
-    if not os.path.exists(patterns_filepath):
-        return
-    patterns_file = open(patterns_filepath)
-    for line in patterns_file:
-        pattern = line.strip()
-        if not pattern or pattern.startswith('#'):
+def acquire_lock(idlemerge, lock):
+    """Returns True once lock is acquired for a pass, False if the pass must be skipped."""
+    with idlemerge.tracer.phase('lock_wait'):
+        locked = lock.acquire()
+    idlemerge.lock_wait = lock.wait
+    return locked
+
+
+def run_daemon(idlemerge, interval, exporter, lock=None):
+    """Run a merge pass every interval seconds, forever.
+
+    A pass stopped by its budget is followed by the next one right away, after giving the runs
+    queued on the lock their turn, so that pairs sharing a lock file are merged round-robin.
+    """
+    while True:
+        if lock is not None and not acquire_lock(idlemerge, lock):
+            time.sleep(interval)
             continue
-        patterns.append(pattern)
-    return patterns
+        success = False
+        try:
+            idlemerge.launch_merge()
+            success = True
+        except Error as error:
+            print 'Merge pass failed: %s' % error
+        finally:
+            idlemerge.report_trace()
+            if lock is not None:
+                lock.release()
+        exporter.update(idlemerge, success)
+        if idlemerge.pass_stats.budget_stop:
+            # Long enough for a queued run polling the lock to take it.
+            delay = 1 if lock is not None else 0
+        else:
+            delay = max(0, interval - idlemerge.pass_stats.duration)
+        deadline = time.time() + delay
+        while time.time() < deadline and not idlemerge.extend_requested:
+            time.sleep(min(1, deadline - time.time()))
+        idlemerge.extend_requested = False
+
+
+class Shard(object):
+    """Sparse working copy of the target holding a group of top level directories.
+
+    Args:
+        name: A string, the name of the shard.
+        directories: A list of strings, the top level directories of the branch in the shard.
+        path: A string, the path to the sparse working copy.
+    """
+
+    def __init__(self, name, directories, path):
+        self.name = name
+        self.directories = list(directories)
+        self.path = path
+
+    def __repr__(self):
+        return 'Shard(%r, %r)' % (self.name, self.directories)
+
+    def checkout(self, svn, url):
+        """Create the sparse working copy if it does not exist yet."""
+        if os.path.exists(os.path.join(self.path, '.svn')):
+            return
+        print 'Checking out shard %s of %s in %s' % (self.name, url, self.path)
+        if svn.run(['checkout', '--ignore-externals', '--depth', 'empty', url, self.path]):
+            raise Error('Failed to checkout shard %s: %s' % (self.name, ''.join(svn.stderr)))
+        for directory in self.directories:
+            if svn.run(['update', '--ignore-externals', '--set-depth', 'infinity',
+                        os.path.join(self.path, directory)]):
+                raise Error('Failed to checkout %s in shard %s: %s' % (
+                    directory, self.name, ''.join(svn.stderr)))
+
+
+def parse_shards(spec, shard_root):
+    """Parse the --shards specification.
+
+    Args:
+        spec: A string, comma separated shards, each is 'name=dir1+dir2' or a single 'dir'.
+        shard_root: A string, the directory holding the shards working copies.
+
+    Returns:
+        A list of Shard() instances.
+    """
+    shards = []
+    for shard_spec in [x.strip() for x in spec.split(',') if x.strip()]:
+        name, _, directories = shard_spec.rpartition('=')
+        directories = [x.strip().strip('/') for x in directories.split('+') if x.strip()]
+        if not name:
+            name = directories[0]
+        shards.append(Shard(name, directories, os.path.join(shard_root, name)))
+    return shards
+
+
+class ShardRouter(object):
+    """Route revisions to the shard covering all of their paths."""
+
+    def __init__(self, idlemerge, shards):
+        self.idlemerge = idlemerge
+        self._by_directory = {}
+        for shard in shards:
+            for directory in shard.directories:
+                self._by_directory[directory] = shard
+
+    def route(self, revision):
+        """Returns the Shard() for revision, None if it must be merged in the full target."""
+        shards = set()
+        for log_path in revision.paths:
+            sub_path = self.idlemerge.get_source_sub_path(log_path.path, revision.original_branch)
+            if sub_path == log_path.path:
+                continue    # outside of the branch, or the branch root itself.
+            shard = self._by_directory.get(sub_path.split('/', 1)[0])
+            if shard is None:
+                return None
+            shards.add(shard)
+        if len(shards) != 1:
+            return None
+        return shards.pop()
+
+
+def merge_shard(task):
+    """Process pool entry point merging revisions into one shard, see ShardedMerge.
+
+    Args:
+        task: A dict, the picklable parameters built by ShardedMerge.shard_task().
+
+    Returns:
+        A dict with the shard name, the list of the revision numbers actually committed, on
+        conflict the conflicting revision number with its report and on failure the error.
+    """
+    os.chdir(task['path'])
+    # Pending mergeinfo only revisions are committed too, only committed revisions are reconciled.
+    idlemerge = IdleMerge(task['source'], noop=task['noop'], single=True, verbose=task['verbose'],
+                          commit_mergeinfo=True)
+    idlemerge.concise = True
+    idlemerge.ignore = task['ignore']
+    idlemerge.merge_subtrees = task['directories']
+    result = {'shard': task['name'], 'merged': [], 'conflict': None, 'error': None}
+    revisions = [Revision(x, idlemerge.svn, branch=task['source']) for x in task['revisions']]
+    try:
+        idlemerge.revert_pristine()
+        if idlemerge.svn_update():
+            raise Error('Failed to update shard %s: %s' % (
+                task['name'], ''.join(idlemerge.svn.stderr)))
+        idlemerge.merge_one_by_one_concise(revisions, True)
+    except Conflict as conflict:
+        result['conflict'] = conflict.revision.number
+        result['mergeinfos'] = [int(x) for x in conflict.mergeinfos or ()]
+        result['report'] = conflict.report.as_dict()
+    except Error as error:
+        result['error'] = str(error)
+    result['merged'] = sorted(int(x) for x in idlemerge.pass_stats.merged)
+    return result
+
+
+class ShardedMerge(object):
+    """Merge revisions into sparse shards of the target, in parallel when they do not overlap.
+
+    Revisions whose paths all fall into a single shard are queued for that shard. A revision
+    spanning several shards, or touching paths outside of all of them, is a barrier: the queued
+    shard revisions are merged in parallel in a process pool first, then the barrier revision is
+    merged in the full target working copy. The shards merge into each of their directories, the
+    svn:mergeinfo goes on these directories and the sparse root is never committed, so the shards
+    do not make each other out of date. After each parallel round a record-only merge of the
+    revisions the shards committed is committed at the root of the full target.
+
+    Args:
+        idlemerge: An IdleMerge() instance for the full target.
+        shards: A list of Shard() instances.
+    """
+
+    def __init__(self, idlemerge, shards):
+        self.idlemerge = idlemerge
+        self.shards = shards
+        self.router = ShardRouter(idlemerge, shards)
+
+    def shard_task(self, shard, revisions):
+        idlemerge = self.idlemerge
+        return {
+            'name': shard.name,
+            'path': os.path.abspath(shard.path),
+            'source': idlemerge.source,
+            'directories': list(shard.directories),
+            'revisions': [r.number for r in revisions],
+            'noop': idlemerge.noop,
+            'verbose': idlemerge.verbose,
+            'ignore': list(idlemerge.ignore),
+        }
+
+    def run(self, revisions):
+        idlemerge = self.idlemerge
+        url = idlemerge.info.entries_by_path[idlemerge.target].url
+        for shard in self.shards:
+            shard.checkout(idlemerge.svn, url)
+        queues = {}
+        for revision in revisions:
+            shard = self.router.route(revision)
+            if shard is not None:
+                queues.setdefault(shard, []).append(revision)
+                continue
+            self.merge_shards(queues)
+            queues = {}
+            print '=====> Merging r%s in the full target' % revision
+            idlemerge.update_for([revision])
+            idlemerge.merge_one_by_one_concise([revision], idlemerge.commit_mergeinfo)
+        self.merge_shards(queues)
+
+    def merge_shards(self, queues):
+        """Merge the queued revisions of each shard in parallel."""
+        if not queues:
+            return
+        print '=====> Merging shards in parallel: %s' % ', '.join(
+            '%s (%s)' % (shard.name, revisions_as_string(revisions))
+            for shard, revisions in sorted(queues.items(), key=lambda x: x[0].name))
+        tasks = [self.shard_task(shard, revisions) for shard, revisions in queues.items()]
+        pool = multiprocessing.Pool(processes=len(tasks))
+        try:
+            results = pool.map(merge_shard, tasks)
+        finally:
+            pool.close()
+            pool.join()
+        merged = []
+        conflict = None
+        errors = []
+        for result in results:
+            merged.extend(result['merged'])
+            if result['error']:
+                errors.append('shard %s: %s' % (result['shard'], result['error']))
+            if result['conflict'] is not None and conflict is None:
+                conflict = result
+        self.reconcile(merged)
+        if errors:
+            raise Error('Failed to merge in %s' % '; '.join(errors))
+        if conflict:
+            svn = self.idlemerge.svn
+            source = self.idlemerge.source
+            raise Conflict(
+                revision=Revision(conflict['conflict'], svn, branch=source),
+                mergeinfos=set(Revision(x, svn, branch=source) for x in conflict['mergeinfos']),
+                message='Conflict in shard %s' % conflict['shard'],
+                source=source,
+                target=[s.path for s in self.shards if s.name == conflict['shard']][0],
+                report=ConflictReport.from_dict(conflict['report']))
+
+    def reconcile(self, numbers):
+        """Record the shard merges in the svn:mergeinfo of the full target root."""
+        idlemerge = self.idlemerge
+        if not numbers or idlemerge.noop:
+            return
+        directories = []
+        for shard in self.shards:
+            directories.extend(shard.directories)
+        revisions = [Revision(x, idlemerge.svn, branch=idlemerge.source) for x in sorted(numbers)]
+        print '=====> Reconciling svn:mergeinfo at the root for %s' % revisions_as_string(revisions)
+        # Only the properties of the root and of the shard directories carry the subtree mergeinfo.
+        if idlemerge.svn_update(directories):
+            raise Error('Failed to update the target for mergeinfo reconciliation !')
+        if idlemerge.merge_record_only(revisions):
+            raise Error('Failed to record shard merges: %s' % ''.join(idlemerge.svn.stderr))
+        status = idlemerge.svn_status(['--depth', 'immediates'])
+        if idlemerge.commit(['-m', idlemerge.commit_log(mergeinfo_revisions=revisions)], status):
+            raise Error('Failed to commit the shard merges mergeinfo: %s' % ''.join(
+                idlemerge.svn.stderr))
+        idlemerge.pass_stats.merged.update(revisions)
+
+
+def plan_worker(task):
+    """Process pool entry point test-merging revisions in a scratch working copy, see MergePlanner.
+
+    Args:
+        task: A dict, the picklable parameters built by MergePlanner.task().
+
+    Returns:
+        A list of the dicts of IdleMerge.plan_revision().
+    """
+    os.chdir(task['path'])
+    idlemerge = IdleMerge(task['source'], noop=True, single=True, verbose=task['verbose'])
+    idlemerge.ignore = task['ignore']
+    idlemerge.reset_strategy = 'full'
+    idlemerge.no_merge_rules = NoMergeRules(task['rules'], task['rules_file'])
+    idlemerge.no_merge_rules.reload()
+    idlemerge.revert_pristine()
+    if idlemerge.svn_update():
+        raise Error('Failed to update the scratch working copy %s' % task['path'])
+    return [idlemerge.plan_revision(Revision(x, idlemerge.svn, branch=task['source']))
+            for x in task['revisions']]
+
+
+class MergePlan(object):
+    """Outcomes of the test merges of the eligible revisions, see MergePlanner.
+
+    Each revision is merged alone on top of the target, a revision depending on an older pending
+    one may conflict here and merge cleanly in the queue.
+
+    Args:
+        results: A list of the dicts of IdleMerge.plan_revision().
+    """
+    OUTCOMES = ('clean', 'mergeinfo', 'record_only', 'resolvable', 'conflict', 'error')
+
+    def __init__(self, results):
+        self.results = sorted(results, key=lambda x: x['revision'])
+
+    def counts(self):
+        counts = dict([(x, 0) for x in self.OUTCOMES])
+        for result in self.results:
+            counts[result['outcome']] += 1
+        return counts
+
+    def write(self, output, report_format='csv'):
+        if report_format == 'json':
+            json.dump({'counts': self.counts(), 'revisions': self.results},
+                      output, indent=2, sort_keys=True)
+            return
+        writer = csv.writer(output)
+        writer.writerow(['revision', 'outcome', 'paths'])
+        for result in self.results:
+            writer.writerow([result['revision'], result['outcome'], ' '.join(result['paths'])])
+
+    def __str__(self):
+        lines = ['%-10s %-12s %s' % ('revision', 'outcome', 'paths')]
+        for result in self.results:
+            lines.append('%-10s %-12s %s' % (
+                'r%d' % result['revision'], result['outcome'], ' '.join(result['paths'])))
+        counts = self.counts()
+        lines.append(', '.join(['%d %s' % (counts[x], x) for x in self.OUTCOMES]))
+        return '\n'.join(lines)
+
+
+class MergePlanner(object):
+    """Preview the whole merge queue without touching the target working copy.
+
+    The target is cloned into scratch working copies, hardlinked like the snapshots of
+    WorkingCopySnapshot() when possible, and the eligible revisions are spread over them. Each
+    scratch copy is updated to HEAD and test-merges its revisions one at a time in a process pool.
+
+    Args:
+        idlemerge: An IdleMerge() instance of the target.
+        workers: An integer, the number of scratch working copies.
+        scratch_root: A string, where to keep the scratch working copies for the next plans.
+            None uses a temporary directory, removed afterwards.
+    """
+
+    def __init__(self, idlemerge, workers, scratch_root=None):
+        self.idlemerge = idlemerge
+        self.workers = max(1, workers)
+        self.scratch_root = scratch_root
+
+    def prepare(self, root):
+        """Returns the paths of the scratch working copies, cloning the missing ones."""
+        paths = []
+        for index in range(self.workers):
+            path = os.path.join(root, 'plan-%d' % index)
+            if not os.path.exists(os.path.join(path, '.svn')):
+                snapshot = WorkingCopySnapshot(self.idlemerge.target, path)
+                try:
+                    snapshot.create()
+                except Error:
+                    # Hardlinks do not cross filesystems, make a real copy.
+                    snapshot.remove(path)
+                    shutil.copytree(self.idlemerge.target, path, symlinks=True)
+            paths.append(os.path.abspath(path))
+        return paths
+
+    def task(self, path, revisions):
+        idlemerge = self.idlemerge
+        return {
+            'path': path,
+            'source': idlemerge.source,
+            'revisions': [r.number for r in revisions],
+            'verbose': idlemerge.verbose,
+            'ignore': list(idlemerge.ignore),
+            'rules': idlemerge.no_merge_rules.rules,
+            'rules_file': idlemerge.no_merge_rules.filename and os.path.abspath(
+                idlemerge.no_merge_rules.filename),
+        }
+
+    def run(self):
+        """Returns the MergePlan() of the eligible revisions."""
+        revisions = self.idlemerge.get_eligible_revisions()
+        print 'Planning %d revisions in %d scratch working copies' % (
+            len(revisions), self.workers)
+        if not revisions:
+            return MergePlan([])
+        root = self.scratch_root or tempfile.mkdtemp(prefix='idlemerge-plan-')
+        try:
+            paths = self.prepare(root)
+            tasks = [self.task(path, revisions[index::len(paths)])
+                     for index, path in enumerate(paths) if revisions[index::len(paths)]]
+            pool = multiprocessing.Pool(processes=len(tasks))
+            try:
+                results = pool.map(plan_worker, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            if not self.scratch_root:
+                shutil.rmtree(root, ignore_errors=True)
+        return MergePlan([x for worker_results in results for x in worker_results])
 
 
 def main(argv):
@@ -1552,6 +5737,26 @@ def main(argv):
     except Error:
         return 1
 
+    if options.where:
+        targets = [x.strip() for x in options.index_targets.split(',') if x.strip()]
+        merge_index = MergeIndex(SvnWrapper(verbose=options.verbose), targets, options.cache_dir)
+        merge_index.update()
+        lines = merge_index.where(options.where)
+        print '\n'.join(lines) if lines else 'r%d has not been merged by idlemerge' % options.where
+        return 0
+    if options.latency_report:
+        start, _, end = options.report_range.partition(':')
+        report = LatencyReport(
+            SvnWrapper(verbose=options.verbose),
+            [x.strip() for x in options.latency_report.split(',') if x.strip()],
+            start=start or 1, end=end or 'HEAD',
+            blocked_threshold=options.blocked_threshold * 60).run()
+        print str(report)
+        if options.report_output:
+            with open(options.report_output, 'wb') as output:
+                report.write(output, options.report_format)
+        return 0
+
     commit_mergeinfo = options.commit_mergeinfo
     noop = options.noop
     single = options.single
@@ -1560,11 +5765,12 @@ def main(argv):
 
     mail_handler = MergeEmail(
         options.send_email, options.email_domain, options.default_recipients, options.from_email,
-        options.append_email_filename
+        options.append_email_filename,
+        NotificationLog(options.notify_state, options.remind_hours * 3600),
+        MailOutbox(options.smtp_host, options.mail_spool)
     )
 
     # validation_script = options.validation
-    # additional_patterns = extract_additional_patterns(options.patterns)
 
     idlemerge = IdleMerge(source_url, noop=noop, single=single, verbose=verbose,
         commit_mergeinfo=commit_mergeinfo)
@@ -1572,7 +5778,99 @@ def main(argv):
     idlemerge.record_only_filename = options.record_only_filename
     idlemerge.mail_handler = mail_handler
     idlemerge.ignore = options.ignore.split(',') if options.ignore else ()
-    return idlemerge.launch_merge()
+    idlemerge.lookahead = options.lookahead
+    idlemerge.reset_strategy = options.reset
+    idlemerge.dirty_journal = options.dirty_journal
+    idlemerge.snapshot_dir = options.snapshot_dir
+    idlemerge.targeted_update = options.targeted_update
+    idlemerge.tracer.filename = options.trace
+    idlemerge.local_eligible = options.local_eligible
+    idlemerge.verify_eligible = options.verify_eligible
+    idlemerge.cache_dir = options.cache_dir
+    idlemerge.run_journal = RunJournal(options.run_journal)
+    idlemerge.budget = PassBudget(options.max, options.max_seconds, options.max_bytes)
+    idlemerge.cursor_filename = options.cursor_file
+    idlemerge.conflict_report = options.conflict_report
+    idlemerge.conflict_html = options.conflict_html
+    idlemerge.predict_batch = options.predict_batch
+    idlemerge.no_merge_rules = NoMergeRules(
+        list(DEFAULT_NO_MERGE_PATTERNS) + [
+            x.strip() for x in (options.patterns or '').split(',') if x.strip()],
+        options.rules_file)
+    idlemerge.priority = PriorityRules(
+        *[[x.strip() for x in (value or '').split(',') if x.strip()] for value in (
+            options.urgent_markers, options.urgent_authors, options.urgent_paths)])
+    if options.shards:
+        idlemerge.shards = parse_shards(options.shards, options.shard_root)
+    if options.record or options.replay:
+        redactor = Redactor([tuple(x.split('=', 1)) for x in options.redact if '=' in x])
+        if options.replay:
+            idlemerge.svn.backend = SvnReplay(options.replay, redactor)
+            # The replayed working copy does not exist, run in a scratch directory.
+            os.chdir(tempfile.mkdtemp(prefix='idlemerge-replay-'))
+            redactor.substitutions[-1] = (os.getcwd(), Redactor.CWD)
+        else:
+            idlemerge.svn.recorder = SvnRecorder(options.record, redactor)
+    if options.profile:
+        idlemerge.profiler = Profiler(options.profile, idlemerge.tracer.run_id, '%s-%s' % (
+            idlemerge.source, idlemerge.target))
+        idlemerge.tracer.listeners.append(idlemerge.profiler)
+        idlemerge.profiler.start()
+    if options.plan:
+        plan = MergePlanner(idlemerge, options.plan, options.plan_dir).run()
+        print str(plan)
+        if options.report_output:
+            with open(options.report_output, 'wb') as output:
+                plan.write(output, options.report_format)
+        return 0
+    if options.lock_policy not in RunLock.POLICIES:
+        print 'Unknown --lock_policy %s, use one of: %s' % (
+            options.lock_policy, ', '.join(RunLock.POLICIES))
+        return 1
+    lock = None
+    if options.lock_policy != 'none':
+        try:
+            lock_file = options.lock_file or RunLock.default_filename(idlemerge.target)
+        except Error as error:
+            print 'Error: %s' % error
+            return 1
+        lock = RunLock(lock_file, '%s-%s' % (idlemerge.source, idlemerge.target),
+                       options.lock_policy, options.lock_timeout)
+
+        def extend(*_):
+            idlemerge.extend_requested = True
+        signal.signal(signal.SIGUSR1, extend)
+        # Restart the system calls of the svn commands instead of failing them.
+        signal.siginterrupt(signal.SIGUSR1, False)
+    exporter = MetricsExporter(options.metrics_file)
+    if options.daemon:
+        if options.metrics_port:
+            exporter.serve(options.metrics_port)
+        run_daemon(idlemerge, options.daemon, exporter, lock)
+    if lock is not None and not acquire_lock(idlemerge, lock):
+        return 0
+    try:
+        return run_passes(idlemerge, options, exporter)
+    finally:
+        if lock is not None:
+            lock.release()
+
+
+def run_passes(idlemerge, options, exporter):
+    """Run the merge passes of main() once the working copy is locked."""
+    while True:
+        success = False
+        try:
+            return_code = idlemerge.launch_merge()
+            success = True
+        finally:
+            idlemerge.report_trace()
+            if options.metrics_file:
+                exporter.update(idlemerge, success)
+        if not idlemerge.extend_requested:
+            return return_code
+        print 'Another pass was requested while merging'
+        idlemerge.extend_requested = False
 
 
 if __name__ == '__main__':
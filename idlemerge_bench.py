@@ -0,0 +1,411 @@
+#!/usr/bin/env python2.6
+# Style based on: http://google-styleguide.googlecode.com/svn/trunk/pyguide.html
+# Exception: 100 characters width.
+#
+# Copyright idle-games.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Benchmarks of idlemerge against synthetic local file:// repositories.
+
+The repositories are generated with svnadmin from a seeded scenario, so two runs of the same
+scenario merge the same history. Each merge mode runs end-to-end in its own process, on a
+fresh copy of the repository, and the wall time, svn command count and peak RSS are appended
+to a JSONL results file for the regression comparison.
+
+Usage:
+    idlemerge_bench.py --scenario small --modes single,concise
+    idlemerge_bench.py --scenario medium --history 1000 --conflict_rate 0.05 --compare
+"""
+
+import hashlib
+import json
+import optparse
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+import idlemerge
+
+MODES = ('single', 'concise', 'bulk')
+
+LAYOUTS = {
+    'standard': ('trunk', 'branches/stable'),
+    'deep': ('projects/app/trunk', 'projects/app/branches/release-1.0'),
+}
+
+SCENARIOS = {
+    'small': dict(history=50, files=200, dirs=10),
+    'medium': dict(history=500, files=2000, dirs=50),
+    'large': dict(history=2000, files=20000, dirs=400),
+}
+
+
+class BenchError(idlemerge.Error):
+    """Error while building a scenario or running a benchmark."""
+
+
+def svn_call(args, cwd=None):
+    """Run a svn or svnadmin command, raise BenchError on failure."""
+    process = subprocess.Popen(
+        args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise BenchError('%s failed:\n%s' % (' '.join(args), output))
+    return output
+
+
+class Scenario(object):
+    """Parameters of a synthetic repository.
+
+    Args:
+        name: A string, the name of the scenario in the results.
+        history: An integer, the number of revisions committed on the source branch.
+        files: An integer, the number of files of the working copy.
+        dirs: An integer, the number of directories the files are spread over.
+        layout: A string, a key of LAYOUTS, where the target and source branches live.
+        conflict_rate: A float, the probability for a source revision to conflict with a
+            change of the same line on the target.
+        double_adds: A float, the probability for a source revision to add a binary file
+            also added, with another content, on the target.
+        no_merge_rate: A float, the probability for a source revision to be flagged NO_MERGE.
+        seed: An integer, the seed of the random generator.
+    """
+
+    def __init__(self, name, history=50, files=200, dirs=10, layout='standard',
+                 conflict_rate=0.0, double_adds=0.0, no_merge_rate=0.0, seed=0):
+        if layout not in LAYOUTS:
+            raise BenchError('Unknown layout %s, use one of: %s' % (
+                layout, ', '.join(sorted(LAYOUTS))))
+        self.name = name
+        self.history = history
+        self.files = files
+        self.dirs = dirs
+        self.layout = layout
+        self.conflict_rate = conflict_rate
+        self.double_adds = double_adds
+        self.no_merge_rate = no_merge_rate
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(
+            name=self.name, history=self.history, files=self.files, dirs=self.dirs,
+            layout=self.layout, conflict_rate=self.conflict_rate, double_adds=self.double_adds,
+            no_merge_rate=self.no_merge_rate, seed=self.seed)
+
+    @property
+    def key(self):
+        """A string identifying the generated repository, the name aside."""
+        params = self.as_dict()
+        del params['name']
+        return hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()[:12]
+
+    @property
+    def target_path(self):
+        return LAYOUTS[self.layout][0]
+
+    @property
+    def source_path(self):
+        return LAYOUTS[self.layout][1]
+
+
+class RepositoryBuilder(object):
+    """Generate the repository of a Scenario() with svnadmin and svn commits.
+
+    Args:
+        scenario: A Scenario() instance.
+        directory: A string, where the repository and its setup working copy are created.
+    """
+    LINES = 20
+
+    def __init__(self, scenario, directory):
+        self.scenario = scenario
+        self.directory = directory
+        self.repo = os.path.join(directory, 'repo')
+        self.wc = os.path.join(directory, 'setup-wc')
+        self.random = random.Random(scenario.seed)
+        self.paths = []
+
+    @property
+    def url(self):
+        return 'file://' + os.path.abspath(self.repo)
+
+    def commit(self, message):
+        svn_call(['svn', 'commit', '-q', '-m', message, self.wc])
+
+    def write_file(self, path, lines):
+        with open(os.path.join(self.wc, path), 'w') as text_file:
+            text_file.write('\n'.join(lines) + '\n')
+
+    def read_file(self, path):
+        with open(os.path.join(self.wc, path)) as text_file:
+            return text_file.read().splitlines()
+
+    def build(self):
+        """Create the repository, returns its url."""
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+        svn_call(['svnadmin', 'create', self.repo])
+        svn_call(['svn', 'checkout', '-q', self.url, self.wc])
+        self.import_target()
+        svn_call(['svn', 'copy', '-q', '--parents',
+                  os.path.join(self.wc, self.scenario.target_path),
+                  os.path.join(self.wc, self.scenario.source_path)])
+        self.commit('Create %s' % self.scenario.source_path)
+        for number in xrange(self.scenario.history):
+            self.commit_change(number)
+        shutil.rmtree(self.wc)
+        return self.url
+
+    def import_target(self):
+        scenario = self.scenario
+        root = os.path.join(self.wc, scenario.target_path)
+        for number in xrange(scenario.dirs):
+            os.makedirs(os.path.join(root, 'dir%04d' % number))
+        os.makedirs(os.path.join(root, 'bin'))
+        for number in xrange(scenario.files):
+            path = os.path.join('dir%04d' % (number % scenario.dirs), 'file%06d.txt' % number)
+            self.paths.append(path)
+            self.write_file(os.path.join(scenario.target_path, path), [
+                'file %d line %d' % (number, line) for line in xrange(self.LINES)])
+        svn_call(['svn', 'add', '-q', '--parents', root])
+        self.commit('Initial import')
+
+    def edit(self, branch, path, line, text):
+        path = os.path.join(branch, path)
+        lines = self.read_file(path)
+        lines[line] = text
+        self.write_file(path, lines)
+
+    def commit_change(self, number):
+        """Commit one source revision, after its conflicting target change if any."""
+        scenario = self.scenario
+        path = self.random.choice(self.paths)
+        line = self.random.randrange(self.LINES)
+        if self.random.random() < scenario.conflict_rate:
+            self.edit(scenario.target_path, path, line, 'target change %d' % number)
+            self.commit('Conflicting change %d' % number)
+        self.edit(scenario.source_path, path, line, 'source change %d' % number)
+        if self.random.random() < scenario.double_adds:
+            name = os.path.join('bin', 'blob%06d.bin' % number)
+            for branch in (scenario.target_path, scenario.source_path):
+                blob = os.path.join(self.wc, branch, name)
+                with open(blob, 'wb') as blob_file:
+                    blob_file.write(os.urandom(256))
+                svn_call(['svn', 'add', '-q', blob])
+                svn_call(['svn', 'propset', '-q', 'svn:mime-type', 'application/octet-stream',
+                          blob])
+                if branch == scenario.target_path:
+                    self.commit('Double add %d on target' % number)
+        message = 'Source change %d' % number
+        if self.random.random() < scenario.no_merge_rate:
+            message += ' NO_MERGE'
+        self.commit(message)
+
+
+def run_mode(url, scenario, mode, directory, verbose=False):
+    """Run one merge mode in a child process on a fresh copy of the repository.
+
+    Returns:
+        A dict, the measures of the run.
+    """
+    run_dir = os.path.join(directory, 'run-%s' % mode)
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    os.makedirs(run_dir)
+    repo = os.path.join(run_dir, 'repo')
+    svn_call(['svnadmin', 'hotcopy', url[len('file://'):], repo])
+    repo_url = 'file://' + os.path.abspath(repo)
+    wc = os.path.join(run_dir, 'wc')
+    svn_call(['svn', 'checkout', '-q', '%s/%s' % (repo_url, scenario.target_path), wc])
+    args = [sys.executable, os.path.abspath(__file__), '--run_one', mode,
+            '--source', '%s/%s' % (repo_url, scenario.source_path)]
+    if verbose:
+        args.append('--verbose')
+    process = subprocess.Popen(args, cwd=wc, stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    shutil.rmtree(run_dir)
+    for line in reversed(output.splitlines()):
+        if line.startswith('{'):
+            return json.loads(line)
+    raise BenchError('%s run failed with code %s:\n%s' % (mode, process.returncode, output))
+
+
+def run_one(mode, source, verbose=False):
+    """Merge source into the current directory, print the measures as a JSON line."""
+    merge = idlemerge.IdleMerge(source, noop=False, single=mode != 'bulk', verbose=verbose)
+    merge.concise = mode == 'concise'
+    merge.mail_handler = idlemerge.MergeEmail(None, None, None, None, None)
+    start = time.time()
+    status = 'ok'
+    try:
+        if merge.launch_merge():
+            status = 'conflict'
+    except idlemerge.Error as error:
+        status = str(error) or error.__class__.__name__
+    wall = time.time() - start
+    commands = sum([x[0] for x in merge.tracer.commands.values()])
+    result = dict(
+        status=status, wall=wall, svn_commands=commands,
+        svn_seconds=sum([x[1] for x in merge.tracer.commands.values()]),
+        merged=len(merge.pass_stats.merged), eligible=len(merge.pass_stats.eligible),
+        peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        peak_child_rss_kb=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    print json.dumps(result, sort_keys=True)
+
+
+def git_revision():
+    """Returns the git revision of idlemerge, None outside of a git checkout."""
+    try:
+        process = subprocess.Popen(
+            ['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    output = process.communicate()[0].strip()
+    return output if not process.returncode else None
+
+
+def load_results(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as results_file:
+        return [json.loads(line) for line in results_file if line.strip()]
+
+
+def compare_results(previous, current, tolerance):
+    """Compare the results of a benchmark to the last ones of the same scenario and mode.
+
+    Args:
+        previous: A list of dicts, the former results.
+        current: A list of dicts, the results of this benchmark.
+        tolerance: A float, the relative slowdown above which a measure regressed.
+
+    Returns:
+        A tuple (lines, regressed), the comparison table and a boolean.
+    """
+    lines = []
+    regressed = False
+    for result in current:
+        matches = [x for x in previous if x['scenario_key'] == result['scenario_key'] and
+                   x['mode'] == result['mode'] and x['status'] == result['status']]
+        if not matches:
+            lines.append('%-10s %-8s no previous result' % (result['scenario'], result['mode']))
+            continue
+        last = matches[-1]
+        for measure in ('wall', 'svn_commands', 'peak_rss_kb'):
+            before, after = last[measure], result[measure]
+            change = (after - before) / float(before) if before else 0.0
+            flag = ''
+            if change > tolerance:
+                flag = '  REGRESSION'
+                regressed = True
+            lines.append('%-10s %-8s %-12s %12.2f -> %12.2f %+7.1f%%%s' % (
+                result['scenario'], result['mode'], measure, before, after, change * 100, flag))
+    return lines, regressed
+
+
+def parse_args(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--scenario', dest='scenario', default='small',
+        help='base scenario, one of: %s. Default is small.' % ', '.join(sorted(SCENARIOS)))
+    parser.add_option('--history', dest='history', type='int',
+        help='number of revisions on the source branch.')
+    parser.add_option('--files', dest='files', type='int',
+        help='number of files of the working copy.')
+    parser.add_option('--dirs', dest='dirs', type='int',
+        help='number of directories the files are spread over.')
+    parser.add_option('--layout', dest='layout', default='standard',
+        help='branch layout, one of: %s. Default is standard.' % ', '.join(sorted(LAYOUTS)))
+    parser.add_option('--conflict_rate', dest='conflict_rate', type='float', default=0.0,
+        help='probability for a revision to conflict. Default is 0.')
+    parser.add_option('--double_adds', dest='double_adds', type='float', default=0.0,
+        help='probability for a revision to double-add a binary file. Default is 0.')
+    parser.add_option('--no_merge_rate', dest='no_merge_rate', type='float', default=0.0,
+        help='probability for a revision to be flagged NO_MERGE. Default is 0.')
+    parser.add_option('--seed', dest='seed', type='int', default=0,
+        help='seed of the repository generation. Default is 0.')
+    parser.add_option('--modes', dest='modes', default=','.join(MODES),
+        help='comma separated merge modes to run. Default is %s.' % ','.join(MODES))
+    parser.add_option('--work_dir', dest='work_dir', default='/tmp/idlemerge-bench',
+        help='directory of the generated repositories, kept across benchmarks.')
+    parser.add_option('--results', dest='results', default='idlemerge_bench.jsonl',
+        help='JSONL file to append the results to.')
+    parser.add_option('--compare', dest='compare', action='store_true', default=False,
+        help='compare with the previous results, exit with 1 on regression.')
+    parser.add_option('--tolerance', dest='tolerance', type='float', default=0.1,
+        help='relative slowdown reported as a regression. Default is 0.1.')
+    parser.add_option('--run_one', dest='run_one', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--source', dest='source', help=optparse.SUPPRESS_HELP)
+    parser.add_option('-v', '--verbose', dest='verbose', action='store_true', default=False,
+        help='verbose idlemerge runs.')
+    options, _ = parser.parse_args(argv[1:])
+    if options.scenario not in SCENARIOS:
+        parser.error('unknown scenario %s' % options.scenario)
+    modes = [x.strip() for x in options.modes.split(',') if x.strip()]
+    unknown = [x for x in modes if x not in MODES]
+    if unknown:
+        parser.error('unknown modes: %s' % ', '.join(unknown))
+    options.modes = modes
+    return options
+
+
+def main(argv):
+    options = parse_args(argv)
+    if options.run_one:
+        run_one(options.run_one, options.source, options.verbose)
+        return 0
+    params = dict(SCENARIOS[options.scenario])
+    for name in ('history', 'files', 'dirs'):
+        if getattr(options, name) is not None:
+            params[name] = getattr(options, name)
+    scenario = Scenario(
+        options.scenario, layout=options.layout, conflict_rate=options.conflict_rate,
+        double_adds=options.double_adds, no_merge_rate=options.no_merge_rate, seed=options.seed,
+        **params)
+    directory = os.path.join(options.work_dir, scenario.key)
+    builder = RepositoryBuilder(scenario, directory)
+    if os.path.isdir(builder.repo) and not os.path.exists(builder.wc):
+        url = builder.url
+    else:
+        print 'Generating the %s repository in %s ...' % (scenario.name, directory)
+        url = builder.build()
+    previous = load_results(options.results)
+    revision = git_revision()
+    current = []
+    for mode in options.modes:
+        result = run_mode(url, scenario, mode, directory, options.verbose)
+        result.update(
+            mode=mode, scenario=scenario.name, scenario_key=scenario.key,
+            params=scenario.as_dict(), revision=revision, time=time.time())
+        print '%-8s %-16s %8.2fs %6d svn commands %8d KiB peak rss (%d KiB svn)' % (
+            mode, result['status'][:16], result['wall'], result['svn_commands'],
+            result['peak_rss_kb'], result['peak_child_rss_kb'])
+        current.append(result)
+    with open(options.results, 'a') as results_file:
+        for result in current:
+            results_file.write(json.dumps(result, sort_keys=True) + '\n')
+    if options.compare:
+        lines, regressed = compare_results(previous, current, options.tolerance)
+        print '\n'.join(lines)
+        return 1 if regressed else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,941 @@
+#!/usr/bin/env python2.6
+# Style based on: http://google-styleguide.googlecode.com/svn/trunk/pyguide.html
+# Exception: 100 characters width.
+#
+# Copyright idle-games.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""In-process simulation of a Subversion repository and working copies for idlemerge.
+
+SimSvn answers the subset of the svn command line idlemerge runs: log, mergeinfo, merge (-c and
+--record-only), status and info (XML), revert, update, commit, cat, resolved, propget, cleanup
+and svnversion. It is plugged as the backend of an idlemerge SvnWrapper, so the whole merge
+logic runs unchanged against histories of any size, in seconds.
+
+The model is deliberately simple: files are tuples of lines, the working copy is never mixed
+revision and an update always brings it to HEAD. Text merges are three-way per line when the
+line counts match, anything else conflicts unless the target is unchanged.
+
+Usage:
+    idlemerge_sim.py --pairs 50 --history 10000 --conflict_rate 0.01 --passes 3
+"""
+
+import bisect
+import datetime
+import optparse
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+import xml.etree.ElementTree
+
+import idlemerge
+
+ROOT_URL = 'file:///sim'
+DIR = 'dir'
+
+# Options of the svn subcommands taking a value.
+VALUE_OPTIONS = frozenset([
+    '-r', '-c', '-m', '--accept', '--depth', '--set-depth', '--show-revs', '--targets',
+    '--username', '--password'])
+
+
+class SimError(idlemerge.Error):
+    """svn error of a simulated command, message is the svn error line."""
+
+
+class SimRevision(object):
+    """A committed revision of a SimRepository().
+
+    Args:
+        number: An integer.
+        author: A string.
+        msg: A string, the log message.
+        date: A datetime.datetime instance.
+        changes: A dict, repository path as key and (action, kind, copyfrom_path, copyfrom_rev)
+            as value, action being one of A, M or D.
+    """
+
+    def __init__(self, number, author, msg, date, changes):
+        self.number = number
+        self.author = author
+        self.msg = msg
+        self.date = date
+        self.changes = changes
+
+    def touches(self, path):
+        """Returns True if the revision changes path or anything below it."""
+        prefix = path.rstrip('/') + '/'
+        for changed in self.changes:
+            if changed == path or changed.startswith(prefix):
+                return True
+        return False
+
+
+class SimRepository(object):
+    """Versioned tree of files, directories and svn:mergeinfo properties.
+
+    Each node keeps the list of revisions it changed in, with its content at that revision: a
+    tuple of lines for files, DIR for directories and None once deleted.
+
+    Args:
+        start: A datetime.datetime instance, the date of revision 0. Each revision is a minute
+            later than the previous one.
+    """
+
+    def __init__(self, start=None):
+        self.start = start or datetime.datetime(2012, 1, 1)
+        self.uuid = str(uuid.uuid4())
+        self.revisions = [SimRevision(0, None, '', self.start, {})]
+        self._nodes = {'/': ([0], [DIR])}
+        self._paths = ['/']
+        self._mergeinfo = {}
+        self.lock = threading.RLock()
+
+    @property
+    def head(self):
+        return self.revisions[-1].number
+
+    def _history(self, table, path, revision):
+        entry = table.get(path)
+        if entry is None:
+            return None
+        index = bisect.bisect_right(entry[0], revision) - 1
+        return entry[1][index] if index >= 0 else None
+
+    def content(self, path, revision=None):
+        """Returns the content of path at revision, None if it does not exist."""
+        if revision is None:
+            revision = self.head
+        return self._history(self._nodes, path, revision)
+
+    def exists(self, path, revision=None):
+        return self.content(path, revision) is not None
+
+    def kind(self, path, revision=None):
+        content = self.content(path, revision)
+        if content is None:
+            return None
+        return 'dir' if content is DIR else 'file'
+
+    def mergeinfo(self, path, revision=None):
+        """Returns the svn:mergeinfo of path, repository path to RevisionRanges()."""
+        if revision is None:
+            revision = self.head
+        return self._history(self._mergeinfo, path, revision) or {}
+
+    def subtree(self, path, revision=None):
+        """Returns the existing paths below path, path included, in sorted order."""
+        prefix = path.rstrip('/') + '/'
+        index = bisect.bisect_left(self._paths, prefix)
+        paths = [path] if self.exists(path, revision) else []
+        while index < len(self._paths) and self._paths[index].startswith(prefix):
+            if self.exists(self._paths[index], revision):
+                paths.append(self._paths[index])
+            index += 1
+        return paths
+
+    def node_changed(self, path):
+        """Returns the last revision changing the node path itself, 0 if never."""
+        entry = self._nodes.get(path)
+        return entry[0][-1] if entry else 0
+
+    def last_changed(self, path, revision=None):
+        """Returns the last revision changing path or below, up to revision."""
+        if revision is None:
+            revision = self.head
+        for number in xrange(revision, 0, -1):
+            if self.revisions[number].touches(path):
+                return number
+        return 0
+
+    def _set(self, table, path, revision, value):
+        if path not in table:
+            table[path] = ([], [])
+            if table is self._nodes:
+                bisect.insort(self._paths, path)
+        table[path][0].append(revision)
+        table[path][1].append(value)
+
+    def commit(self, author, msg, changes=None, mergeinfo=None, copies=None):
+        """Commit a new revision.
+
+        Args:
+            author: A string.
+            msg: A string, the log message.
+            changes: A dict, repository path as key, the new content as value: a tuple of lines,
+                DIR or None to delete. Missing parent directories are added.
+            mergeinfo: A dict, repository path as key, its new svn:mergeinfo dict as value.
+            copies: A list of (source path, source revision, destination path) tuples.
+
+        Returns:
+            An integer, the new revision number.
+        """
+        with self.lock:
+            number = self.head + 1
+            summary = {}
+            for source, source_revision, destination in copies or []:
+                self._add_parents(destination, number, summary)
+                for path in self.subtree(source, source_revision):
+                    target = destination + path[len(source):]
+                    self._set(self._nodes, target, number, self.content(path, source_revision))
+                merged = self.mergeinfo(source, source_revision)
+                if merged:
+                    self._set(self._mergeinfo, destination, number, merged)
+                summary[destination] = ('A', self.kind(destination, number), source,
+                                        source_revision)
+            for path, content in sorted((changes or {}).items()):
+                existed = self.exists(path, number)
+                if content is None:
+                    if not existed:
+                        raise SimError("svn: E160013: '%s' path not found" % path)
+                    summary[path] = ('D', self.kind(path, number), None, None)
+                    for child in self.subtree(path, number):
+                        self._set(self._nodes, child, number, None)
+                    continue
+                self._add_parents(path, number, summary)
+                self._set(self._nodes, path, number, content)
+                summary[path] = ('M' if existed else 'A', 'dir' if content is DIR else 'file',
+                                 None, None)
+            for path, value in sorted((mergeinfo or {}).items()):
+                self._set(self._mergeinfo, path, number, value)
+                if path not in summary:
+                    summary[path] = ('M', 'dir', None, None)
+            self.revisions.append(SimRevision(
+                number, author, msg, self.start + datetime.timedelta(minutes=number), summary))
+            return number
+
+    def _add_parents(self, path, number, summary):
+        parent = os.path.dirname(path)
+        missing = []
+        while parent != '/' and not self.exists(parent, number):
+            missing.append(parent)
+            parent = os.path.dirname(parent)
+        for parent in reversed(missing):
+            self._set(self._nodes, parent, number, DIR)
+            summary[parent] = ('A', 'dir', None, None)
+
+    def branch_revisions(self, path):
+        """Returns the revision numbers changing path after the revision creating it."""
+        numbers = []
+        for revision in self.revisions[1:]:
+            change = revision.changes.get(path)
+            if change and change[0] == 'A':
+                numbers = []
+                continue
+            if revision.touches(path):
+                numbers.append(revision.number)
+        return numbers
+
+
+class SimWorkingCopy(object):
+    """Working copy of a SimRepository() branch, checked out at HEAD.
+
+    Paths are relative to the working copy root, '.' being the root itself.
+
+    Args:
+        repository: A SimRepository() instance.
+        path: A string, the repository path of the branch, e.g. /trunk.
+    """
+
+    def __init__(self, repository, path):
+        self.repository = repository
+        self.path = path.rstrip('/')
+        self.revision = repository.head
+        self.local = {}
+        self.copied = set()
+        self.conflicts = {}
+        self.local_mergeinfo = None
+
+    def repo_path(self, rel):
+        return self.path if rel == '.' else '%s/%s' % (self.path, rel)
+
+    def rel_path(self, repo_path):
+        return '.' if repo_path == self.path else repo_path[len(self.path) + 1:]
+
+    def content(self, rel):
+        if rel in self.local:
+            return self.local[rel]
+        return self.repository.content(self.repo_path(rel), self.revision)
+
+    def base(self, rel):
+        return self.repository.content(self.repo_path(rel), self.revision)
+
+    @property
+    def mergeinfo(self):
+        if self.local_mergeinfo is not None:
+            return self.local_mergeinfo
+        return self.repository.mergeinfo(self.path, self.revision)
+
+    @property
+    def modified(self):
+        return bool(self.local or self.conflicts or self.local_mergeinfo is not None)
+
+    def entries(self):
+        """Returns the modified paths as a sorted list of (rel, item, props, copied, tree)."""
+        entries = []
+        if self.local_mergeinfo is not None and self.local_mergeinfo != self.repository.mergeinfo(
+                self.path, self.revision):
+            entries.append(('.', 'normal', 'modified', False, None))
+        for rel in sorted(set(self.local) | set(self.conflicts)):
+            conflict = self.conflicts.get(rel)
+            tree = conflict if conflict and conflict[0] == 'tree' else None
+            if conflict and not tree:
+                item = 'conflicted'
+            elif self.content(rel) is None:
+                item = 'missing' if self.base(rel) is None else 'deleted'
+            elif self.base(rel) is None or rel in self.copied:
+                item = 'added'
+            elif rel in self.local and self.local[rel] != self.base(rel):
+                item = 'modified'
+            else:
+                item = 'normal'
+            entries.append((rel, item, 'none', rel in self.copied, tree))
+        return entries
+
+    def revert(self, rel, recursive=False):
+        """Revert rel, and its children if recursive, returns the reverted paths."""
+        prefix = '' if rel == '.' else rel + '/'
+        reverted = []
+        for table in (self.local, self.conflicts):
+            for path in table.keys():
+                if path == rel or (recursive and path.startswith(prefix)):
+                    del table[path]
+                    reverted.append(path)
+        for path in list(self.copied):
+            if path == rel or (recursive and path.startswith(prefix)):
+                self.copied.discard(path)
+        if rel == '.' and self.local_mergeinfo is not None:
+            self.local_mergeinfo = None
+            reverted.append('.')
+        return sorted(set(reverted))
+
+    def add_mergeinfo(self, source_path, number):
+        mergeinfo = dict(self.mergeinfo)
+        mergeinfo[source_path] = mergeinfo.get(source_path, idlemerge.RevisionRanges()).union(
+            idlemerge.RevisionRanges.from_revisions([number]))
+        self.local_mergeinfo = mergeinfo
+
+    def merge_revision(self, source_path, number):
+        """Merge the changes of revision number below source_path.
+
+        Returns:
+            A list of (status, rel) tuples, the svn merge notifications.
+        """
+        repository = self.repository
+        revision = repository.revisions[number]
+        prefix = source_path + '/'
+        notifications = []
+        for path, change in sorted(revision.changes.items()):
+            if not path.startswith(prefix):
+                continue
+            rel = path[len(prefix):]
+            action, kind = change[0], change[1]
+            current = self.content(rel)
+            before = repository.content(path, number - 1)
+            after = repository.content(path, number)
+            if action == 'A':
+                if current is not None:
+                    self.conflicts[rel] = ('tree', 'add', 'add', kind, path, number - 1, number)
+                    notifications.append(('   C', rel))
+                    continue
+                for child in repository.subtree(path, number):
+                    child_rel = rel + child[len(path):]
+                    self.local[child_rel] = repository.content(child, number)
+                    self.copied.add(child_rel)
+                notifications.append(('A   ', rel))
+            elif action == 'D':
+                if current is None:
+                    self.conflicts[rel] = ('tree', 'delete', 'delete', kind, path, number - 1,
+                                           number)
+                    notifications.append(('   C', rel))
+                elif current != before and current is not DIR:
+                    self.conflicts[rel] = ('tree', 'delete', 'edit', kind, path, number - 1,
+                                           number)
+                    notifications.append(('   C', rel))
+                else:
+                    for child in repository.subtree(self.repo_path(rel), self.revision):
+                        self.local[self.rel_path(child)] = None
+                    self.local[rel] = None
+                    notifications.append(('D   ', rel))
+            elif kind == 'file':
+                if current is None:
+                    self.conflicts[rel] = ('tree', 'edit', 'delete', kind, path, number - 1,
+                                           number)
+                    notifications.append(('   C', rel))
+                    continue
+                merged = merge_lines(before, after, current)
+                if merged is None:
+                    self.conflicts[rel] = ('text',)
+                    notifications.append(('C   ', rel))
+                elif merged != current:
+                    self.local[rel] = merged
+                    notifications.append(('U   ', rel))
+        self.add_mergeinfo(source_path, number)
+        notifications.append((' U  ', '.'))
+        return notifications
+
+
+def merge_lines(before, after, current):
+    """Three-way merge of tuples of lines, returns None on conflict."""
+    if current == before or current == after:
+        return after
+    if before is None or after is None or not len(before) == len(after) == len(current):
+        return None
+    merged = []
+    for base, theirs, mine in zip(before, after, current):
+        if theirs == base or mine == theirs:
+            merged.append(mine)
+        elif mine == base:
+            merged.append(theirs)
+        else:
+            return None
+    return tuple(merged)
+
+
+class SimSvn(object):
+    """SvnWrapper backend running the svn commands against a SimWorkingCopy().
+
+    Args:
+        working_copy: A SimWorkingCopy() instance, the target '.' of idlemerge.
+        author: A string, the author of the commits.
+    """
+
+    def __init__(self, working_copy, author='idlemerge'):
+        self.wc = working_copy
+        self.repository = working_copy.repository
+        self.author = author
+        self.commands = 0
+
+    def run(self, command, handle_process=True):
+        with self.repository.lock:
+            self.commands += 1
+            try:
+                stdout = self.execute(command[0], command[1:])
+                result = {'return_code': 0, 'stdout': stdout, 'stderr': []}
+            except SimError as error:
+                result = {'return_code': 1, 'stdout': [], 'stderr': [str(error) + '\n']}
+        return result if handle_process else idlemerge.ReplayProcess(result)
+
+    @staticmethod
+    def parse(args):
+        """Returns the subcommand, a dict of the options and the list of the operands."""
+        subcommand = idlemerge.svn_subcommand(args)
+        options = {}
+        operands = []
+        iterator = iter(args)
+        for arg in iterator:
+            if arg in VALUE_OPTIONS:
+                options[arg] = iterator.next()
+            elif arg.startswith('-'):
+                options[arg] = True
+            else:
+                operands.append(arg)
+        if subcommand in operands:
+            operands.remove(subcommand)
+        return subcommand, options, operands
+
+    def execute(self, program, args):
+        if program == 'svnversion':
+            return ['%d%s\n' % (self.wc.revision, 'M' if self.wc.modified else '')]
+        subcommand, options, operands = self.parse(args)
+        if subcommand == '--version':
+            return ['1.9.7\n' if '--quiet' in options else 'svn, version 1.9.7 (simulated)\n']
+        handler = getattr(self, 'svn_' + subcommand, None)
+        if handler is None:
+            raise SimError("svn: E205000: '%s' is not supported by the simulation" % subcommand)
+        return handler(options, operands)
+
+    def resolve(self, target):
+        """Returns ('url', repository path, peg revision) or ('wc', relative path, None)."""
+        path, _, peg = target.partition('@')
+        revision = self.revision(peg) if peg else None
+        if path.startswith('^/'):
+            return 'url', path[1:].rstrip('/') or '/', revision
+        if path.startswith(ROOT_URL):
+            return 'url', path[len(ROOT_URL):].rstrip('/') or '/', revision
+        return 'wc', os.path.normpath(path), revision
+
+    def revision(self, text):
+        if text in ('HEAD', None, ''):
+            return self.repository.head
+        if text == 'BASE':
+            return self.wc.revision
+        return int(text)
+
+    @staticmethod
+    def to_xml(element):
+        return ['<?xml version="1.0" encoding="UTF-8"?>\n',
+                xml.etree.ElementTree.tostring(element) + '\n']
+
+    def svn_info(self, options, operands):
+        root = xml.etree.ElementTree.Element('info')
+        for operand in operands or ['.']:
+            kind, path, peg = self.resolve(operand)
+            if kind == 'wc':
+                self.wc_info_entry(root, path)
+                continue
+            revision = peg or self.repository.head
+            if not self.repository.exists(path, revision):
+                raise SimError("svn: E170000: URL '%s' doesn't exist" % (ROOT_URL + path))
+            entry = xml.etree.ElementTree.SubElement(root, 'entry', {
+                'path': os.path.basename(path), 'kind': self.repository.kind(path, revision),
+                'revision': str(revision)})
+            self.common_info(entry, path, revision)
+        return self.to_xml(root)
+
+    def common_info(self, entry, path, revision):
+        xml.etree.ElementTree.SubElement(entry, 'url').text = ROOT_URL + path
+        xml.etree.ElementTree.SubElement(entry, 'relative-url').text = '^' + path
+        repository = xml.etree.ElementTree.SubElement(entry, 'repository')
+        xml.etree.ElementTree.SubElement(repository, 'root').text = ROOT_URL
+        xml.etree.ElementTree.SubElement(repository, 'uuid').text = self.repository.uuid
+        last_changed = self.repository.last_changed(path, revision)
+        commit = xml.etree.ElementTree.SubElement(entry, 'commit', {
+            'revision': str(last_changed)})
+        xml.etree.ElementTree.SubElement(commit, 'author').text = (
+            self.repository.revisions[last_changed].author or '')
+
+    def wc_info_entry(self, root, rel):
+        wc = self.wc
+        conflict = wc.conflicts.get(rel)
+        content = wc.content(rel)
+        if content is None and not conflict:
+            raise SimError("svn: E155010: The node '%s' was not found." % rel)
+        kind = 'none' if content is None else ('dir' if content is DIR else 'file')
+        entry = xml.etree.ElementTree.SubElement(root, 'entry', {
+            'path': rel, 'kind': kind, 'revision': str(wc.revision)})
+        self.common_info(entry, wc.repo_path(rel), wc.revision)
+        wc_info = xml.etree.ElementTree.SubElement(entry, 'wc-info')
+        xml.etree.ElementTree.SubElement(wc_info, 'schedule').text = 'normal'
+        xml.etree.ElementTree.SubElement(wc_info, 'depth').text = 'infinity'
+        if conflict and conflict[0] == 'tree':
+            _, action, reason, node_kind, source, left, right = conflict
+            tree = xml.etree.ElementTree.SubElement(entry, 'tree-conflict', {
+                'operation': 'merge', 'kind': node_kind, 'reason': reason, 'victim': rel,
+                'action': action})
+            for side, revision in (('source-left', left), ('source-right', right)):
+                xml.etree.ElementTree.SubElement(tree, 'version', {
+                    'side': side, 'kind': node_kind, 'path-in-repos': source.lstrip('/'),
+                    'repos-url': ROOT_URL, 'revision': str(revision)})
+
+    def status_entries(self, options, operands):
+        rels = [self.resolve(x)[1] for x in operands or ['.']]
+        depth = options.get('--depth', 'infinity')
+        selected = []
+        for entry in self.wc.entries():
+            rel = entry[0]
+            for target in rels:
+                prefix = '' if target == '.' else target + '/'
+                if rel == target:
+                    selected.append(entry)
+                    break
+                if not rel.startswith(prefix) or depth == 'empty':
+                    continue
+                if depth == 'immediates' and '/' in rel[len(prefix):]:
+                    continue
+                selected.append(entry)
+                break
+        return rels, selected
+
+    def svn_status(self, options, operands):
+        rels, entries = self.status_entries(options, operands)
+        if '--xml' not in options:
+            lines = []
+            for rel, item, props, copied, tree in entries:
+                code = {'conflicted': 'C', 'missing': '!', 'deleted': 'D', 'added': 'A',
+                        'modified': 'M'}.get(item, ' ')
+                lines.append('%s%s  %s  %s %s\n' % (
+                    code, 'M' if props == 'modified' else ' ', '+' if copied else ' ',
+                    'C' if tree else ' ', rel))
+            return lines
+        root = xml.etree.ElementTree.Element('status')
+        target = xml.etree.ElementTree.SubElement(root, 'target', {'path': rels[0]})
+        for rel, item, props, copied, tree in entries:
+            entry = xml.etree.ElementTree.SubElement(target, 'entry', {'path': rel})
+            attributes = {'item': item, 'props': props, 'revision': str(self.wc.revision)}
+            if copied:
+                attributes['copied'] = 'true'
+            if tree:
+                attributes['tree-conflicted'] = 'true'
+            xml.etree.ElementTree.SubElement(entry, 'wc-status', attributes)
+        return self.to_xml(root)
+
+    def svn_revert(self, options, operands):
+        recursive = '-R' in options or options.get('--depth') == 'infinity'
+        if '--targets' in options:
+            with open(options['--targets']) as targets_file:
+                operands = operands + [x.strip() for x in targets_file if x.strip()]
+        lines = []
+        for operand in operands:
+            for rel in self.wc.revert(self.resolve(operand)[1], recursive):
+                lines.append("Reverted '%s'\n" % rel)
+        return lines
+
+    def svn_cleanup(self, options, operands):
+        return []
+
+    def svn_resolved(self, options, operands):
+        lines = []
+        for operand in operands:
+            rel = self.resolve(operand)[1]
+            if self.wc.conflicts.pop(rel, None) is not None:
+                lines.append("Resolved conflicted state of '%s'\n" % rel)
+        return lines
+
+    def svn_update(self, options, operands):
+        # Targeted updates bring the whole working copy to HEAD, it is never mixed revision.
+        wc = self.wc
+        repository = self.repository
+        lines = ["Updating '.':\n"]
+        for number in xrange(wc.revision + 1, repository.head + 1):
+            for path in sorted(repository.revisions[number].changes):
+                if path.startswith(wc.path + '/'):
+                    lines.append('U    %s\n' % wc.rel_path(path))
+        wc.revision = repository.head
+        lines.append('At revision %d.\n' % wc.revision)
+        return lines
+
+    def svn_propget(self, options, operands):
+        if not operands or operands[0] != 'svn:mergeinfo':
+            raise SimError('svn: E200017: only svn:mergeinfo is simulated')
+        kind, path, peg = self.resolve(operands[1] if len(operands) > 1 else '.')
+        if kind == 'wc':
+            mergeinfo = self.wc.mergeinfo if path == '.' else {}
+        else:
+            mergeinfo = self.repository.mergeinfo(path, peg)
+        return ['%s:%s\n' % (x, mergeinfo[x]) for x in sorted(mergeinfo) if mergeinfo[x].ranges]
+
+    def svn_mergeinfo(self, options, operands):
+        if options.get('--show-revs') != 'eligible':
+            raise SimError('svn: E205000: only mergeinfo --show-revs eligible is simulated')
+        source = self.resolve(operands[0])[1]
+        merged = self.wc.mergeinfo.get(source, idlemerge.RevisionRanges())
+        return ['r%d\n' % x for x in self.repository.branch_revisions(source) if x not in merged]
+
+    def svn_log(self, options, operands):
+        kind, path, peg = self.resolve(operands[0])
+        if kind == 'wc':
+            path = self.wc.repo_path(path)
+        first, _, last = options.get('-r', 'HEAD:1').partition(':')
+        first, last = self.revision(first), self.revision(last or first)
+        root = xml.etree.ElementTree.Element('log')
+        numbers = range(min(first, last), min(max(first, last), self.repository.head) + 1)
+        if first > last:
+            numbers.reverse()
+        for number in numbers:
+            revision = self.repository.revisions[number]
+            if not revision.touches(path):
+                continue
+            entry = xml.etree.ElementTree.SubElement(root, 'logentry', {'revision': str(number)})
+            xml.etree.ElementTree.SubElement(entry, 'author').text = revision.author or ''
+            xml.etree.ElementTree.SubElement(entry, 'date').text = revision.date.strftime(
+                '%Y-%m-%dT%H:%M:%S.000000Z')
+            if '-v' in options:
+                paths = xml.etree.ElementTree.SubElement(entry, 'paths')
+                for changed, change in sorted(revision.changes.items()):
+                    attributes = {'action': change[0], 'kind': change[1]}
+                    if change[2]:
+                        attributes['copyfrom-path'] = change[2]
+                        attributes['copyfrom-rev'] = str(change[3])
+                    xml.etree.ElementTree.SubElement(paths, 'path', attributes).text = changed
+            if '-q' not in options:
+                xml.etree.ElementTree.SubElement(entry, 'msg').text = revision.msg
+        return self.to_xml(root)
+
+    def svn_diff(self, options, operands):
+        if '--summarize' not in options or '-c' not in options:
+            raise SimError('svn: E205000: only diff --summarize -c is simulated')
+        path = self.resolve(operands[0])[1]
+        revision = self.repository.revisions[self.revision(options['-c'])]
+        root = xml.etree.ElementTree.Element('diff')
+        paths = xml.etree.ElementTree.SubElement(root, 'paths')
+        items = {'A': 'added', 'D': 'deleted', 'M': 'modified'}
+        for changed, change in sorted(revision.changes.items()):
+            if changed != path and not changed.startswith(path + '/'):
+                continue
+            xml.etree.ElementTree.SubElement(paths, 'path', {
+                'item': items[change[0]], 'kind': change[1], 'props': 'none'}).text = (
+                    ROOT_URL + changed)
+        return self.to_xml(root)
+
+    def svn_cat(self, options, operands):
+        kind, path, peg = self.resolve(operands[0])
+        revision = self.revision(options.get('-r')) if '-r' in options else peg
+        if kind == 'wc':
+            if revision is None:
+                content = self.wc.base(path)
+            else:
+                content = self.repository.content(self.wc.repo_path(path), revision)
+        else:
+            content = self.repository.content(path, revision)
+        if content is None or content is DIR:
+            raise SimError("svn: E200009: '%s' is not a file" % operands[0])
+        return list(content)
+
+    def svn_merge(self, options, operands):
+        source, target = operands[0], operands[-1] if len(operands) > 1 else '.'
+        if self.resolve(target)[1] != '.':
+            raise SimError('svn: E205000: only merges into the working copy root are simulated')
+        source_path = self.resolve(source)[1]
+        merged = self.wc.mergeinfo.get(source_path, idlemerge.RevisionRanges())
+        numbers = sorted([int(x) for x in options['-c'].replace('r', '').split(',') if x])
+        lines = []
+        for index, number in enumerate(numbers):
+            if number in merged:
+                continue
+            lines.append("--- Merging r%d into '.':\n" % number)
+            if '--record-only' in options:
+                self.wc.add_mergeinfo(source_path, number)
+                lines.append(' U   .\n')
+                continue
+            notifications = self.wc.merge_revision(source_path, number)
+            lines.extend(['%s %s\n' % x for x in notifications])
+            conflicted = [x for x in notifications if 'C' in x[0]]
+            if conflicted and index < len(numbers) - 1:
+                raise SimError("svn: E155015: One or more conflicts were produced while merging "
+                               "r%d into '.', resolve them and rerun the merge" % number)
+        return lines
+
+    def svn_commit(self, options, operands):
+        wc = self.wc
+        rels = [self.resolve(x)[1] for x in operands]
+        if '--targets' in options:
+            with open(options['--targets']) as targets_file:
+                rels.extend([os.path.normpath(x.strip()) for x in targets_file if x.strip()])
+        if options.get('--depth') == 'empty':
+            selected = set(rels)
+            include = lambda rel: rel in selected
+        else:
+            include = lambda rel: True
+        for rel in wc.conflicts:
+            if include(rel):
+                raise SimError("svn: E155015: Aborting commit: '%s' remains in conflict" % rel)
+        changes = {}
+        lines = []
+        for rel in sorted(wc.local):
+            if not include(rel):
+                continue
+            path = wc.repo_path(rel)
+            if self.repository.node_changed(path) > wc.revision and wc.base(rel) is not None:
+                raise SimError("svn: E155011: File '%s' is out of date" % rel)
+            content = wc.local[rel]
+            if content is None:
+                if wc.base(rel) is None:
+                    continue
+                changes[path] = None
+                lines.append('Deleting       %s\n' % rel)
+            elif content != wc.base(rel):
+                changes[path] = content
+                lines.append('%s %s\n' % ('Sending       ' if wc.base(rel) is not None
+                                          else 'Adding        ', rel))
+        mergeinfo = {}
+        if include('.') and wc.local_mergeinfo is not None:
+            if wc.local_mergeinfo != self.repository.mergeinfo(wc.path, wc.revision):
+                mergeinfo[wc.path] = wc.local_mergeinfo
+                lines.insert(0, 'Sending        .\n')
+        if not changes and not mergeinfo:
+            return []
+        message = options.get('-m', '')
+        number = self.repository.commit(self.author, message, changes, mergeinfo)
+        for rel in [x for x in wc.local if include(x)]:
+            del wc.local[rel]
+            wc.copied.discard(rel)
+        if mergeinfo:
+            wc.local_mergeinfo = None
+        wc.revision = number
+        lines.append('Committed revision %d.\n' % number)
+        return lines
+
+
+class SimScenario(object):
+    """Synthetic history of pairs of branches, each /projN/branches/stable merged to /projN/trunk.
+
+    Args:
+        pairs: An integer, the number of source/target pairs.
+        history: An integer, the number of source revisions, spread over the pairs.
+        files: An integer, the number of files per branch.
+        conflict_rate: A float, the probability for a source revision to conflict with a
+            change of the same line on its target.
+        double_adds: A float, the probability for a source revision to add a file also added on
+            the target, with the same content half of the time.
+        no_merge_rate: A float, the probability for a source revision to be flagged NO_MERGE.
+        seed: An integer, the seed of the random generator.
+    """
+    LINES = 10
+
+    def __init__(self, pairs=1, history=100, files=100, conflict_rate=0.0, double_adds=0.0,
+                 no_merge_rate=0.0, seed=0):
+        self.pairs = pairs
+        self.history = history
+        self.files = files
+        self.conflict_rate = conflict_rate
+        self.double_adds = double_adds
+        self.no_merge_rate = no_merge_rate
+        self.random = random.Random(seed)
+        self.repository = SimRepository()
+
+    @staticmethod
+    def source(pair):
+        return '/proj%d/branches/stable' % pair
+
+    @staticmethod
+    def target(pair):
+        return '/proj%d/trunk' % pair
+
+    def build(self):
+        """Generate the history, returns the SimRepository()."""
+        repository = self.repository
+        for pair in xrange(self.pairs):
+            changes = {}
+            for number in xrange(self.files):
+                changes['%s/dir%d/file%d.txt' % (self.target(pair), number % 10, number)] = tuple(
+                    ['file %d line %d\n' % (number, x) for x in xrange(self.LINES)])
+            repository.commit('setup', 'Initial import of proj%d' % pair, changes)
+            repository.commit('setup', 'Create the stable branch of proj%d' % pair,
+                              copies=[(self.target(pair), repository.head, self.source(pair))])
+        for number in xrange(self.history):
+            self.commit_change(number % self.pairs, number)
+        return repository
+
+    def commit_change(self, pair, number):
+        repository = self.repository
+        file_number = self.random.randrange(self.files)
+        rel = 'dir%d/file%d.txt' % (file_number % 10, file_number)
+        line = self.random.randrange(self.LINES)
+        author = 'dev%d' % self.random.randrange(20)
+        if self.random.random() < self.conflict_rate:
+            self.edit(self.target(pair), rel, line, 'target change %d\n' % number,
+                      author, 'Conflicting change %d' % number)
+        msg = 'Source change %d' % number
+        if self.random.random() < self.no_merge_rate:
+            msg += ' NO_MERGE'
+        changes = {}
+        if self.random.random() < self.double_adds:
+            name = 'bin/blob%d.bin' % number
+            same = self.random.random() < 0.5
+            repository.commit(author, 'Double add %d' % number, {
+                '%s/%s' % (self.target(pair), name): ('blob %d\n' % number,)})
+            changes['%s/%s' % (self.source(pair), name)] = (
+                'blob %d%s\n' % (number, '' if same else ' source'),)
+        path = '%s/%s' % (self.source(pair), rel)
+        lines = list(repository.content(path))
+        lines[line] = 'source change %d\n' % number
+        changes[path] = tuple(lines)
+        repository.commit(author, msg, changes)
+
+    def edit(self, branch, rel, line, text, author, msg):
+        path = '%s/%s' % (branch, rel)
+        lines = list(self.repository.content(path))
+        lines[line] = text
+        self.repository.commit(author, msg, {path: tuple(lines)})
+
+
+def sim_idlemerge(repository, source, target, concise=True, **attributes):
+    """Returns an IdleMerge() instance merging source to target of repository.
+
+    Args:
+        repository: A SimRepository() instance.
+        source: A string, the repository path of the source branch.
+        target: A string, the repository path of the target branch.
+        concise: A boolean, see --concise.
+        attributes: Other IdleMerge() attributes to set, e.g. lookahead.
+    """
+    merge = idlemerge.IdleMerge('^' + source, noop=False, single=True)
+    merge.concise = concise
+    merge.reset_strategy = 'full'
+    merge.mail_handler = idlemerge.MergeEmail(None, None, None, None, None)
+    for name, value in attributes.items():
+        setattr(merge, name, value)
+    merge.svn.backend = SimSvn(SimWorkingCopy(repository, target))
+    return merge
+
+
+def resolve_manually(merge, revision):
+    """Simulate a developer resolving the conflict on revision by a record-only merge."""
+    backend = merge.svn.backend
+    backend.run(['svn', 'revert', '-R', '.'])
+    backend.run(['svn', 'update', '.'])
+    backend.run(['svn', 'merge', '--record-only', '-c', str(revision), merge.source, '.'])
+    backend.run(['svn', 'commit', '-m', 'Manual merge of r%s' % revision, '.'])
+
+
+def run_scenario(scenario, passes=1, concise=True, quiet=True):
+    """Run passes of idlemerge over every pair of scenario.
+
+    Returns:
+        A dict of the totals: merged and conflicts counts, svn commands, wall time.
+    """
+    repository = scenario.build()
+    totals = {'merged': 0, 'conflicts': 0, 'svn_commands': 0, 'passes': 0}
+    start = time.time()
+    stdout = sys.stdout
+    try:
+        if quiet:
+            sys.stdout = open(os.devnull, 'w')
+        merges = [sim_idlemerge(repository, scenario.source(x), scenario.target(x), concise)
+                  for x in xrange(scenario.pairs)]
+        for _ in xrange(passes):
+            for merge in merges:
+                merge.launch_merge()
+                totals['passes'] += 1
+                totals['merged'] += len(merge.pass_stats.merged)
+                if merge.pass_stats.conflict:
+                    totals['conflicts'] += 1
+                    resolve_manually(merge, merge.pass_stats.conflict.revision.number)
+    finally:
+        sys.stdout = stdout
+    totals['wall'] = time.time() - start
+    totals['svn_commands'] = sum([x.svn.backend.commands for x in merges])
+    totals['revisions'] = repository.head
+    return totals
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--pairs', dest='pairs', type='int', default=1,
+        help='number of source/target pairs. Default is 1.')
+    parser.add_option('--history', dest='history', type='int', default=1000,
+        help='number of source revisions over all pairs. Default is 1000.')
+    parser.add_option('--files', dest='files', type='int', default=100,
+        help='number of files per branch. Default is 100.')
+    parser.add_option('--conflict_rate', dest='conflict_rate', type='float', default=0.0,
+        help='probability for a revision to conflict. Default is 0.')
+    parser.add_option('--double_adds', dest='double_adds', type='float', default=0.0,
+        help='probability for a revision to double-add a file. Default is 0.')
+    parser.add_option('--no_merge_rate', dest='no_merge_rate', type='float', default=0.0,
+        help='probability for a revision to be flagged NO_MERGE. Default is 0.')
+    parser.add_option('--passes', dest='passes', type='int', default=1,
+        help='merge passes per pair, conflicts are resolved between passes. Default is 1.')
+    parser.add_option('--seed', dest='seed', type='int', default=0,
+        help='seed of the history generation. Default is 0.')
+    parser.add_option('--not_concise', dest='concise', action='store_false', default=True,
+        help='merge one by one without the concise mode.')
+    parser.add_option('-v', '--verbose', dest='verbose', action='store_true', default=False,
+        help='show the idlemerge output.')
+    options, _ = parser.parse_args(argv[1:])
+    scenario = SimScenario(
+        pairs=options.pairs, history=options.history, files=options.files,
+        conflict_rate=options.conflict_rate, double_adds=options.double_adds,
+        no_merge_rate=options.no_merge_rate, seed=options.seed)
+    totals = run_scenario(scenario, options.passes, options.concise, not options.verbose)
+    print ('%(passes)d passes over %(revisions)d revisions: %(merged)d merged, %(conflicts)d '
+           'conflicts, %(svn_commands)d svn commands in %(wall).2fs' % totals)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
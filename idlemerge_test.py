@@ -19,8 +19,21 @@
 """Unittests for idlemerge.py."""
 
 import idlemerge
+import idlemerge_bench
+import idlemerge_sim
+import gzip
+import json
 import mock
 import mox
+import os
+import pstats
+import shutil
+import signal
+import sqlite3
+import StringIO
+import sys
+import tempfile
+import time
 import unittest
 import xml.etree.ElementTree
 
@@ -188,6 +201,1271 @@ class testCommitLog(unittest.TestCase):
         self.assertEqual(expected, received)
 
 
+class testRevisionPrefetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.revisions = [mock.Mock(number=n) for n in (1, 2, 3, 4)]
+
+    def test_disabled(self):
+        prefetcher = idlemerge.RevisionPrefetcher(self.revisions, lookahead=0)
+        prefetcher.start()
+        prefetcher.wait_for(self.revisions[0])
+        prefetcher.stop()
+        self.assertFalse(self.revisions[0].prefetch.called)
+
+    def test_lookahead_window(self):
+        prefetcher = idlemerge.RevisionPrefetcher(self.revisions, lookahead=2)
+        prefetcher.start()
+        prefetcher.wait_for(self.revisions[0])
+        prefetcher.wait_for(self.revisions[1])
+        prefetcher.stop()
+        self.assertTrue(self.revisions[0].prefetch.called)
+        self.assertTrue(self.revisions[1].prefetch.called)
+        self.assertFalse(self.revisions[3].prefetch.called)
+
+    def test_prefetch_error_is_not_raised(self):
+        self.revisions[0].prefetch.side_effect = idlemerge.Error('boom')
+        prefetcher = idlemerge.RevisionPrefetcher(self.revisions, lookahead=1)
+        prefetcher.start()
+        prefetcher.wait_for(self.revisions[0])
+        prefetcher.stop()
+
+class testDirtyPathsJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.journal = idlemerge.DirtyPathsJournal(os.path.join(self.tmpdir, 'dirty'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_missing_journal_is_not_trusted(self):
+        self.assertEqual((False, set(), set()), self.journal.read())
+
+    def test_complete_merge(self):
+        self.journal.begin([1])
+        self.journal.end([1], ['foo', 'bar'], ['.'])
+        self.assertEqual((True, set(['foo', 'bar']), set(['.'])), self.journal.read())
+
+    def test_interrupted_merge(self):
+        self.journal.begin([1])
+        self.journal.end([1], ['foo'])
+        self.journal.begin([2])
+        self.assertFalse(self.journal.read()[0])
+
+    def test_clear(self):
+        self.journal.begin([1])
+        self.journal.clear()
+        self.assertEqual((True, set(), set()), self.journal.read())
+
+    def test_reset_roots_without_children(self):
+        merge = idlemerge.IdleMerge('^/foo/stable')
+        merge.execute_svn_command = mock.Mock(return_value=0)
+        merge.svn = mock.Mock(stdout=['<status/>'])
+        reset = idlemerge.WorkspaceReset(merge, 'journal', self.journal)
+        with mock.patch('os.path.lexists', return_value=True):
+            reset.reset_paths(set(['foo', 'bar']), set(['.']))
+        self.assertEqual([
+            ['revert', '--depth', 'empty', '.'],
+            ['revert', '-R', 'bar', 'foo'],
+            ['status', '--ignore-externals', '--xml', 'bar', 'foo']],
+            [x[0][0] for x in merge.execute_svn_command.call_args_list])
+
+
+class testStatusUnversioned(unittest.TestCase):
+
+    def test_unversioned_entries(self):
+        status = idlemerge.Status(xml.etree.ElementTree.fromstring(
+            '<status><target path=".">'
+            '<entry path="new"><wc-status item="unversioned" props="none"/></entry>'
+            '<entry path="foo"><wc-status item="modified" props="none"/></entry>'
+            '</target></status>'))
+        self.assertEqual(['new'], [entry.path for entry in status.unversionned])
+        self.assertTrue(status.has_non_props_changes())
+
+class testSvnOutputPaths(unittest.TestCase):
+
+    def test_updated_paths(self):
+        lines = ["Updating '.':\n", 'U    foo/bar.py\n', ' U   foo\n', 'A    new file\n',
+                 'D    gone\n', 'Updated to revision 12.\n', 'Summary of conflicts:\n',
+                 '  Text conflicts: 1\n']
+        self.assertEqual(['foo/bar.py', 'foo', 'new file', 'gone'],
+                         idlemerge.updated_paths(lines))
+
+    def test_committed_paths(self):
+        lines = ['Sending        foo/bar.py\n', 'Adding  (bin)  image.jpg\n',
+                 'Deleting       gone\n', 'Transmitting file data ..\n',
+                 'Committed revision 13.\n']
+        self.assertEqual(['foo/bar.py', 'image.jpg', 'gone'], idlemerge.committed_paths(lines))
+
+
+class testWorkingCopySnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.target = os.path.join(self.tmpdir, 'wc')
+        os.makedirs(os.path.join(self.target, '.svn', 'pristine', 'ab'))
+        os.makedirs(os.path.join(self.target, 'dir'))
+        connection = sqlite3.connect(os.path.join(self.target, '.svn', 'wc.db'))
+        connection.execute('CREATE TABLE nodes (local_relpath TEXT, checksum TEXT)')
+        connection.execute("INSERT INTO nodes VALUES ('dir/file', '$sha1$abcd')")
+        connection.commit()
+        connection.close()
+        self.write('.svn/pristine/ab/abcd.svn-base', 'clean')
+        self.write('dir/file', 'clean')
+        self.write('other', 'untouched')
+        self.snapshot = idlemerge.WorkingCopySnapshot(
+            self.target, os.path.join(self.tmpdir, 'snapshot'))
+        self.snapshot._mode = 'hardlink'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, relpath, content):
+        with open(os.path.join(self.target, relpath), 'w') as output:
+            output.write(content)
+
+    def read(self, relpath):
+        with open(os.path.join(self.target, relpath)) as data:
+            return data.read()
+
+    def test_create(self):
+        self.assertFalse(self.snapshot.exists)
+        self.snapshot.create()
+        self.assertTrue(self.snapshot.exists)
+        self.assertNotEqual(
+            os.stat(os.path.join(self.target, '.svn', 'wc.db')).st_ino,
+            os.stat(os.path.join(self.snapshot.snapshot_dir, '.svn', 'wc.db')).st_ino)
+
+    def test_restore(self):
+        self.snapshot.create()
+        os.remove(os.path.join(self.target, 'dir', 'file'))
+        self.write('dir/file', 'merged')
+        self.write('added', 'merged')
+        os.remove(os.path.join(self.target, '.svn', 'pristine', 'ab', 'abcd.svn-base'))
+        self.snapshot.restore([os.path.join(self.target, 'dir', 'file'),
+                               os.path.join(self.target, 'added')])
+        self.assertEqual('clean', self.read('dir/file'))
+        self.assertFalse(os.path.exists(os.path.join(self.target, 'added')))
+        self.assertEqual('clean', self.read('.svn/pristine/ab/abcd.svn-base'))
+
+    def test_refresh(self):
+        self.snapshot.create()
+        os.remove(os.path.join(self.target, 'dir', 'file'))
+        self.write('dir/file', 'committed')
+        self.snapshot.refresh([os.path.join(self.target, 'dir', 'file')])
+        self.assertTrue(self.snapshot.exists)
+        with open(os.path.join(self.snapshot.snapshot_dir, 'dir', 'file')) as data:
+            self.assertEqual('committed', data.read())
+
+class testUpdatePlanner(unittest.TestCase):
+
+    def revision(self, paths):
+        xml_element = xml.etree.ElementTree.fromstring(
+            '<logentry revision="3"><author>foo</author>'
+            '<date>2011-01-01T01:01:01.100000Z</date><msg>msg</msg>'
+            '<paths>%s</paths></logentry>' % paths)
+        return idlemerge.Revision(branch='^/foo/stable', xml_element=xml_element)
+
+    def test_files(self):
+        revision = self.revision(
+            '<path kind="file" action="M">/foo/stable/a/b.py</path>'
+            '<path kind="file" action="A">/foo/stable/c.py</path>'
+            '<path kind="dir" action="M">/foo/stable</path>')
+        planner = idlemerge.UpdatePlanner(idlemerge.IdleMerge('^/foo/stable'))
+        self.assertEqual(set(['a/b.py', 'c.py']), planner.plan([revision]))
+
+    def test_directory_add_requires_full_update(self):
+        revision = self.revision('<path kind="dir" action="A">/foo/stable/new</path>')
+        planner = idlemerge.UpdatePlanner(idlemerge.IdleMerge('^/foo/stable'))
+        self.assertEqual(None, planner.plan([revision]))
+
+    def test_copy_requires_full_update(self):
+        revision = self.revision(
+            '<path kind="file" action="A" copyfrom-path="/foo/stable/a.py" copyfrom-rev="2">'
+            '/foo/stable/b.py</path>')
+        planner = idlemerge.UpdatePlanner(idlemerge.IdleMerge('^/foo/stable'))
+        self.assertEqual(None, planner.plan([revision]))
+
+class testCommitTargets(unittest.TestCase):
+
+    def status(self, entries):
+        return idlemerge.Status(xml.etree.ElementTree.fromstring(
+            '<status><target path=".">%s</target></status>' % entries))
+
+    def test_modified_paths_only(self):
+        status = self.status(
+            '<entry path="."><wc-status item="normal" props="modified"/></entry>'
+            '<entry path="a.py"><wc-status item="modified" props="none"/></entry>'
+            '<entry path="b"><wc-status item="normal" props="modified"/></entry>'
+            '<entry path="junk"><wc-status item="unversioned" props="none"/></entry>')
+        idlemerge_instance = idlemerge.IdleMerge('^/foo/stable')
+        self.assertEqual(['a.py', 'b'], idlemerge_instance.commit_targets(status))
+
+    def test_unexpected_modification(self):
+        status = self.status(
+            '<entry path="a.py"><wc-status item="modified" props="none"/></entry>'
+            '<entry path="c.py"><wc-status item="modified" props="none"/></entry>')
+        idlemerge_instance = idlemerge.IdleMerge('^/foo/stable')
+        self.assertRaises(idlemerge.UnexpectedModifications, idlemerge_instance.commit_targets,
+                          status, set(['.', 'a.py']))
+
+    def test_deleted_directory_commits_recursively(self):
+        status = self.status(
+            '<entry path="a.py"><wc-status item="modified" props="none"/></entry>'
+            '<entry path="old"><wc-status item="deleted" props="none"/></entry>'
+            '<entry path="old/b.py"><wc-status item="deleted" props="none"/></entry>')
+        idlemerge_instance = idlemerge.IdleMerge('^/foo/stable')
+        self.assertEqual(None, idlemerge_instance.commit_targets(status))
+        status = self.status(
+            '<entry path="a.py"><wc-status item="modified" props="none"/></entry>'
+            '<entry path="old.py"><wc-status item="deleted" props="none"/></entry>')
+        self.assertEqual(['a.py', 'old.py'], idlemerge_instance.commit_targets(status))
+
+    def test_commit_with_depth_empty(self):
+        status = self.status('<entry path="a.py"><wc-status item="modified" props="none"/></entry>')
+        idlemerge_instance = idlemerge.IdleMerge('^/foo/stable', noop=False)
+        idlemerge_instance.svn = mock.Mock(stdout=[], return_code=0)
+        idlemerge_instance.svn.run.return_value = 0
+        idlemerge_instance.commit(['-m', 'msg'], status, set(['a.py']))
+        idlemerge_instance.svn.run.assert_called_once_with(
+            ['commit', '-m', 'msg', '--depth', 'empty', '.', 'a.py'], discard_output=False,
+            handle_process=True, bufsize=None)
+
+class testShardRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.shards = idlemerge.parse_shards('web=www+static, server', '/shards')
+        self.router = idlemerge.ShardRouter(idlemerge.IdleMerge('^/foo/stable'), self.shards)
+
+    def revision(self, *paths):
+        xml_element = xml.etree.ElementTree.fromstring(
+            '<logentry revision="3"><author>foo</author>'
+            '<date>2011-01-01T01:01:01.100000Z</date><msg>msg</msg><paths>%s</paths>'
+            '</logentry>' % ''.join(
+                ['<path kind="file" action="M">/foo/stable/%s</path>' % x for x in paths]))
+        return idlemerge.Revision(branch='^/foo/stable', xml_element=xml_element)
+
+    def test_parse_shards(self):
+        self.assertEqual(['web', 'server'], [x.name for x in self.shards])
+        self.assertEqual(['www', 'static'], self.shards[0].directories)
+        self.assertEqual('/shards/server', self.shards[1].path)
+
+    def test_single_shard(self):
+        self.assertEqual(
+            self.shards[0], self.router.route(self.revision('www/index.html', 'static/a.css')))
+
+    def test_multiple_shards(self):
+        self.assertEqual(None, self.router.route(self.revision('www/index.html', 'server/a.py')))
+
+    def test_outside_shards(self):
+        self.assertEqual(None, self.router.route(self.revision('www/index.html', 'pom.xml')))
+
+    def test_merge_into_directories(self):
+        merge = idlemerge.IdleMerge('^/foo/stable', noop=False)
+        merge.merge_subtrees = self.shards[0].directories
+        merge.execute_svn_command = mock.Mock(return_value=0)
+        merge.svn = mock.Mock(stderr=[])
+        self.assertTrue(merge.svn_merge(self.revision('www/index.html')))
+        self.assertEqual(
+            [('^/foo/stable/www@3', 'www'), ('^/foo/stable/static@3', 'static')],
+            [tuple(x[0][0][-2:]) for x in merge.execute_svn_command.call_args_list])
+
+    def test_shard_reports_committed_revisions(self):
+        def merge_one_by_one_concise(merge, revisions, commit_mergeinfo):
+            # r4 failed to commit.
+            merge.pass_stats.merged.add(revisions[0])
+        with mock.patch('os.chdir'), \
+                mock.patch('idlemerge.IdleMerge.revert_pristine'), \
+                mock.patch('idlemerge.IdleMerge.svn_update', return_value=0), \
+                mock.patch('idlemerge.IdleMerge.merge_one_by_one_concise',
+                           autospec=True, side_effect=merge_one_by_one_concise):
+            result = idlemerge.merge_shard({
+                'name': 'web', 'path': '/shards/web', 'source': '^/foo/stable',
+                'directories': ['www', 'static'], 'revisions': [3, 4], 'noop': False,
+                'verbose': False, 'ignore': []})
+        self.assertEqual([3], result['merged'])
+        self.assertEqual(None, result['error'])
+
+class testRevisionRanges(unittest.TestCase):
+
+    def test_parse(self):
+        ranges = idlemerge.RevisionRanges.parse('1-5,7,9-12*,6')
+        self.assertEqual([(1, 7)], ranges.ranges)
+        self.assertEqual('1-7', str(ranges))
+
+    def test_contains(self):
+        ranges = idlemerge.RevisionRanges([(3, 5), (10, 10)])
+        self.assertTrue(4 in ranges)
+        self.assertTrue(10 in ranges)
+        self.assertFalse(2 in ranges)
+        self.assertFalse(6 in ranges)
+
+    def test_difference(self):
+        source = idlemerge.RevisionRanges.from_revisions([1, 2, 3, 5, 8, 9, 10, 20])
+        merged = idlemerge.RevisionRanges([(2, 3), (9, 15), (18, 19)])
+        self.assertEqual([1, 5, 8, 20], list(source.difference(merged)))
+
+    def test_difference_overlapping_ranges(self):
+        source = idlemerge.RevisionRanges([(1, 100)])
+        merged = idlemerge.RevisionRanges([(10, 20), (30, 40)])
+        self.assertEqual([(1, 9), (21, 29), (41, 100)], source.difference(merged).ranges)
+
+    def test_parse_mergeinfo(self):
+        mergeinfo = idlemerge.parse_mergeinfo(
+            ['/branches/stable:1-5,7*\n', '/branches/prod:3\n'])
+        self.assertEqual([(1, 5)], mergeinfo['/branches/stable'].ranges)
+        self.assertEqual([(3, 3)], mergeinfo['/branches/prod'].ranges)
+
+    def test_repo_path(self):
+        idlemerge_instance = idlemerge.IdleMerge('^/foo/stable')
+        self.assertEqual('/foo/stable', idlemerge_instance.repo_path('^/foo/stable@12'))
+
+class testMergeIndex(unittest.TestCase):
+
+    def logentry(self, number, msg):
+        return xml.etree.ElementTree.fromstring(
+            '<logentry revision="%d"><author>_idlemerge</author>'
+            '<date>2012-02-02T02:02:02.200000Z</date><msg>%s</msg></logentry>' % (number, msg))
+
+    def test_idle_data(self):
+        revision = idlemerge.Revision(xml_element=self.logentry(
+            10, '[automerge ^/foo/stable@1] fix\n-- IDLEMERGE DATA --\n  REVISIONS=1\n'
+            '  MERGEINFO_REVISIONS=2,3\n  r1 | foo | 2011-01-01 01:01:01.100000'))
+        self.assertEqual('[automerge ^/foo/stable@1] fix', revision.msg)
+        idle_data = idlemerge.IdleData(revision.idle_data)
+        self.assertEqual([1], idle_data.revisions)
+        self.assertEqual([2, 3], idle_data.mergeinfo_revisions)
+        self.assertEqual([(1, 'foo', '2011-01-01 01:01:01.100000')], idle_data.origins)
+
+    def test_automerge_source(self):
+        self.assertEqual('^/foo/stable', idlemerge.automerge_source('[automerge ^/foo/stable@1] x'))
+        self.assertEqual('^/foo/stable', idlemerge.automerge_source(
+            '[automerge ^/foo/stable] Committing mergeinfo changes'))
+        self.assertEqual('^/foo/stable', idlemerge.automerge_source(
+            'merge revisions 1, 2 from ^/foo/stable to ^/foo/trunk'))
+        self.assertEqual(None, idlemerge.automerge_source('fix a bug'))
+
+    def test_where_follows_merges(self):
+        merge_index = idlemerge.MergeIndex(None, [])
+        merge_index._loaded = True
+        self.assertTrue(merge_index.add('^/foo/stable', self.logentry(
+            10, '[automerge ^/foo/prod@1] fix\n-- IDLEMERGE DATA --\n  REVISIONS=1')))
+        self.assertTrue(merge_index.add('^/foo/trunk', self.logentry(
+            11, '[automerge ^/foo/stable@10] fix\n-- IDLEMERGE DATA --\n  REVISIONS=10')))
+        self.assertFalse(merge_index.add('^/foo/trunk', self.logentry(12, 'manual change')))
+        self.assertEqual([
+            'r1 -> ^/foo/stable r10 at 2012-02-02T02:02:02.200000Z (merge from ^/foo/prod)',
+            '  r10 -> ^/foo/trunk r11 at 2012-02-02T02:02:02.200000Z (merge from ^/foo/stable)'],
+            merge_index.where(1))
+
+class testLatencyReport(unittest.TestCase):
+
+    def logentry(self, number, date, msg):
+        return xml.etree.ElementTree.fromstring(
+            '<logentry revision="%d"><author>_idlemerge</author><date>%s</date><msg>%s</msg>'
+            '</logentry>' % (number, date, msg))
+
+    def test_svn_date_to_epoch(self):
+        self.assertEqual(60.5, idlemerge.svn_date_to_epoch('1970-01-01T00:01:00.500000Z'))
+        self.assertEqual(60.0, idlemerge.svn_date_to_epoch('1970-01-01 00:01:00'))
+        self.assertEqual(3660.0, idlemerge.svn_date_to_epoch(
+            '1970-01-01 00:01:00 -0100 (Thu, 01 Jan 1970)'))
+        self.assertEqual(None, idlemerge.svn_date_to_epoch('yesterday'))
+
+    def test_histogram(self):
+        histogram = idlemerge.LatencyHistogram()
+        for seconds in range(1, 101):
+            histogram.add(seconds)
+        self.assertEqual(100, histogram.count)
+        self.assertTrue(45 <= histogram.percentile(50) <= 55)
+        self.assertTrue(94 <= histogram.percentile(99) <= 100)
+        self.assertEqual(100, histogram.percentile(100))
+
+    def test_hops(self):
+        report = idlemerge.LatencyReport(None, [], blocked_threshold=60)
+        report.add('^/foo/stable', self.logentry(
+            10, '2012-01-01T00:01:00.000000Z',
+            '[automerge ^/foo/prod@1] fix\n-- IDLEMERGE DATA --\n  REVISIONS=1\n'
+            '  r1 | foo | 2012-01-01 00:00:00'))
+        report.add('^/foo/trunk', self.logentry(
+            11, '2012-01-01T00:03:00.000000Z',
+            '[automerge ^/foo/stable@10] fix\n-- IDLEMERGE DATA --\n  REVISIONS=10\n'
+            '  r10 | _idlemerge | 2012-01-01 00:01:00'))
+        self.assertEqual(60, report.pairs['^/foo/prod -> ^/foo/stable'].maximum)
+        self.assertEqual(120, report.pairs['^/foo/stable -> ^/foo/trunk'].maximum)
+        self.assertEqual(180, report.hops['^/foo/trunk (2 hops)'].maximum)
+        self.assertEqual(60, report.blocked['^/foo/stable -> ^/foo/trunk'].maximum)
+        self.assertEqual([(1325376000, 0)],
+                         report.queue_depth()['^/foo/prod -> ^/foo/stable'])
+
+    def test_run_follows_hops(self):
+        repository = idlemerge_sim.SimRepository()
+        repository.commit('bob', 'import', {'/trunk/a.txt': ('a\n',)})
+        repository.commit('bob', 'branch', copies=[('/trunk', 1, '/branches/stable')])
+        repository.commit('bob', 'branch', copies=[('/branches/stable', 2, '/branches/prod')])
+        repository.commit('alice', 'fix', {'/branches/prod/a.txt': ('A\n',)})
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            for source, target in (('/branches/prod', '/branches/stable'),
+                                   ('/branches/stable', '/trunk')):
+                merge = idlemerge_sim.sim_idlemerge(repository, source, target)
+                self.assertEqual(0, merge.launch_merge())
+        finally:
+            sys.stdout = stdout
+        report = idlemerge.LatencyReport(merge.svn, ['^/branches/stable', '^/trunk']).run()
+        self.assertEqual(1, report.hops['^/trunk (2 hops)'].count)
+        self.assertEqual(1, report.hops['^/branches/stable (1 hops)'].count)
+        # The origin of r5 was consumed by its merge to trunk.
+        self.assertEqual({}, report._origins)
+
+class testRunTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'trace.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_svn_subcommand(self):
+        self.assertEqual('merge', idlemerge.svn_subcommand(
+            ['--accept', 'postpone', 'merge', '-c', '3', '^/foo/stable@3', '.']))
+        self.assertEqual('--version', idlemerge.svn_subcommand(['--version', '--quiet']))
+
+    def test_nested_phases(self):
+        tracer = idlemerge.RunTrace(self.filename, run_id='run', labels={'source': '^/foo'})
+        with tracer.phase('pass'):
+            with tracer.phase('svn_merge'):
+                tracer.record_command(['merge', '-c', '3'], 0.5, 10, 0)
+        tracer.close()
+        with open(self.filename) as trace_file:
+            records = [json.loads(line) for line in trace_file]
+        self.assertEqual(['command', 'phase', 'phase'], [x['type'] for x in records])
+        self.assertEqual('pass/svn_merge', records[0]['phase'])
+        self.assertEqual('merge', records[0]['subcommand'])
+        self.assertEqual('^/foo', records[2]['source'])
+        self.assertEqual('run', records[2]['run'])
+        self.assertEqual((1, 0.5, 10), tracer.commands['merge'])
+        self.assertTrue('pass/svn_merge' in tracer.summary())
+
+
+class testProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_phase_profiles(self):
+        tracer = idlemerge.RunTrace(run_id='run')
+        profiler = idlemerge.Profiler(self.tmpdir, tracer.run_id, '^/foo/stable-trunk', top=5)
+        tracer.listeners.append(profiler)
+        profiler.start()
+        with tracer.phase('pass'):
+            with tracer.phase('svn_status'):
+                kept = [[x] for x in range(1000)]
+        profiler.stop()
+        filenames = profiler.write()
+        self.assertEqual(
+            ['foo_stable-trunk-run.pass.pstats', 'foo_stable-trunk-run.pass.svn_status.pstats',
+             'foo_stable-trunk-run.run.pstats', 'foo_stable-trunk-run.alloc.txt'],
+            [os.path.basename(x) for x in filenames])
+        pstats.Stats(filenames[1])
+        report = profiler.allocation_report()
+        self.assertTrue('== pass/svn_status' in report)
+        self.assertTrue(kept)
+
+
+class testRecordReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'svn.jsonl.gz')
+        self.redactor = idlemerge.Redactor([('svn+ssh://secret.host', '%%HOST%%')])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_record_replay(self):
+        recorder = idlemerge.SvnRecorder(self.filename, self.redactor)
+        command = ['svn', 'info', 'svn+ssh://secret.host/foo']
+        for revision in ('3', '4'):
+            recorder.wrap(command, {
+                'return_code': 0, 'stdout': ['URL: svn+ssh://secret.host/foo\n',
+                                             'Revision: %s\n' % revision],
+                'stderr': []}, True)
+        process = mock.Mock()
+        process.stdout = StringIO.StringIO('\xff\x00binary\n')
+        process.stderr = StringIO.StringIO('')
+        process.wait.return_value = 1
+        streamed = recorder.wrap(['svn', 'cat', 'foo.bin'], process, False)
+        self.assertEqual('\xff\x00binary\n', streamed.stdout.read())
+        self.assertEqual(1, streamed.wait())
+        recorder.close()
+        with gzip.open(self.filename) as archive:
+            self.assertFalse('secret.host' in archive.read())
+
+        replay = idlemerge.SvnReplay(self.filename, self.redactor)
+        results = [replay.run(command) for _ in range(3)]
+        self.assertEqual(
+            ['Revision: 3\n', 'Revision: 4\n', 'Revision: 4\n'], [x['stdout'][1] for x in results])
+        self.assertEqual('URL: svn+ssh://secret.host/foo\n', results[0]['stdout'][0])
+        process = replay.run(['svn', 'cat', 'foo.bin'], handle_process=False)
+        self.assertEqual('\xff\x00binary\n', process.stdout.read())
+        self.assertEqual(1, process.wait())
+        self.assertRaises(idlemerge.Error, replay.run, ['svn', 'status'])
+
+    def test_replay_targets_file(self):
+        recorder = idlemerge.SvnRecorder(self.filename, self.redactor)
+        with tempfile.NamedTemporaryFile(prefix='idlemerge-targets-') as targets_file:
+            targets_file.write('a\nb\n')
+            targets_file.flush()
+            recorder.wrap(['svn', 'revert', '--targets', targets_file.name],
+                          {'return_code': 0, 'stdout': ["Reverted 'a'\n"], 'stderr': []}, True)
+        recorder.close()
+        replay = idlemerge.SvnReplay(self.filename, self.redactor)
+        with tempfile.NamedTemporaryFile(prefix='idlemerge-targets-') as targets_file:
+            targets_file.write('a\nb\n')
+            targets_file.flush()
+            result = replay.run(['svn', 'revert', '--targets', targets_file.name])
+        self.assertEqual(["Reverted 'a'\n"], result['stdout'])
+
+    def test_wrapper_replay(self):
+        recorder = idlemerge.SvnRecorder(self.filename, self.redactor)
+        recorder.wrap(['svnversion', '.'], {'return_code': 0, 'stdout': ['42\n'], 'stderr': []},
+                      True)
+        recorder.close()
+        svn = idlemerge.SvnWrapper(tracer=idlemerge.RunTrace())
+        svn.backend = idlemerge.SvnReplay(self.filename, self.redactor)
+        self.assertEqual(0, svn.run(['.'], program='svnversion'))
+        self.assertEqual(['42\n'], svn.stdout)
+        self.assertEqual(1, svn.tracer.commands['svnversion'][0])
+
+
+class testSimulation(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        self.repository = idlemerge_sim.SimRepository()
+        self.repository.commit('bob', 'import', {
+            '/trunk/a.txt': ('a\n', 'b\n', 'c\n'), '/trunk/b.txt': ('b\n',)})
+        self.repository.commit('bob', 'branch', copies=[('/trunk', 1, '/branches/stable')])
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def edit(self, path, content, msg='fix'):
+        return self.repository.commit('alice', msg, {path: content})
+
+    def merge(self):
+        merge = idlemerge_sim.sim_idlemerge(self.repository, '/branches/stable', '/trunk')
+        return merge, merge.launch_merge()
+
+    def test_clean_merges(self):
+        self.edit('/branches/stable/a.txt', ('A\n', 'b\n', 'c\n'))
+        self.edit('/trunk/a.txt', ('a\n', 'b\n', 'C\n'))
+        self.edit('/branches/stable/b.txt', ('B\n',), 'NO_MERGE')
+        merge, return_code = self.merge()
+        self.assertEqual(0, return_code)
+        # The NO_MERGE revision only changes svn:mergeinfo, it waits for a real merge.
+        self.assertEqual([3], [x.number for x in merge.pass_stats.merged])
+        self.assertEqual(('A\n', 'b\n', 'C\n'), self.repository.content('/trunk/a.txt'))
+        self.assertEqual(('b\n',), self.repository.content('/trunk/b.txt'))
+        self.assertEqual('3', str(self.repository.mergeinfo('/trunk')['/branches/stable']))
+        self.assertTrue(
+            '[automerge ^/branches/stable@3]' in self.repository.revisions[6].msg)
+
+    def test_merge_traced(self):
+        self.edit('/branches/stable/a.txt', ('A\n', 'b\n', 'c\n'))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            merge = idlemerge_sim.sim_idlemerge(self.repository, '/branches/stable', '/trunk')
+            merge.tracer.filename = os.path.join(tmpdir, 'trace.jsonl')
+            self.assertEqual(0, merge.launch_merge())
+            merge.tracer.close()
+            with open(merge.tracer.filename) as trace_file:
+                records = [json.loads(line) for line in trace_file]
+        finally:
+            shutil.rmtree(tmpdir)
+        phases = [x['phase'] for x in records if x['type'] == 'phase']
+        self.assertTrue([x for x in phases if x.endswith('svn_merge')])
+        commands = [x['args'] for x in records
+                    if x['type'] == 'command' and x['phase'].endswith('svn_merge')]
+        self.assertEqual(1, len(commands))
+        self.assertEqual('merge', idlemerge.svn_subcommand(commands[0]))
+        self.assertTrue('^/branches/stable@3' in commands[0])
+
+    def test_log_cache_per_repository(self):
+        self.edit('/branches/stable/a.txt', ('A\n', 'b\n', 'c\n'))
+        self.edit('/branches/stable/b.txt', ('B\n',))
+        other = idlemerge_sim.SimRepository()
+        other.commit('bob', 'import', {'/trunk/a.txt': ('a\n',)})
+        other.commit('bob', 'branch', copies=[('/trunk', 1, '/branches/stable')])
+        other.commit('bob', 'fix', {'/branches/stable/a.txt': ('A\n',)})
+        cache_dir = tempfile.mkdtemp()
+        try:
+            for repository, expected in ((self.repository, [3, 4]), (other, [3])):
+                merge = idlemerge_sim.sim_idlemerge(repository, '/branches/stable', '/trunk')
+                log_cache = idlemerge.LogCache(
+                    merge.svn, '^/branches/stable', '/branches/stable', cache_dir)
+                self.assertEqual(expected, list(log_cache.revisions()))
+            self.assertEqual(2, len(os.listdir(cache_dir)))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_conflict(self):
+        self.edit('/trunk/a.txt', ('x\n', 'b\n', 'c\n'))
+        self.edit('/branches/stable/a.txt', ('y\n', 'b\n', 'c\n'))
+        merge, return_code = self.merge()
+        self.assertEqual(1, return_code)
+        self.assertEqual(4, merge.pass_stats.conflict.revision.number)
+        self.assertEqual(4, self.repository.head)
+
+    def test_unexpected_modifications_stop_the_pass(self):
+        self.edit('/branches/stable/a.txt', ('A\n', 'b\n', 'c\n'))
+        with mock.patch.object(idlemerge.IdleMerge, 'commit_targets',
+                               side_effect=idlemerge.UnexpectedModifications(['b.txt'])):
+            merge, return_code = self.merge()
+        self.assertEqual(1, return_code)
+        self.assertEqual(3, self.repository.head)
+        self.assertTrue('unexpected modifications: b.txt' in sys.stdout.getvalue())
+
+    def test_conflict_report(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.edit('/trunk/a.txt', ('x\n', 'b\n', 'c\n'))
+        self.edit('/branches/stable/a.txt', ('y\n', 'b\n', 'c\n'))
+        self.edit('/branches/stable/b.txt', ('B\n',))
+        filename = os.path.join(directory, 'conflict.json')
+        merge = idlemerge_sim.sim_idlemerge(
+            self.repository, '/branches/stable', '/trunk', conflict_report=filename,
+            conflict_html=os.path.join(directory, 'conflict.html'))
+        self.assertEqual(1, merge.launch_merge())
+        with open(filename) as report_file:
+            report = json.load(report_file)
+        self.assertEqual(4, report['revision'])
+        self.assertEqual(['a.txt'], [os.path.basename(x) for x in report['conflicted']])
+        self.assertTrue('svn merge -c 4' in '\n'.join(report['resolve']))
+        with open(os.path.join(directory, 'conflict.html')) as html_file:
+            self.assertTrue('a.txt</code>' in html_file.read())
+
+        self.edit('/trunk/a.txt', ('y\n', 'b\n', 'c\n'))
+        self.assertEqual(0, idlemerge_sim.sim_idlemerge(
+            self.repository, '/branches/stable', '/trunk', conflict_report=filename).launch_merge())
+        self.assertFalse(os.path.exists(filename))
+
+    def test_budget(self):
+        self.repository.commit('alice', 'fix', {'/branches/stable/c.txt': ('c\n',)})
+        self.repository.commit('alice', 'fix', {'/branches/stable/d.txt': ('d\n',)})
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cursor_filename = os.path.join(tmpdir, 'cursor.json')
+        merge = idlemerge_sim.sim_idlemerge(
+            self.repository, '/branches/stable', '/trunk', budget=idlemerge.PassBudget(1),
+            cursor_filename=cursor_filename)
+        self.assertEqual(0, merge.launch_merge())
+        self.assertEqual([3], [x.number for x in merge.pass_stats.merged])
+        self.assertEqual('--max 1', merge.pass_stats.budget_stop)
+        cursor = merge.load_cursor()
+        self.assertEqual((4, 1, '--max 1'), (cursor['next'], cursor['pending'], cursor['stopped']))
+        self.assertEqual(0, merge.launch_merge())
+        self.assertEqual([4], [x.number for x in merge.pass_stats.merged])
+        self.assertEqual(None, merge.pass_stats.budget_stop)
+        cursor = merge.load_cursor()
+        self.assertEqual((None, None), (cursor['next'], cursor['stopped']))
+        self.assertEqual(('d\n',), self.repository.content('/trunk/d.txt'))
+
+    def test_urgent_first(self):
+        self.edit('/branches/stable/a.txt', ('A\n', 'b\n', 'c\n'))
+        self.edit('/branches/stable/a.txt', ('A\n', 'B\n', 'c\n'), 'MERGE_URGENT overlapping')
+        self.edit('/branches/stable/b.txt', ('B\n',), 'MERGE_URGENT hotfix')
+        merge, return_code = self.merge()
+        self.assertEqual(0, return_code)
+        self.assertEqual([5, 3, 4], [int(x.msg.split('@')[1].split(']')[0])
+                                     for x in self.repository.revisions[6:]])
+        data = idlemerge.IdleData(self.repository.revisions[6].msg.split('-- IDLEMERGE DATA --')[1])
+        self.assertEqual('MERGE_URGENT', data.values['URGENT'])
+        self.assertEqual([3, 4], data.ahead_of)
+        self.assertFalse('AHEAD_OF=' in self.repository.revisions[8].msg)
+
+    def test_ignore_patterns(self):
+        self.repository.commit('alice', 'fix', {
+            '/branches/stable/a.txt': ('A\n', 'b\n', 'c\n'),
+            '/branches/stable/conf/prod.ini': ('prod\n',),
+            '/branches/stable/lib/release.pom': ('1.1\n',)})
+        merge = idlemerge_sim.sim_idlemerge(
+            self.repository, '/branches/stable', '/trunk', ignore=['conf/', '**/*.pom'])
+        self.assertEqual(0, merge.launch_merge())
+        self.assertEqual(('A\n', 'b\n', 'c\n'), self.repository.content('/trunk/a.txt'))
+        self.assertEqual(None, self.repository.content('/trunk/conf/prod.ini'))
+        self.assertEqual(None, self.repository.content('/trunk/lib/release.pom'))
+
+    def test_predicted_batches(self):
+        self.edit('/branches/stable/a.txt', ('A\n', 'b\n', 'c\n'))
+        self.repository.commit('alice', 'new', {'/branches/stable/c.txt': ('c\n',)})
+        self.edit('/trunk/b.txt', ('b\n', 'trunk\n'))
+        self.edit('/branches/stable/b.txt', ('B\n',))
+        merge = idlemerge_sim.sim_idlemerge(
+            self.repository, '/branches/stable', '/trunk', predict_batch=10)
+        # r6 is merged alone since the target changed b.txt, it does conflict.
+        self.assertEqual(1, merge.launch_merge())
+        self.assertEqual([3, 4], sorted([x.number for x in merge.pass_stats.merged]))
+        self.assertEqual(6, merge.pass_stats.conflict.revision.number)
+        self.assertEqual(7, self.repository.head)
+        self.assertTrue(self.repository.revisions[7].msg.startswith(
+            'merge revisions 3, 4 from ^/branches/stable'))
+        self.assertEqual(('c\n',), self.repository.content('/trunk/c.txt'))
+
+    def test_predicted_conflict_from_older_target_change(self):
+        # The trunk edit of r3 is older than the pending revisions, yet after the branch copy.
+        self.edit('/trunk/a.txt', ('x\n', 'b\n', 'c\n'))
+        self.edit('/branches/stable/a.txt', ('y\n', 'b\n', 'c\n'))
+        self.edit('/branches/stable/b.txt', ('B\n',))
+        merge = idlemerge_sim.sim_idlemerge(
+            self.repository, '/branches/stable', '/trunk', predict_batch=10)
+        self.assertEqual(1, merge.launch_merge())
+        self.assertTrue(merge.predictor.likely_conflict(merge.pass_stats.conflict.revision))
+        self.assertFalse('isolating' in sys.stdout.getvalue())
+        self.assertEqual(4, merge.pass_stats.conflict.revision.number)
+        self.assertEqual(5, self.repository.head)
+
+    def test_merge_base_after_last_automerge(self):
+        self.edit('/trunk/a.txt', ('x\n', 'b\n', 'c\n'))
+        self.edit('/branches/stable/b.txt', ('B\n',))
+        merge = idlemerge_sim.sim_idlemerge(self.repository, '/branches/stable', '/trunk')
+        self.assertEqual(0, merge.launch_merge())
+        self.assertEqual(5, self.repository.head)
+        self.edit('/branches/stable/a.txt', ('a\n', 'b\n', 'C\n'))
+        merge = idlemerge_sim.sim_idlemerge(self.repository, '/branches/stable', '/trunk')
+        merge.predictor.load(merge.get_eligible_revisions())
+        # r3 was changed on the target before the automerge r5, only later changes diverge.
+        self.assertEqual(5, merge.predictor.merge_base('^/trunk'))
+        self.assertFalse(merge.predictor.diverged.overlaps('a.txt'))
+
+    def test_mispredicted_batch_paths_not_kept(self):
+        self.edit('/trunk/a.txt', ('x\n', 'b\n', 'c\n'))
+        self.edit('/branches/stable/a.txt', ('y\n', 'b\n', 'c\n'))
+        self.edit('/branches/stable/b.txt', ('B\n',))
+        merge = idlemerge_sim.sim_idlemerge(self.repository, '/branches/stable', '/trunk')
+        merged_paths = idlemerge.PathTrie(['.'])
+        self.assertFalse(merge.merge_batch(merge.get_eligible_revisions(), merged_paths))
+        self.assertEqual(['.'], list(merged_paths))
+
+    def test_plan_revisions(self):
+        self.edit('/trunk/a.txt', ('x\n', 'b\n', 'c\n'))
+        self.edit('/branches/stable/a.txt', ('y\n', 'b\n', 'c\n'))
+        self.edit('/branches/stable/b.txt', ('B\n',))
+        self.edit('/branches/stable/b.txt', ('b\n',), 'NO_MERGE revert')
+        merge = idlemerge_sim.sim_idlemerge(self.repository, '/branches/stable', '/trunk')
+        results = [merge.plan_revision(x) for x in merge.get_eligible_revisions()]
+        plan = idlemerge.MergePlan(results)
+        self.assertEqual([(4, 'conflict'), (5, 'clean'), (6, 'record_only')],
+                         [(x['revision'], x['outcome']) for x in plan.results])
+        self.assertEqual(['a.txt'], plan.results[0]['paths'])
+        self.assertEqual(1, plan.counts()['clean'])
+        self.assertTrue('1 clean, 0 mergeinfo, 1 record_only' in str(plan))
+        # The working copy is left pristine, nothing was committed.
+        self.assertEqual(6, self.repository.head)
+        self.assertFalse(merge.svn_status().entries)
+
+
+class testPathTrie(unittest.TestCase):
+
+    def test_lookup(self):
+        trie = idlemerge.PathTrie(['.', 'a/b.txt'])
+        trie.add('lib', prefix=True)
+        trie.add_pattern('conf/')
+        trie.add_pattern('*.pom')
+        trie.add_pattern('modules/**/pom.xml')
+        for path in ('.', 'a/b.txt', 'lib', 'lib/x/y.py', 'conf', 'conf/a.ini', 'root.pom',
+                     'modules/pom.xml', 'modules/x/y/pom.xml'):
+            self.assertTrue(path in trie, path)
+        for path in ('a', 'a/b.txt.orig', 'library', 'x/root.pom', 'modules/x/pom.xml.bak'):
+            self.assertFalse(path in trie, path)
+        self.assertEqual(['.', 'a/b.txt', 'lib/', 'conf/', '*.pom', 'modules/**/pom.xml'],
+                         list(trie))
+        self.assertTrue(idlemerge.PathTrie(['a', 'b/c']).exact_only)
+        self.assertFalse(trie.exact_only)
+
+    def test_batched_revert(self):
+        merge = idlemerge.IdleMerge('^/branches/stable')
+        merge.execute_svn_command = mock.Mock(return_value=0)
+        merge.svn_revert(['a', 'b'])
+        merge.execute_svn_command.assert_called_with(['revert', 'a', 'b'])
+        merge.svn_revert(['f%d' % x for x in range(500)])
+        command = merge.execute_svn_command.call_args[0][0]
+        self.assertEqual(['revert', '--targets'], command[:2])
+
+
+class testPassBudget(unittest.TestCase):
+
+    def test_exhausted(self):
+        self.assertEqual(None, idlemerge.PassBudget().exhausted())
+        budget = idlemerge.PassBudget(revisions=3, size=100)
+        budget.charge(2, 60)
+        self.assertEqual(None, budget.exhausted())
+        budget.charge(1, 10)
+        self.assertEqual('--max 3', budget.exhausted())
+        budget.start()
+        budget.charge(1, 100)
+        self.assertEqual('--max_bytes 100', budget.exhausted())
+        budget = idlemerge.PassBudget(seconds=60)
+        budget.started -= 61
+        self.assertEqual('--max_seconds 60', budget.exhausted())
+
+
+class testNoMergeRules(unittest.TestCase):
+
+    def revision(self, msg, author='alice', paths=()):
+        revision = mock.Mock()
+        revision.msg = msg
+        revision.author = author
+        revision.paths = []
+        for path in paths:
+            log_path = mock.Mock()
+            log_path.path = path
+            revision.paths.append(log_path)
+        return revision
+
+    def test_invalid_regex_skipped(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            rules = idlemerge.NoMergeRules(['re:fix(', 're:^Release', 'NO_MERGE'])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertTrue('re:fix(' in output)
+        self.assertEqual(2, rules.count)
+        self.assertEqual('re:^Release', rules.match(self.revision('Release 12')))
+        self.assertEqual(None, rules.match(self.revision('fix(foo)')))
+
+    def test_aho_corasick(self):
+        automaton = idlemerge.AhoCorasick(['he', 'she', 'hers', 'his'])
+        self.assertEqual('she', automaton.search('ushers'))
+        self.assertEqual('his', automaton.search('this'))
+        self.assertEqual(None, automaton.search('hi'))
+        self.assertEqual(None, idlemerge.AhoCorasick([]).search('anything'))
+
+    def test_match(self):
+        rules = idlemerge.NoMergeRules(
+            ['NO_MERGE', 're:^Release \\d+', 'author:jenkins', 'path:*.pom'] +
+            ['RULE%04d' % x for x in range(2000)])
+        branch = '/branches/stable'
+        self.assertEqual('NO_MERGE', rules.match(self.revision('fix NO_MERGE')))
+        self.assertEqual('RULE1999', rules.match(self.revision('see RULE1999')))
+        self.assertEqual('re:^Release \\d+', rules.match(self.revision('Release 12')))
+        self.assertEqual('author:jenkins', rules.match(self.revision('fix', 'jenkins')))
+        self.assertEqual('path:*.pom', rules.match(
+            self.revision('fix', paths=['/branches/stable/lib/x.pom']), branch))
+        self.assertEqual(None, rules.match(
+            self.revision('fix Release 1', paths=['/trunk/x.pom', '/branches/stable/x.py']),
+            branch))
+
+    def test_reload(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'patterns.txt')
+        rules = idlemerge.NoMergeRules(['NO_MERGE'], filename)
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            rules.reload()
+            self.assertEqual(None, rules.match(self.revision('prod only')))
+            with open(filename, 'w') as rules_file:
+                rules_file.write('# branch specific\nprod only\n')
+            rules.reload()
+            self.assertEqual('prod only', rules.match(self.revision('prod only')))
+            with open(filename, 'w') as rules_file:
+                rules_file.write('author:bob\n')
+            os.utime(filename, (time.time() + 10, time.time() + 10))
+            rules.reload()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(None, rules.match(self.revision('prod only')))
+        self.assertEqual('NO_MERGE', rules.match(self.revision('NO_MERGE')))
+
+
+class testRunJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'run.journal')
+        self.repository = idlemerge_sim.SimRepository()
+        self.repository.commit('bob', 'import', {'/trunk/a.txt': ('a\n',)})
+        self.repository.commit('bob', 'branch', copies=[('/trunk', 1, '/branches/stable')])
+        self.repository.commit('alice', 'fix', {'/branches/stable/a.txt': ('A\n',)})
+        self.working_copy = idlemerge_sim.SimWorkingCopy(self.repository, '/trunk')
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.tmpdir)
+
+    def merge(self):
+        merge = idlemerge_sim.sim_idlemerge(self.repository, '/branches/stable', '/trunk')
+        merge.svn.backend = idlemerge_sim.SimSvn(self.working_copy)
+        merge.run_journal = idlemerge.RunJournal(self.filename)
+        return merge
+
+    def crash(self, commit_first):
+        merge = self.merge()
+        commit = merge.commit
+
+        def killed(*args, **kwargs):
+            if commit_first:
+                commit(*args, **kwargs)
+            raise KeyboardInterrupt()
+        merge.commit = killed
+        self.assertRaises(KeyboardInterrupt, merge.launch_merge)
+        self.assertEqual('commit', merge.run_journal.interrupted()['step'])
+
+    def test_interrupted(self):
+        journal = idlemerge.RunJournal(self.filename)
+        journal.start()
+        journal.record('merge', [3])
+        self.assertEqual('merge', journal.interrupted()['step'])
+        with open(self.filename, 'a') as journal_file:
+            journal_file.write('{"step": "done"')
+        self.assertEqual([3], journal.interrupted()['revisions'])
+        journal.start()
+        journal.record('done')
+        self.assertEqual(None, journal.interrupted())
+
+    def test_resume_commit(self):
+        self.crash(commit_first=False)
+        self.assertEqual(3, self.repository.head)
+        merge = self.merge()
+        self.assertEqual(0, merge.launch_merge())
+        self.assertEqual(4, self.repository.head)
+        self.assertEqual(('A\n',), self.repository.content('/trunk/a.txt'))
+        self.assertEqual([3], [x.number for x in merge.pass_stats.merged])
+        self.assertTrue('Resume: committed the interrupted merge' in sys.stdout.getvalue())
+
+    def test_resume_landed(self):
+        self.crash(commit_first=True)
+        self.assertEqual(4, self.repository.head)
+        merge = self.merge()
+        self.assertEqual(0, merge.launch_merge())
+        self.assertEqual(4, self.repository.head)
+        self.assertTrue('Resume: the merge landed as r4' in sys.stdout.getvalue())
+
+
+class testMetricsExporter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'idlemerge.prom')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def revision(self, number):
+        return idlemerge.Revision(xml_element=xml.etree.ElementTree.fromstring(
+            '<logentry revision="%d"><author>bob</author>'
+            '<date>2012-01-27T02:08:20.565277Z</date><msg>fix</msg></logentry>' % number))
+
+    def merge_pass(self, conflict_revision=None):
+        tracer = idlemerge.RunTrace()
+        fake = mock.Mock()
+        fake.source = '^/foo/stable'
+        fake.target_label = '^/foo/trunk'
+        fake.lock_wait = 0.0
+        fake.pass_stats = idlemerge.PassStats(tracer)
+        fake.pass_stats.eligible = [self.revision(3), self.revision(4)]
+        fake.pass_stats.merged.add(fake.pass_stats.eligible[0])
+        if conflict_revision:
+            fake.pass_stats.conflict = idlemerge.Conflict(self.revision(conflict_revision))
+        tracer.record_command(['merge', '-c', '3'], 0.5, 10, 0)
+        fake.pass_stats.finish(tracer)
+        return fake
+
+    def samples(self, text):
+        return dict((line.split('{')[0], float(line.split()[-1]))
+                    for line in text.splitlines() if not line.startswith('#'))
+
+    def test_render(self):
+        exporter = idlemerge.MetricsExporter(self.filename)
+        exporter.update(self.merge_pass(4))
+        with open(self.filename) as metrics_file:
+            text = metrics_file.read()
+        self.assertTrue('# TYPE idlemerge_pending_revisions gauge' in text)
+        self.assertTrue('source="^/foo/stable",subcommand="merge",target="^/foo/trunk"' in text)
+        samples = self.samples(text)
+        self.assertEqual(2, samples['idlemerge_eligible_revisions'])
+        self.assertEqual(1, samples['idlemerge_pending_revisions'])
+        self.assertEqual(4, samples['idlemerge_conflict_revision'])
+        self.assertEqual(1, samples['idlemerge_pass_svn_commands'])
+        self.assertTrue(samples['idlemerge_oldest_pending_age_seconds'] > 0)
+
+    def test_conflict_since_survives_runs(self):
+        idlemerge.MetricsExporter(self.filename).update(self.merge_pass(4))
+        with open(self.filename) as metrics_file:
+            since = self.samples(metrics_file.read())[
+                'idlemerge_conflict_since_timestamp_seconds']
+        exporter = idlemerge.MetricsExporter(self.filename)
+        exporter.update(self.merge_pass(4))
+        self.assertEqual(since, self.samples(exporter.render())[
+            'idlemerge_conflict_since_timestamp_seconds'])
+        exporter.update(self.merge_pass())
+        self.assertEqual(0, self.samples(exporter.render())['idlemerge_conflict_blocking'])
+
+
+class testRunLock(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'idlemerge.lock')
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.directory)
+
+    def test_default_filename(self):
+        target = os.path.join(self.directory, 'wc', 'sub', 'dir')
+        self.assertRaises(idlemerge.Error, idlemerge.RunLock.default_filename, target)
+        os.makedirs(os.path.join(self.directory, 'wc', '.svn'))
+        os.makedirs(target)
+        self.assertEqual(os.path.join(self.directory, 'wc', '.svn', 'idlemerge.lock'),
+                         idlemerge.RunLock.default_filename(target))
+
+    def test_skip_while_held(self):
+        holder = idlemerge.RunLock(self.filename, 'stable-trunk')
+        self.assertTrue(holder.acquire())
+        self.assertEqual('stable-trunk', holder.holder()['label'])
+        self.assertFalse(idlemerge.RunLock(self.filename).acquire())
+        holder.release()
+        self.assertEqual(None, holder.holder())
+        self.assertTrue(idlemerge.RunLock(self.filename).acquire())
+
+    def test_stale_lock_is_taken_over(self):
+        with open(self.filename, 'w') as lock_file:
+            lock_file.write('{"pid": 1, "host": "gone", "label": "x", "start": 0}')
+        lock = idlemerge.RunLock(self.filename, 'stable-trunk')
+        self.assertTrue(lock.acquire())
+        self.assertTrue('stale lock of pid 1' in sys.stdout.getvalue())
+        self.assertEqual(os.getpid(), lock.holder()['pid'])
+        lock.release()
+
+    def test_queue_one_behind(self):
+        holder = idlemerge.RunLock(self.filename)
+        self.assertTrue(holder.acquire())
+        queued = open(self.filename + '.queue', 'a+')
+        self.assertTrue(idlemerge.RunLock._flock(queued))
+        self.assertFalse(
+            idlemerge.RunLock(self.filename, policy='queue', timeout=0).acquire())
+        self.assertTrue('already queued' in sys.stdout.getvalue())
+        queued.close()
+        waiting = idlemerge.RunLock(self.filename, policy='queue', timeout=0)
+        self.assertFalse(waiting.acquire())
+        self.assertTrue('gave up waiting' in sys.stdout.getvalue())
+        holder.release()
+        self.assertTrue(waiting.acquire())
+        waiting.release()
+
+    def test_signal_during_command(self):
+        received = []
+        handler = signal.signal(signal.SIGUSR1, lambda *_: received.append(True))
+        try:
+            result = idlemerge.execute_command(
+                ['sh', '-c', 'sleep 0.2; kill -USR1 $PPID; sleep 0.2; echo done'])
+        finally:
+            signal.signal(signal.SIGUSR1, handler)
+        self.assertEqual([True], received)
+        self.assertEqual(0, result['return_code'])
+        self.assertEqual(['done\n'], result['stdout'])
+
+
+class testConflictNotifications(unittest.TestCase):
+    def setUp(self):
+        self.revision = mock.Mock(number=5, author='foo')
+        self.directory = tempfile.mkdtemp()
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.directory)
+
+    def conflict(self, status_lines):
+        return idlemerge.Conflict(
+            revision=self.revision, source='^/branches/stable', target='.',
+            status_lines=status_lines)
+
+    def test_email_once_until_changed(self):
+        state = os.path.join(self.directory, 'notified.json')
+        outbox = mock.Mock()
+        outbox.pending.return_value = False
+        merge_email = idlemerge.MergeEmail(
+            'conflict', '@localhost', None, 'fake_sender', None,
+            idlemerge.NotificationLog(state, 3600), outbox)
+        merge_email.email_conflict(self.conflict(['C  a.txt']))
+        # Queued but not delivered yet.
+        self.assertEqual({}, idlemerge.NotificationLog(state).entries)
+        merge_email.email_conflict(self.conflict(['C  a.txt']))
+        self.assertEqual(1, outbox.put.call_count)
+        merge_email.delivered(outbox.put.call_args[0][3])
+        merge_email.email_conflict(self.conflict(['C  a.txt']))
+        self.assertEqual(1, outbox.put.call_count)
+        merge_email.email_conflict(self.conflict(['C  a.txt', 'C  b.txt']))
+        self.assertEqual(2, outbox.put.call_count)
+        merge_email.delivered(outbox.put.call_args[0][3])
+
+        notifications = idlemerge.NotificationLog(state, 3600)
+        key = '^/branches/stable>.@5'
+        digest = notifications.entries[key]['digest']
+        self.assertEqual(None, notifications.due(key, digest))
+        self.assertEqual('reminder', notifications.due(key, digest, time.time() + 3600))
+        merge_email.conflict_cleared('^/branches/stable', '.')
+        self.assertEqual({}, idlemerge.NotificationLog(state).entries)
+
+    def test_failed_message_queued_again(self):
+        delivered = []
+        outbox = idlemerge.MailOutbox('relay', on_delivered=delivered.append)
+        with mock.patch('smtplib.SMTP', side_effect=idlemerge.socket.error('refused')):
+            outbox.put('sender', ['foo@localhost'], 'first', 1)
+            outbox.wait()
+        self.assertEqual([], delivered)
+        with mock.patch('smtplib.SMTP') as smtp:
+            outbox.put('sender', ['bar@localhost'], 'second', 2)
+            outbox.wait()
+        self.assertEqual(
+            ['first', 'second'], [x[0][2] for x in smtp.return_value.sendmail.call_args_list])
+        self.assertEqual([1, 2], delivered)
+
+    def test_spool_delivered_over_one_connection(self):
+        spool = os.path.join(self.directory, 'spool')
+        outbox = idlemerge.MailOutbox('relay', spool)
+        with mock.patch('smtplib.SMTP', side_effect=idlemerge.socket.error('refused')):
+            outbox.put('sender', ['foo@localhost'], 'first')
+            outbox.wait()
+        self.assertEqual(1, len(outbox.spooled()))
+        with mock.patch('smtplib.SMTP') as smtp:
+            outbox.put('sender', ['bar@localhost'], 'second')
+            outbox.wait()
+        smtp.assert_called_once_with('relay')
+        self.assertEqual(
+            ['first', 'second'], [x[0][2] for x in smtp.return_value.sendmail.call_args_list])
+        self.assertEqual([], outbox.spooled())
+        self.assertEqual(2, outbox.delivered)
+
+    def test_spooled_conflict_not_spooled_again(self):
+        state = os.path.join(self.directory, 'notified.json')
+        spool = os.path.join(self.directory, 'spool')
+        with mock.patch('smtplib.SMTP', side_effect=idlemerge.socket.error('refused')):
+            for _ in range(2):
+                # A new run, only the state file and the spool are kept.
+                outbox = idlemerge.MailOutbox('relay', spool)
+                merge_email = idlemerge.MergeEmail(
+                    'conflict', '@localhost', None, 'fake_sender', None,
+                    idlemerge.NotificationLog(state, 3600), outbox)
+                merge_email.email_conflict(self.conflict(['C  a.txt']))
+                outbox.wait()
+        self.assertEqual(1, len(outbox.spooled()))
+        self.assertTrue('already queued' in sys.stdout.getvalue())
+
+
+class testConflictReport(unittest.TestCase):
+    def test_classify_status_lines(self):
+        report = idlemerge.ConflictReport.from_lines([
+            ' M      .\n', 'C       a.txt\n', 'A  +    new.txt\n', 'D       gone.txt\n',
+            '!     C moved.txt\n', 'M       Conf.txt\n', '?       junk\n',
+            'Summary of conflicts:\n'])
+        self.assertEqual(['moved.txt', 'a.txt'], report.files('conflicted'))
+        self.assertEqual(['Conf.txt'], report.files('merged'))
+        self.assertEqual(['new.txt'], report.files('added'))
+        self.assertEqual(['gone.txt'], report.files('deleted'))
+        self.assertEqual('Summary of conflicts:', report.lines[-1])
+        copy = idlemerge.ConflictReport.from_dict(json.loads(json.dumps(report.as_dict())))
+        self.assertEqual(report.lines, copy.lines)
+        self.assertEqual(report.files('conflicted'), copy.files('conflicted'))
+
+
+class testBench(unittest.TestCase):
+
+    def result(self, wall, mode='single', status='ok', key='abc'):
+        return {'scenario': 'small', 'scenario_key': key, 'mode': mode, 'status': status,
+                'wall': wall, 'svn_commands': 100, 'peak_rss_kb': 1000}
+
+    def test_compare_results(self):
+        previous = [self.result(20.0), self.result(10.0), self.result(10.0, mode='concise')]
+        lines, regressed = idlemerge_bench.compare_results(
+            previous, [self.result(11.0), self.result(5.0, mode='concise')], 0.2)
+        # The last result of the same scenario, mode and status is the baseline.
+        self.assertFalse(regressed)
+        self.assertTrue('+10.0%' in lines[0])
+        self.assertTrue('-50.0%' in lines[3])
+        self.assertFalse([x for x in lines if 'REGRESSION' in x])
+        lines, regressed = idlemerge_bench.compare_results(previous, [self.result(12.5)], 0.2)
+        self.assertTrue(regressed)
+        self.assertTrue(lines[0].endswith('+25.0%  REGRESSION'))
+        self.assertFalse('REGRESSION' in lines[1])
+
+    def test_compare_results_without_baseline(self):
+        previous = [self.result(10.0, key='other'), self.result(10.0, status='conflict')]
+        lines, regressed = idlemerge_bench.compare_results(previous, [self.result(50.0)], 0.2)
+        self.assertFalse(regressed)
+        self.assertEqual(['small      single   no previous result'], lines)
+
+    def test_scenario_key(self):
+        scenario = idlemerge_bench.Scenario('small', history=50, conflict_rate=0.1)
+        self.assertEqual(scenario.key, idlemerge_bench.Scenario(
+            'renamed', history=50, conflict_rate=0.1).key)
+        self.assertNotEqual(scenario.key, idlemerge_bench.Scenario(
+            'small', history=50, conflict_rate=0.1, seed=1).key)
+        self.assertNotEqual(scenario.key, idlemerge_bench.Scenario(
+            'small', history=50, conflict_rate=0.1, layout='deep').key)
+        self.assertRaises(idlemerge_bench.BenchError, idlemerge_bench.Scenario, 'x', layout='flat')
+
+    def build(self, scenario):
+        """Returns the commit messages and the final files of scenario, svn copies the files."""
+        directory = tempfile.mkdtemp()
+        builder = idlemerge_bench.RepositoryBuilder(scenario, os.path.join(directory, 'bench'))
+        commits = []
+        files = {}
+
+        def svn_call(args, cwd=None):
+            if args[1] == 'copy':
+                shutil.copytree(args[-2], args[-1])
+            elif args[1] == 'commit':
+                commits.append(args[4])
+                for path in builder.paths:
+                    for branch in (scenario.target_path, scenario.source_path):
+                        if os.path.exists(os.path.join(builder.wc, branch)):
+                            files[branch, path] = builder.read_file(os.path.join(branch, path))
+            return ''
+        try:
+            with mock.patch('idlemerge_bench.svn_call', side_effect=svn_call):
+                builder.build()
+        finally:
+            shutil.rmtree(directory)
+        return commits, files
+
+    def test_repository_builder(self):
+        scenario = idlemerge_bench.Scenario(
+            'tiny', history=3, files=4, dirs=2, conflict_rate=1.0, no_merge_rate=1.0)
+        commits, files = self.build(scenario)
+        self.assertEqual(
+            ['Initial import', 'Create branches/stable',
+             'Conflicting change 0', 'Source change 0 NO_MERGE',
+             'Conflicting change 1', 'Source change 1 NO_MERGE',
+             'Conflicting change 2', 'Source change 2 NO_MERGE'], commits)
+        # The seed drives the generation, each source change edits the line changed on the target.
+        self.assertEqual((commits, files), self.build(scenario))
+        for path in ['dir%04d/file%06d.txt' % (x % 2, x) for x in range(4)]:
+            target, source = files['trunk', path], files['branches/stable', path]
+            for target_line, source_line in zip(target, source):
+                if target_line != source_line:
+                    self.assertEqual(target_line.replace('target', 'source'), source_line)
+        self.assertEqual(
+            3, len([x for x in sum(files.values(), []) if x.startswith('source change')]))
+
 
 if __name__ == '__main__':
     unittest.main()